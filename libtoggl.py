@@ -1,5 +1,10 @@
+import bisect
+import calendar
+import datetime
 import json
-import requests
+import re
+import threading
+import time
 import urllib
 try:
     from urllib.parse import quote as url_quote
@@ -8,6 +13,34 @@ except:
 
 TOGGL_API_VERSION = 'v6'
 
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 10
+
+# Long time entry ranges are fetched in windows of this size (day, week,
+# month or None for a single request), this many at a time.
+FETCH_WINDOWS = ('day', 'week', 'month')
+DEFAULT_FETCH_WINDOW = 'month'
+DEFAULT_FETCH_PARALLEL = 4
+
+# Toggl allows roughly one request per second per token. Short bursts are
+# let through, and 429s or server errors are retried with jittered
+# exponential backoff.
+DEFAULT_RATE_LIMIT = 1.0
+DEFAULT_RATE_BURST = 4
+DEFAULT_MAX_RETRIES = 4
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+RETRY_AFTER_MAX = 300.0
+
+UTC = datetime.timezone.utc
+TIMESTAMP_CACHE_SIZE = 65536
+
+# The fixed timestamp format returned by the API, e.g.
+# 2013-04-01T09:30:00+00:00 or 2013-04-01T09:30:00.123Z
+ISO_TIMESTAMP_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})'
+        r'(?:\.(\d+))?(?:(Z)|([+-])(\d{2}):?(\d{2}))?$')
+
 KEY_ID          = 'id'
 KEY_NAME        = 'name'
 KEY_DESC        = 'description'
@@ -32,12 +65,143 @@ KEY_CREATEDW    = 'created_with'
 KEY_IGNTIMES    = 'ignore_start_and_stop'
 KEY_ESTSECS     = 'estimated_seconds'
 KEY_TASK        = 'task'
+KEY_USER        = 'user'
+
+# Parsed API timestamps, keyed by the original string. Listings repeat the
+# same timestamps a lot (one entry's stop is often the next one's start).
+_timestamp_cache = {}
+
+def timestamp_to_epoch(value):
+    """Converts a datetime or an API timestamp string to UTC epoch seconds.
+       Naive values are taken to be in UTC."""
+    if isinstance(value, datetime.datetime):
+        epoch = calendar.timegm(value.utctimetuple())
+        return epoch + value.microsecond / 1000000.0
+
+    epoch = _timestamp_cache.get(value)
+    if epoch is not None:
+        return epoch
+
+    m = ISO_TIMESTAMP_RE.match(str(value))
+    if m is None:
+        # Not the fixed API format; let dateutil figure it out.
+        import dateutil.parser
+        return timestamp_to_epoch(dateutil.parser.parse(value))
+
+    (year, month, day, hour, minute, second,
+            frac, zulu, sign, off_h, off_m) = m.groups()
+    epoch = calendar.timegm((int(year), int(month), int(day),
+        int(hour), int(minute), int(second)))
+    if frac:
+        epoch += float('0.' + frac)
+    if sign:
+        offset = int(off_h) * 3600 + int(off_m) * 60
+        epoch -= offset if sign == '+' else -offset
+
+    if len(_timestamp_cache) >= TIMESTAMP_CACHE_SIZE:
+        _timestamp_cache.clear()
+    _timestamp_cache[value] = epoch
+    return epoch
+
+def epoch_to_datetime(epoch):
+    """Converts UTC epoch seconds to an aware UTC datetime."""
+    return datetime.datetime.fromtimestamp(epoch, UTC)
+
+def timestamp_to_datetime(value):
+    """Converts an API timestamp string to an aware UTC datetime."""
+    return epoch_to_datetime(timestamp_to_epoch(value))
+
+def plan_windows(low, high, unit):
+    """Splits the epoch range low..high at UTC day, week (Monday) or month
+    boundaries. Returns a list of (low, high) pairs covering the range."""
+    if unit not in FETCH_WINDOWS:
+        raise ValueError("Unknown window size: %s" % unit)
+
+    windows = []
+    start = low
+    day = epoch_to_datetime(low).date()
+    while True:
+        if unit == 'day':
+            day = day + datetime.timedelta(days=1)
+        elif unit == 'week':
+            day = day + datetime.timedelta(days=7 - day.weekday())
+        elif day.month == 12:
+            day = datetime.date(day.year + 1, 1, 1)
+        else:
+            day = datetime.date(day.year, day.month + 1, 1)
+        boundary = calendar.timegm(day.timetuple())
+        if boundary >= high:
+            break
+        windows.append((start, boundary))
+        start = boundary
+    windows.append((start, high))
+    return windows
+
+def localize(tz, naive):
+    """Attaches tz to a naive local datetime, for pytz and plain tzinfos."""
+    if hasattr(tz, 'localize'):
+        return tz.localize(naive)
+    return naive.replace(tzinfo=tz)
+
+class TogglBuckets(object):
+    """Assigns UTC epochs to local calendar days, weeks or months.
+
+    The local period boundaries between low and high are worked out once in
+    the given timezone and converted to UTC epochs, so each lookup is a
+    binary search. Boundaries are computed from local midnights, so days
+    around DST changes get their real length of 23 or 25 hours."""
+    UNITS = ('day', 'week', 'month')
+
+    def __init__(self, tz, low, high, unit='day'):
+        if unit not in self.UNITS:
+            raise ValueError("Unknown bucket unit: %s" % unit)
+        self._tz = tz
+        self._unit = unit
+        self._starts = []
+        self._labels = []
+
+        day = self._period_start(epoch_to_datetime(low).astimezone(tz).date())
+        last = epoch_to_datetime(high).astimezone(tz).date()
+        while day <= last:
+            local = localize(tz, datetime.datetime(day.year, day.month, day.day))
+            self._starts.append(timestamp_to_epoch(local))
+            self._labels.append(local)
+            day = self._next_period(day)
+
+    def _period_start(self, day):
+        if self._unit == 'week':
+            return day - datetime.timedelta(days=day.weekday())
+        elif self._unit == 'month':
+            return day.replace(day=1)
+        return day
+
+    def _next_period(self, day):
+        if self._unit == 'week':
+            return day + datetime.timedelta(days=7)
+        elif self._unit == 'month':
+            if day.month == 12:
+                return day.replace(year=day.year + 1, month=1)
+            return day.replace(month=day.month + 1)
+        return day + datetime.timedelta(days=1)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def bucket(self, epoch):
+        """Returns the index of the period containing epoch, or -1."""
+        return bisect.bisect_right(self._starts, epoch) - 1
+
+    def label(self, index):
+        """Returns the local datetime at which the period starts."""
+        return self._labels[index]
 
 class TogglRawData:
     def __init__(self):
         self._url = None
         self._reqdata = None
         self._respdata = None
+        self._validators = None
+        self._not_modified = False
 
     @property
     def request_url(self):
@@ -63,43 +227,472 @@ class TogglRawData:
     def response_data(self, value):
         self._respdata = value
 
+    @property
+    def validators(self):
+        """The ETag, Last-Modified and content hash of the response."""
+        return self._validators
+
+    @validators.setter
+    def validators(self, value):
+        self._validators = value
+
+    @property
+    def not_modified(self):
+        return self._not_modified
+
+    @not_modified.setter
+    def not_modified(self, value):
+        self._not_modified = value
+
+def response_validators(r):
+    """Returns the validators identifying the content of a response."""
+    import hashlib
+    return {
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+        'hash': hashlib.sha1(r.content).hexdigest(),
+    }
+
+class TogglRateLimiter:
+    """Token bucket shared by every request of a TogglApi, including those
+    sent from worker threads."""
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(int(burst), 1)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self):
+        """Takes a token and returns how long to wait before sending."""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def pause(self, seconds):
+        """Holds back every request for the given number of seconds, e.g.
+        after the server answered with a Retry-After header."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+def parse_retry_after(value):
+    """Returns the delay in seconds of a Retry-After header, or None."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    import email.utils
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(email.utils.mktime_tz(date) - time.time(), 0.0)
+
+CASSETTE_VERSION = 1
+
+class TogglExchange(TogglRawData):
+    """A request and its response as kept in a cassette: the raw data plus
+    the method, status, headers and timing of the exchange."""
+    def __init__(self, fields=None):
+        TogglRawData.__init__(self)
+        fields = fields or {}
+        self.method = fields.get('method')
+        self.request_url = fields.get('request_url')
+        self.request_data = fields.get('request_data')
+        self.request_headers = fields.get('request_headers') or {}
+        self.status = fields.get('status')
+        self.headers = fields.get('headers') or {}
+        self.response_data = fields.get('response_data')
+        # Seconds from the start of the recording, and the time taken.
+        self.at = fields.get('at', 0.0)
+        self.elapsed = fields.get('elapsed', 0.0)
+
+    def to_json(self):
+        return {
+            'method': self.method,
+            'request_url': self.request_url,
+            'request_data': self.request_data,
+            'request_headers': self.request_headers,
+            'status': self.status,
+            'headers': self.headers,
+            'response_data': self.response_data,
+            'at': self.at,
+            'elapsed': self.elapsed,
+        }
+
+class TogglReplayHeaders(dict):
+    """Case-insensitive response headers."""
+    def __init__(self, headers):
+        dict.__init__(self, ((k.lower(), v) for k, v in headers.items()))
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key.lower())
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key.lower())
+
+    def get(self, key, default=None):
+        return dict.get(self, key.lower(), default)
+
+class TogglReplayResponse(object):
+    """Stands in for a requests response when replaying a cassette."""
+    def __init__(self, exchange):
+        self.url = exchange.request_url
+        self.status_code = exchange.status
+        self.headers = TogglReplayHeaders(exchange.headers)
+        self.content = (exchange.response_data or '').encode('utf-8', 'surrogateescape')
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.exceptions.HTTPError("%d Error for url: %s" % \
+                    (self.status_code, self.url), response=self)
+
+    def close(self):
+        pass
+
+class TogglReplayError(Exception):
+    pass
+
+class TogglCassette(object):
+    """Records every request a TogglApi sends, with its response and timing,
+    to a JSONL file, or answers the requests from such a file instead of
+    the network.
+
+    A replayed request gets the first unused response recorded for the same
+    method, URL and body; failing that, for the same method and URL path, so
+    that ranges computed from the current time still replay."""
+    def __init__(self, path, mode='record', delays=False):
+        if mode not in ('record', 'replay'):
+            raise ValueError("Unknown cassette mode %s" % mode)
+        self.path = path
+        self.mode = mode
+        self.delays = delays
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._file = None
+        self._exchanges = []
+        self._used = []
+        if mode == 'record':
+            self._file = open(path, 'w')
+            self._write({'cassette': CASSETTE_VERSION, 'recorded': self._started})
+        else:
+            self._load()
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def __len__(self):
+        return len(self._exchanges)
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('cassette') != CASSETTE_VERSION:
+                raise ValueError("%s is not a cassette" % self.path)
+            for line in f:
+                if line.strip():
+                    self._exchanges.append(TogglExchange(json.loads(line)))
+        self._used = [False] * len(self._exchanges)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def record(self, method, url, data, headers, r, elapsed):
+        exchange = TogglExchange()
+        exchange.method = method
+        exchange.request_url = url
+        exchange.request_data = data
+        exchange.request_headers = dict(headers or {})
+        exchange.status = r.status_code
+        exchange.headers = dict(r.headers)
+        # Kept as the exact bytes received, whatever their encoding.
+        exchange.response_data = r.content.decode('utf-8', 'surrogateescape')
+        exchange.elapsed = elapsed
+        with self._lock:
+            exchange.at = time.time() - elapsed - self._started
+            self._exchanges.append(exchange)
+            self._write(exchange.to_json())
+
+    def _find(self, method, url, data):
+        path = url.split('?', 1)[0]
+        fallback = None
+        for i, exchange in enumerate(self._exchanges):
+            if self._used[i] or exchange.method != method:
+                continue
+            if exchange.request_url == url and exchange.request_data == data:
+                return i
+            if fallback is None and exchange.request_url.split('?', 1)[0] == path:
+                fallback = i
+        return fallback
+
+    def replay(self, method, url, data):
+        with self._lock:
+            i = self._find(method, url, data)
+            if i is None:
+                raise TogglReplayError("No recorded response for %s %s in %s" % \
+                        (method, url, self.path))
+            self._used[i] = True
+        exchange = self._exchanges[i]
+        if self.delays:
+            time.sleep(exchange.elapsed)
+        return TogglReplayResponse(exchange)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
 class TogglApi:
-    def __init__(self, url, auth, api_version=TOGGL_API_VERSION, verbose=False):
+    def __init__(self, url, auth, api_version=TOGGL_API_VERSION, verbose=False,
+            pool_connections=DEFAULT_POOL_CONNECTIONS,
+            pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_block=False,
+            keep_alive=True, entry_store=None, fetch_window=DEFAULT_FETCH_WINDOW,
+            fetch_parallel=DEFAULT_FETCH_PARALLEL, rate_limit=DEFAULT_RATE_LIMIT,
+            rate_burst=DEFAULT_RATE_BURST, max_retries=DEFAULT_MAX_RETRIES,
+            cassette=None):
         self.base_url = '%s/%s' % (url, api_version)
         self.auth = auth
         self.verbose = verbose
         self.headers = {'content-type': 'application/json'}
+        self.entry_store = entry_store
+        self.fetch_window = fetch_window
+        self.fetch_parallel = fetch_parallel
+        self.max_retries = max_retries
+        self.cassette = cassette
+        self._limiter = None
+        if rate_limit:
+            self._limiter = TogglRateLimiter(rate_limit, rate_burst)
+        self._num_requests = 0
+        self._num_throttled = 0
+        self._num_retried = 0
+        self._pool_args = {
+            'pool_connections': pool_connections,
+            'pool_maxsize': pool_maxsize,
+            'pool_block': pool_block,
+        }
+        self._keep_alive = keep_alive
+        self._session = None
+        # Requests are sent from several threads at once (parallel fetches,
+        # imports and updates); this guards the session and the counters.
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The shared HTTP session, created on first use."""
+        if self._session is not None:
+            return self._session
+        with self._lock:
+            if self._session is not None:
+                return self._session
+            # requests is by far the most expensive import, so only pay for
+            # it once a command actually talks to the server.
+            import requests
+            import requests.adapters
+
+            # All endpoints share one session so that connections to the API
+            # host are kept alive and reused instead of paying a new TCP/TLS
+            # handshake for every call.
+            session = requests.Session()
+            session.auth = self.auth
+            adapter = requests.adapters.HTTPAdapter(**self._pool_args)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            if not self._keep_alive:
+                session.headers['Connection'] = 'close'
+            self._session = session
+            return session
+
+    def _request(self, method, url, data=None, headers=None):
+        """Sends a request through the shared connection pool, keeping to
+        the rate limit and retrying throttled or failed requests."""
+        if data is not None and headers is None:
+            headers = self.headers
+
+        attempt = 0
+        while True:
+            self._throttle()
+            with self._lock:
+                self._num_requests += 1
+            r = self._send(method, url, data, headers)
+            delay = self._retry_delay(method, r, attempt)
+            if delay is None:
+                return r
+
+            attempt += 1
+            with self._lock:
+                self._num_retried += 1
+            if self.verbose:
+                print("HTTP %d, retrying in %.1fs" % (r.status_code, delay))
+            r.close()
+            time.sleep(delay)
+
+    def _send(self, method, url, data, headers):
+        cassette = self.cassette
+        if cassette is not None and cassette.replaying:
+            return cassette.replay(method, url, data)
+        started = time.time()
+        r = self.session.request(method, url, data=data, headers=headers)
+        if cassette is not None:
+            cassette.record(method, url, data, headers, r, time.time() - started)
+        return r
+
+    def _throttle(self):
+        # A replay does not wait on the rate limit; the cassette reproduces
+        # the recorded timing itself when asked to.
+        if self._limiter is None or (self.cassette is not None and self.cassette.replaying):
+            return
+        wait = self._limiter.reserve()
+        if wait > 0:
+            with self._lock:
+                self._num_throttled += 1
+            time.sleep(wait)
+
+    def concurrency(self, requested):
+        """Returns how many requests are worth sending at once. Under a
+        rate limit that is at most its burst; more workers would only wait
+        for it."""
+        if self._limiter is None or (self.cassette is not None and self.cassette.replaying):
+            return max(requested, 1)
+        return max(min(requested, self._limiter.burst), 1)
+
+    def _retry_delay(self, method, r, attempt):
+        """Returns how long to wait before retrying the request, or None if
+        the response should be returned as is."""
+        if r.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+            return None
+        # A POST that failed on the server may still have been applied, so
+        # only retry it when it was turned away by the rate limit.
+        if r.status_code != 429 and method == 'POST':
+            return None
+
+        delay = parse_retry_after(r.headers.get('Retry-After'))
+        if delay is not None:
+            if delay > RETRY_AFTER_MAX:
+                return None
+            if self._limiter is not None:
+                self._limiter.pause(delay)
+            return delay
+
+        import random
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    def connection_stats(self):
+        """Returns the number of requests sent and connections opened."""
+        connections = 0
+        adapters = self._session.adapters.values() if self._session else []
+        for adapter in set(adapters):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+
+        return {
+            'requests': self._num_requests,
+            'connections': connections,
+            'reused': max(self._num_requests - connections, 0),
+            'throttled': self._num_throttled,
+            'retried': self._num_retried,
+        }
+
+    def close(self):
+        """Closes all pooled connections."""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
     def _raise_if_error(self, r):
         if r.status_code != 200:
             print("Error reason: " + r.text)
         r.raise_for_status()
 
-    def get_projects(self, raw_data=None):
-        """Fetches the projects as JSON objects."""
-        
-        if raw_data is None or raw_data.response_data is None:
-            url = "%s/projects.json" % self.base_url
-            if self.verbose:
-                print(url)
-            r = requests.get(url, auth=self.auth)
-            self._raise_if_error(r)
+    def _get_text(self, url, raw_data=None):
+        """GETs url, or returns the response already held by raw_data.
+        Fresh responses are recorded in raw_data along with their
+        validators."""
+        if raw_data is not None and raw_data.response_data is not None:
+            return raw_data.response_data
 
-            if self.verbose:
-                print(r.text)
-            from_text = r.text
+        if self.verbose:
+            print(url)
+        r = self._request('GET', url)
+        self._raise_if_error(r)
 
-            if raw_data is not None:
-                raw_data.request_url = url
-                raw_data.response_data = from_text
-        else:
-            from_text = raw_data.response_data
+        if raw_data is not None:
+            raw_data.request_url = url
+            raw_data.response_data = r.text
+            raw_data.validators = response_validators(r)
+        return r.text
+
+    def revalidate(self, raw_data):
+        """Asks the server whether the response to raw_data.request_url has
+        changed since it was described by raw_data.validators. Returns True
+        if it has not; otherwise the new response and its validators are
+        stored in raw_data."""
+        old = raw_data.validators or {}
+        headers = {}
+        if old.get('etag'):
+            headers['If-None-Match'] = old['etag']
+        if old.get('last_modified'):
+            headers['If-Modified-Since'] = old['last_modified']
+
+        if self.verbose:
+            print("%s (conditional)" % raw_data.request_url)
+        r = self._request('GET', raw_data.request_url, headers=headers)
+        if r.status_code == 304:
+            raw_data.not_modified = True
+            return True
+        self._raise_if_error(r)
+
+        # Without server validators, fall back to comparing the content.
+        validators = response_validators(r)
+        if old.get('hash') == validators['hash']:
+            raw_data.not_modified = True
+            return True
+
+        raw_data.response_data = r.text
+        raw_data.validators = validators
+        return False
+
+    def get_projects(self, raw_data=None):
+        """Fetches the projects as JSON objects."""
+        from_text = self._get_text("%s/projects.json" % self.base_url, raw_data)
 
         if (self.verbose):
             print(from_text)
 
         return [TogglProject(p) for p in json.loads(from_text)['data']]
 
+    def get_workspace_projects(self, wsp_id, raw_data=None):
+        """Fetches the projects of a single workspace."""
+        from_text = self._get_text("%s/workspaces/%s/projects.json" % \
+                (self.base_url, url_quote(str(wsp_id))), raw_data)
+
+        if self.verbose:
+            print(from_text)
+
+        return [TogglProject(p) for p in json.loads(from_text)['data'] or []]
+
     def add_project(self, proj):
         """Adds the given project as a new project."""
 
@@ -109,8 +702,7 @@ class TogglApi:
         if self.verbose:
             print(url)
             print(data)
-        r = requests.post(url, auth=self.auth,
-            data=json.dumps(data), headers=self.headers)
+        r = self._request('POST', url, data=json.dumps(data))
         self._raise_if_error(r)
         
         if self.verbose:
@@ -127,8 +719,7 @@ class TogglApi:
         if self.verbose:
             print(url)
             print(data)
-        r = requests.put(url, auth=self.auth,
-            data=json.dumps(data), headers=self.headers)
+        r = self._request('PUT', url, data=json.dumps(data))
         self._raise_if_error(r)
         
         if self.verbose:
@@ -145,8 +736,7 @@ class TogglApi:
         if self.verbose:
             print(url)
             print(data)
-        r = requests.put(url, auth=self.auth,
-            data=json.dumps(data), headers=self.headers)
+        r = self._request('PUT', url, data=json.dumps(data))
         self._raise_if_error(r)
         
         if self.verbose:
@@ -163,8 +753,7 @@ class TogglApi:
         if self.verbose:
             print(url)
             print(data)
-        r = requests.put(url, auth=self.auth,
-            data=json.dumps(data), headers=self.headers)
+        r = self._request('PUT', url, data=json.dumps(data))
         self._raise_if_error(r)
         
         if self.verbose:
@@ -172,9 +761,52 @@ class TogglApi:
 
         return TogglResponse(True, json.loads(r.text))
 
-    def get_time_entries(self, start=None, end=None):
+    def get_time_entries(self, start=None, end=None, refresh=False):
         """Get the list of entries for the specified time range,
         or the latest entries if no dates specified"""
+        if start is None or end is None:
+            return self._fetch_time_entries()
+
+        if self.entry_store is not None:
+            return self._get_stored_time_entries(start, end, refresh)
+
+        if self.fetch_window is None:
+            return self._fetch_time_entries(start, end)
+
+        return self._fetch_range(timestamp_to_epoch(end), timestamp_to_epoch(start))
+
+    def _fetch_range(self, low, high):
+        """Fetches the entries starting between the epochs low and high. Long
+        ranges are split into fetch_window sized windows which are fetched
+        concurrently, then merged in order without duplicates."""
+        windows = [(low, high)]
+        if self.fetch_window is not None:
+            windows = plan_windows(low, high, self.fetch_window)
+
+        def fetch(window):
+            return self._fetch_time_entries(epoch_to_datetime(window[1]),
+                    epoch_to_datetime(window[0]))
+
+        if len(windows) == 1 or self.fetch_parallel <= 1:
+            results = [fetch(w) for w in windows]
+        else:
+            import concurrent.futures
+            workers = min(self.concurrency(self.fetch_parallel), len(windows))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(fetch, windows))
+
+        # Windows share their boundaries, so an entry starting exactly on
+        # one is returned twice.
+        entries = []
+        seen = set()
+        for result in results:
+            for entry in result:
+                if entry.id not in seen:
+                    seen.add(entry.id)
+                    entries.append(entry)
+        return entries
+
+    def _fetch_time_entries(self, start=None, end=None):
         # Fetch the data or die trying.
         # Toggle has the start/end dates creating a confusing
         # backwards range. Swap them here.
@@ -184,7 +816,7 @@ class TogglApi:
                     (url, url_quote(str(end)), url_quote(str(start)))
         if self.verbose:
             print(url)
-        r = requests.get(url, auth=self.auth)
+        r = self._request('GET', url)
         self._raise_if_error(r)
 
         if self.verbose:
@@ -192,6 +824,27 @@ class TogglApi:
 
         return [TogglEntry(e) for e in json.loads(r.text)['data']]
 
+    def _get_stored_time_entries(self, start, end, refresh=False):
+        """Answers a range query from the entry store, fetching only the
+        ranges the store does not hold yet or that may still change."""
+        # Same backwards range as _fetch_time_entries: end is the earlier date.
+        low = timestamp_to_epoch(end)
+        high = timestamp_to_epoch(start)
+
+        store = self.entry_store
+        for range_low, range_high in store.missing_ranges(low, high, refresh):
+            entries = self._fetch_range(range_low, range_high)
+            store.replace_range(range_low, range_high,
+                    [(e.start_epoch, e.fields) for e in entries])
+        store.extend_coverage(low, high)
+        store.commit()
+
+        return [TogglEntry(e) for e in store.query(low, high)]
+
+    def _store_entry(self, fields):
+        if self.entry_store is not None and fields and fields.get(KEY_START):
+            self.entry_store.upsert(timestamp_to_epoch(fields[KEY_START]), fields)
+
     def get_time_entry(self, entry_id):
         """Find the entry with the specified id"""
         # Fetch the data or die trying.
@@ -201,7 +854,7 @@ class TogglApi:
             (self.base_url, url_quote(entry_id))
         if self.verbose:
             print(url)
-        r = requests.get(url, auth=self.auth)
+        r = self._request('GET', url)
         if r.status_code == 404:
             return None 
         self._raise_if_error(r)
@@ -209,26 +862,35 @@ class TogglApi:
         if self.verbose:
             print(r.text)
 
-        return TogglEntry(json.loads(r.text)['data'])
+        fields = json.loads(r.text)['data']
+        self._store_entry(fields)
+        return TogglEntry(fields)
 
-    def add_time_entry(self, entry):
-        """Add the given entry as a new time entry"""
+    def add_time_entry(self, entry, idempotency_key=None):
+        """Add the given entry as a new time entry. A server that supports
+        idempotency keys creates only one entry per key however often the
+        request is repeated."""
 
         url = "%s/time_entries.json" % self.base_url
         data = { KEY_TIMEENTRY : entry.to_json() }
+        headers = None
+        if idempotency_key is not None:
+            headers = dict(self.headers)
+            headers['Idempotency-Key'] = idempotency_key
 
         if self.verbose:
             print(url)
             print(data)
 
-        r = requests.post(url, auth=self.auth,
-            data=json.dumps(data), headers=self.headers)
+        r = self._request('POST', url, data=json.dumps(data), headers=headers)
         self._raise_if_error(r)
         
         if self.verbose:
             print(r.text)
 
-        return TogglResponse(True, json.loads(r.text))
+        resp = TogglResponse(True, json.loads(r.text))
+        self._store_entry(resp.data)
+        return resp
 
     def update_time_entry(self, entry):
         """Update the given time entry"""
@@ -239,7 +901,7 @@ class TogglApi:
             print(url)
             print(data)
 
-        r = requests.put(url, auth=self.auth, data=json.dumps(data), headers=self.headers)
+        r = self._request('PUT', url, data=json.dumps(data))
         if r.status_code == 404:
             return TogglResponse(False)
         self._raise_if_error(r)
@@ -247,14 +909,16 @@ class TogglApi:
         if self.verbose:
             print(r.text)
 
-        return TogglResponse(True, json.loads(r.text))
+        resp = TogglResponse(True, json.loads(r.text))
+        self._store_entry(resp.data)
+        return resp
 
     def delete_time_entry(self, entry_id):
         """Delete the time entry with the specified id"""
-        url = "%s/time_entries/%s.json" % (self.base_url, url_quote(entry_id))
+        url = "%s/time_entries/%s.json" % (self.base_url, url_quote(str(entry_id)))
         if self.verbose:
             print(url)
-        r = requests.delete(url, auth=self.auth, data=None, headers=self.headers)
+        r = self._request('DELETE', url)
         if r.status_code == 404:
             return TogglResponse(False)
         self._raise_if_error(r)
@@ -262,65 +926,49 @@ class TogglApi:
         if self.verbose:
             print(r.text)
 
+        if self.entry_store is not None:
+            self.entry_store.delete(entry_id)
+
         return TogglResponse(True, json.loads(r.text))
 
     def get_workspaces(self, raw_data=None):
         """Get the list of workspaces."""
 
-        if raw_data is None or raw_data.response_data is None:
-            url = "%s/workspaces.json" % self.base_url
-            if self.verbose:
-                print(url)
-            r = requests.get(url, auth=self.auth)
-            self._raise_if_error(r)
-            
-            from_text = r.text
-
-            if raw_data is not None:
-                raw_data.request_url = url
-                raw_data.response_data = from_text
-        else:
-            from_text = raw_data.response_data
+        from_text = self._get_text("%s/workspaces.json" % self.base_url, raw_data)
 
         if self.verbose:
             print(from_text)
 
         return [TogglWorkspace(w) for w in json.loads(from_text)['data']]
 
-    def get_workspace_users(self, wsp_id):
+    def get_workspace_users(self, wsp_id, raw_data=None):
         """Get the user list for the specified workspace."""
-        url = "%s/workspaces/%s/users.json" % (self.base_url, wsp_id)
-        if self.verbose:
-            print(url)
-        r = requests.get(url, auth=self.auth)
-        self._raise_if_error(r)
+        from_text = self._get_text("%s/workspaces/%s/users.json" % \
+                (self.base_url, url_quote(str(wsp_id))), raw_data)
 
         if self.verbose:
-            print(r.text)
+            print(from_text)
 
-        return [TogglUser(u) for u in json.loads(r.text)['data']]
+        return [TogglUser(u) for u in json.loads(from_text)['data'] or []]
 
     def get_clients(self, raw_data=None):
         """Get list of clients."""
-        if raw_data is None or raw_data.response_data is None:
-            url = "%s/clients.json" % (self.base_url)
-            if self.verbose:
-                print(url)
-            r = requests.get(url, auth=self.auth)
-            self._raise_if_error(r)
+        from_text = self._get_text("%s/clients.json" % self.base_url, raw_data)
 
-            from_text = r.text
+        if self.verbose:
+            print(from_text)
 
-            if raw_data is not None:
-                raw_data.request_url = url
-                raw_data.response_data = from_text
-        else:
-            from_text = raw_data.response_data
+        return [TogglClient(c) for c in json.loads(from_text)['data']]
+
+    def get_workspace_clients(self, wsp_id, raw_data=None):
+        """Get the clients of a single workspace."""
+        from_text = self._get_text("%s/workspaces/%s/clients.json" % \
+                (self.base_url, url_quote(str(wsp_id))), raw_data)
 
         if self.verbose:
             print(from_text)
 
-        return [TogglClient(c) for c in json.loads(from_text)['data']]
+        return [TogglClient(c) for c in json.loads(from_text)['data'] or []]
 
     def add_client(self, cl):
         """Add a new client entry."""
@@ -331,8 +979,7 @@ class TogglApi:
             print(url)
             print(data)
 
-        r = requests.post(url, auth=self.auth,
-            data=json.dumps(data), headers=self.headers)
+        r = self._request('POST', url, data=json.dumps(data))
         self._raise_if_error(r)
 
         if self.verbose:
@@ -349,7 +996,7 @@ class TogglApi:
             print(url)
             print(data)
 
-        r = requests.put(url, auth=self.auth, data=json.dumps(data), headers=self.headers)
+        r = self._request('PUT', url, data=json.dumps(data))
         if r.status_code == 404:
             return TogglResponse(False)
         self._raise_if_error(r)
@@ -364,7 +1011,7 @@ class TogglApi:
         url = "%s/clients/%d.json" % (self.base_url, int(client_id))
         if self.verbose:
             print(url)
-        r = requests.delete(url, auth=self.auth, data=None, headers=self.headers)
+        r = self._request('DELETE', url)
         if r.status_code == 404:
             return TogglResponse(False)
         self._raise_if_error(r)
@@ -374,20 +1021,15 @@ class TogglApi:
 
         return TogglResponse(True, json.loads(r.text))
 
-    def get_tasks(self, active=True):
-        """Get the list of tasks"""
-        url = "%s/tasks.json?active=%s" % (self.base_url, active)
-        if self.verbose:
-            print(url)
-        r = requests.get(url, auth=self.auth)
-        self._raise_if_error(r)
-
-        from_text = r.text
+    def get_tasks(self, active=True, raw_data=None):
+        """Get the list of tasks. active may also be 'both' to get active
+        and inactive tasks alike."""
+        from_text = self._get_text("%s/tasks.json?active=%s" % (self.base_url, active), raw_data)
 
         if self.verbose:
             print(from_text)
 
-        return [TogglTask(t) for t in json.loads(from_text)['data']]
+        return [TogglTask(t) for t in json.loads(from_text)['data'] or []]
 
     def add_task(self, task):
         """Add a new client entry."""
@@ -398,8 +1040,26 @@ class TogglApi:
             print(url)
             print(data)
 
-        r = requests.post(url, auth=self.auth,
-            data=json.dumps(data), headers=self.headers)
+        r = self._request('POST', url, data=json.dumps(data))
+        self._raise_if_error(r)
+
+        if self.verbose:
+            print(r.text)
+
+        return TogglResponse(True, json.loads(r.text))
+
+    def update_task(self, task):
+        """Update an existing task entry."""
+        url = "%s/tasks/%d.json" % (self.base_url, int(task.id))
+        data = { KEY_TASK: task.to_json() }
+
+        if self.verbose:
+            print(url)
+            print(data)
+
+        r = self._request('PUT', url, data=json.dumps(data))
+        if r.status_code == 404:
+            return TogglResponse(False)
         self._raise_if_error(r)
 
         if self.verbose:
@@ -413,7 +1073,7 @@ class TogglApi:
 
         if self.verbose:
             print(url)
-        r = requests.delete(url, auth=self.auth, data=None, headers=self.headers)
+        r = self._request('DELETE', url)
         if r.status_code == 404:
             return TogglResponse(False)
         self._raise_if_error(r)
@@ -423,6 +1083,48 @@ class TogglApi:
 
         return TogglResponse(True, json.loads(r.text))
 
+class TogglIndex(object):
+    """Lookup structure over a list of TogglObjects.
+
+    find() accepts either an id or a unique prefix of the name, just like
+    the find_* helpers of the command line tool. Ids are looked up in a
+    dict and name prefixes by binary search over the sorted names, so both
+    stay fast for tens of thousands of items."""
+    def __init__(self, items):
+        self._items = list(items)
+        self._by_id = dict((str(item.id), item) for item in self._items)
+        order = sorted(range(len(self._items)), key=lambda i: self._items[i].name or '')
+        self._names = [self._items[i].name or '' for i in order]
+        self._name_pos = order
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def items(self):
+        return self._items
+
+    def get(self, item_id):
+        return self._by_id.get(str(item_id))
+
+    def find(self, key):
+        item = self._by_id.get(key)
+        if item is not None:
+            return item
+
+        # Names starting with key are adjacent in sorted order; of those,
+        # return the one listed first, as a linear scan would.
+        first = None
+        i = bisect.bisect_left(self._names, key)
+        while i < len(self._names) and self._names[i].startswith(key):
+            if first is None or self._name_pos[i] < first:
+                first = self._name_pos[i]
+            i += 1
+        return self._items[first] if first is not None else None
+
 class TogglResponse:
     def __init__(self, success, data=None):
         self._success = success
@@ -460,11 +1162,16 @@ class TogglObject(object):
 class TogglTask(TogglObject):
     def __init__(self, fields=None):
         TogglObject.__init__(self, fields)
+        self._workspace = None
+        self._project = None
+        self._user = None
         if fields is not None:
-            if KEY_WORKSPACE in fields:
+            if fields.get(KEY_WORKSPACE):
                 self._workspace = TogglWorkspace(fields[KEY_WORKSPACE])
-            else:
-                self._workspace = None
+            if fields.get(KEY_PROJECT):
+                self._project = TogglProject(fields[KEY_PROJECT])
+            if fields.get(KEY_USER):
+                self._user = TogglUser(fields[KEY_USER])
 
     @property
     def workspace(self):
@@ -689,6 +1396,8 @@ class TogglProject(TogglObject):
 
 class TogglEntry(object):
     def __init__(self, fields=None):
+        self._start = None
+        self._stop = None
         if fields is not None:
             self.fields = fields
             if KEY_PROJECT in fields:
@@ -747,14 +1456,49 @@ class TogglEntry(object):
     @start_time.setter
     def start_time(self, value):
         self.fields[KEY_START] = value
+        self._start = None
 
     @property
     def stop_time(self):
-        return self.fields[KEY_STOP]
+        return self.fields.get(KEY_STOP)
 
     @stop_time.setter
     def stop_time(self, value):
         self.fields[KEY_STOP] = value
+        self._stop = None
+
+    def _parse_time(self, key):
+        value = self.fields.get(key)
+        if not value:
+            return (None, None)
+        epoch = timestamp_to_epoch(value)
+        return (epoch, epoch_to_datetime(epoch))
+
+    # The start and stop timestamps are parsed at most once per entry and
+    # kept as (epoch, datetime) pairs until the underlying field is set.
+    @property
+    def start_epoch(self):
+        if self._start is None:
+            self._start = self._parse_time(KEY_START)
+        return self._start[0]
+
+    @property
+    def start_datetime(self):
+        if self._start is None:
+            self._start = self._parse_time(KEY_START)
+        return self._start[1]
+
+    @property
+    def stop_epoch(self):
+        if self._stop is None:
+            self._stop = self._parse_time(KEY_STOP)
+        return self._stop[0]
+
+    @property
+    def stop_datetime(self):
+        if self._stop is None:
+            self._stop = self._parse_time(KEY_STOP)
+        return self._stop[1]
 
     @property
     def duration(self):
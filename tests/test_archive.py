@@ -0,0 +1,37 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from togglarchive import TogglArchive, TogglArchiveWriter
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='toggltest.')
+        self.path = os.path.join(self.dir, 'entries.archive')
+        writer = TogglArchiveWriter()
+        for i in range(100):
+            writer.add(i * 3600, i * 3600 + 1800, 1800, 'Entry %d' % (i % 7), i % 3 or None, 'Project')
+        writer.write(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_roundtrip(self):
+        with TogglArchive(self.path) as archive:
+            self.assertEqual(len(archive), 100)
+            self.assertEqual(archive.string(archive.desc[8]), 'Entry 1')
+            self.assertEqual(archive.project_name(1), 'Project')
+
+    def test_truncated_archive_is_rejected(self):
+        size = os.path.getsize(self.path)
+        for length in (size - 1, size // 2, 40, 29, 24 + 800 * 4 + 3):
+            with open(self.path, 'r+b') as f:
+                f.truncate(length)
+            self.assertRaises(ValueError, TogglArchive, self.path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import toggl
+from togglstore import TogglEntryStore
+
+class CacheBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='toggltest.')
+        self.cache = toggl.TogglCache(self.path, True, max_mb=0.1)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def write(self, name, size):
+        with open(os.path.join(self.path, name), 'wb') as f:
+            f.write(b'x' * size)
+
+    def test_entry_store_does_not_evict_resource_caches(self):
+        # The entry history alone is well over the budget.
+        self.write('entries.db', 1024 * 1024)
+        self.write('entries.archive', 512 * 1024)
+        for name in ('projects.1', 'clients.1', 'workspaces'):
+            self.write(name + '.cache', 1024)
+            self.cache.record_use(name, True)
+        self.cache.flush_stats()
+
+        self.assertEqual(self.cache.cache_names(), ['clients.1', 'projects.1', 'workspaces'])
+        self.assertEqual(self.cache.evictable_usage(), 3 * 1024)
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'entries.db')))
+
+    def test_entry_store_gives_up_its_oldest_entries(self):
+        store = TogglEntryStore(os.path.join(self.path, 'entries.db'))
+        day = 24 * 3600
+        entries = [(i * day, {'id': i + 1, 'start': '', 'description': 'x' * 200})
+                for i in range(2000)]
+        store.replace_range(0, 2000 * day, entries)
+        store.extend_coverage(0, 2000 * day)
+        store.commit()
+        for name in ('projects.1', 'workspaces'):
+            self.write(name + '.cache', 1024)
+            self.cache.record_use(name, True)
+        self.assertGreater(store.size(), self.cache.max_bytes)
+
+        self.cache.flush_stats(store)
+
+        self.assertLessEqual(self.cache.budget_usage(store), self.cache.max_bytes)
+        self.assertEqual(self.cache.cache_names(), ['projects.1', 'workspaces'])
+        low, high = store.coverage()
+        self.assertEqual(high, 2000 * day)
+        self.assertEqual(store.query(0, low - 1), [])
+        self.assertEqual(store.query(1999 * day, high)[0]['id'], 2000)
+        # Everything from the new start of the range is still there.
+        self.assertEqual(len(store.query(low, high)), (high - low) // day)
+        store.close()
+
+    def test_evicts_least_recently_used_over_budget(self):
+        self.write('old.cache', 80 * 1024)
+        self.cache.record_use('old', True)
+        self.cache.flush_stats()
+        self.write('new.cache', 80 * 1024)
+        self.cache.record_use('new', True)
+        self.cache.flush_stats()
+
+        self.assertEqual(self.cache.cache_names(), ['new'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import toggl
+
+@unittest.skipIf(shutil.which('bash') is None, "bash is not installed")
+class BashCompletionTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='toggltest.')
+        self.saved = getattr(toggl, 'toggl_cache', None)
+        toggl.toggl_cache = toggl.TogglCache(self.path, True)
+        with open(toggl.names_index_file(), 'w') as f:
+            f.write("p\tProject 00001\np\tProject 00002\np\tOther Project\n")
+        self.script = os.path.join(self.path, 'toggl.bash')
+        with open(self.script, 'w') as f:
+            f.write(toggl.completion_script('bash'))
+
+    def tearDown(self):
+        toggl.toggl_cache = self.saved
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def complete(self, *words):
+        """Returns the candidates bash offers for the last word."""
+        line = ' '.join(words)
+        proc = subprocess.run(['bash', '-c',
+                'source "$1"; shift; COMP_WORDS=("$@"); COMP_CWORD=$(($# - 1)); '
+                '_toggl_complete; printf "%s\\n" "${COMPREPLY[@]}"',
+                'bash', self.script] + list(words), stdout=subprocess.PIPE, check=True)
+        return [c for c in proc.stdout.decode('utf-8').split('\n') if c]
+
+    def test_first_tab(self):
+        self.assertEqual(self.complete('toggl', 'start', '-p', 'Proj'),
+                ['Project\\ 00001', 'Project\\ 00002'])
+
+    def test_escaped_prefix(self):
+        self.assertEqual(self.complete('toggl', 'start', '-p', 'Project\\ 000'),
+                ['Project\\ 00001', 'Project\\ 00002'])
+
+    def test_quoted_prefix(self):
+        self.assertEqual(self.complete('toggl', 'start', '-p', "'Other P"),
+                ['Other\\ Project'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import toggl
+from libtoggl import TogglEntry, TogglResponse, KEY_ID, KEY_DESC, KEY_START, KEY_DURATION
+
+class FakeApi(object):
+    """Answers like a server that applied an add but lost its response:
+    the entry is there, with its start time cut to whole seconds."""
+    entry_store = None
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.added = []
+
+    def get_time_entries(self, start, end, refresh=False):
+        return [e for e in self.entries
+                if end.timestamp() <= e.start_epoch <= start.timestamp()]
+
+    def add_time_entry(self, entry, idempotency_key=None):
+        self.added.append(entry)
+        raise AssertionError("the add was sent again")
+
+class ServerError(Exception):
+    def __init__(self, status):
+        Exception.__init__(self, "HTTP %d" % status)
+        self.response = type('Response', (object,), {'status_code': status})()
+
+class FakeServer(object):
+    """Keeps entries by id; fail_next makes the next update or delete
+    fail with that HTTP status."""
+    entry_store = None
+
+    def __init__(self):
+        self.entries = {}
+        self.next_id = 1000
+        self.fail_next = None
+
+    def get_time_entries(self, start, end, refresh=False):
+        return []
+
+    def add_time_entry(self, entry, idempotency_key=None):
+        fields = dict(entry.fields)
+        fields[KEY_ID] = self.next_id
+        self.next_id += 1
+        self.entries[fields[KEY_ID]] = fields
+        return TogglResponse(True, {'data': fields})
+
+    def _check(self):
+        status, self.fail_next = self.fail_next, None
+        if status is not None:
+            raise ServerError(status)
+
+    def update_time_entry(self, entry):
+        self._check()
+        if entry.id not in self.entries:
+            return TogglResponse(False)
+        self.entries[entry.id].update(entry.fields)
+        return TogglResponse(True, {'data': self.entries[entry.id]})
+
+    def delete_time_entry(self, entry_id):
+        self._check()
+        if self.entries.pop(entry_id, None) is None:
+            return TogglResponse(False)
+        return TogglResponse(True)
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='toggltest.')
+        self.saved = [getattr(toggl, name, None) for name in ('toggl_cache', 'toggl_journal', 'toggl')]
+        toggl.toggl_cache = toggl.TogglCache(self.path, True)
+        toggl.toggl_journal = toggl.TogglJournal(os.path.join(self.path, 'journal.jsonl'))
+
+    def tearDown(self):
+        toggl.toggl_cache, toggl.toggl_journal, toggl.toggl = self.saved
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def queue_add(self, desc):
+        return toggl.toggl_journal.append('add', fields={KEY_DESC: desc,
+                KEY_START: '2024-03-01T09:00:00', KEY_DURATION: -1})
+
+    def test_update_after_compaction_uses_added_id(self):
+        server = FakeServer()
+        toggl.toggl = server
+        add = self.queue_add('Offline')
+        toggl.toggl_journal.append('update', add['key'],
+                {KEY_DESC: 'Renamed', KEY_START: '2024-03-01T09:00:00', KEY_DURATION: 60})
+
+        # The add goes through, the update does not; the journal is
+        # compacted down to the update and the add's id.
+        server.fail_next = 503
+        self.assertRaises(ServerError, toggl.sync_journal)
+        pending, ids, attempted = toggl.toggl_journal.read()
+        self.assertEqual([c['op'] for c in pending], ['update'])
+
+        self.assertEqual(toggl.sync_journal(), (1, 0))
+        self.assertEqual(server.entries[1000][KEY_DESC], 'Renamed')
+        self.assertFalse(toggl.toggl_journal.has_pending())
+
+    def test_delete_after_compaction_uses_added_id(self):
+        server = FakeServer()
+        toggl.toggl = server
+        add = self.queue_add('Offline')
+        toggl.toggl_journal.append('delete', add['key'])
+
+        server.fail_next = 503
+        self.assertRaises(ServerError, toggl.sync_journal)
+        self.assertEqual(toggl.sync_journal(), (1, 0))
+        self.assertEqual(server.entries, {})
+
+    def test_change_to_missing_entry_is_dropped(self):
+        server = FakeServer()
+        toggl.toggl = server
+        toggl.toggl_journal.append('update', 4242,
+                {KEY_DESC: 'Gone', KEY_START: '2024-03-01T09:00:00', KEY_DURATION: 60})
+        toggl.toggl_journal.append('delete', 4243)
+
+        self.assertEqual(toggl.sync_journal(), (0, 2))
+        self.assertFalse(toggl.toggl_journal.has_pending())
+
+    def test_retried_add_finds_sent_entry(self):
+        fields = {KEY_DESC: 'Writing', KEY_START: '2024-03-01T09:15:42.637281',
+                KEY_DURATION: -1}
+        sent = TogglEntry({KEY_ID: 1234, KEY_DESC: 'Writing',
+                KEY_START: '2024-03-01T09:15:42+00:00', KEY_DURATION: -1})
+        api = FakeApi([sent])
+        toggl.toggl = api
+
+        change = toggl.toggl_journal.append('add', fields=fields)
+        toggl.toggl_journal.attempt(change['key'])
+        pending, ids, attempted = toggl.toggl_journal.read()
+
+        self.assertEqual(toggl.send_journal_change(pending[0], ids, True), 1234)
+        self.assertEqual(api.added, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOGGL = os.path.join(HERE, '..', 'toggl.py')
+SERVER = os.path.join(HERE, '..', 'togglserver.py')
+
+TOGGLRC = """[auth]
+username = test@example.com
+password = test
+
+[options]
+api_url = %s
+timezone = UTC
+ignore_start_times = False
+cache_enabled = True
+rate_limit = 0
+"""
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix='toggltest.')
+        self.server = subprocess.Popen([sys.executable, SERVER, '-p', '0',
+                '--entries', '100', '--projects', '5', '--seed', '1'],
+                stdout=subprocess.PIPE)
+        line = self.server.stdout.readline().decode('utf-8').strip()
+        with open(os.path.join(self.home, '.togglrc'), 'w') as f:
+            f.write(TOGGLRC % line[len('Listening on '):])
+
+    def tearDown(self):
+        if self.server.poll() is None:
+            self.server.terminate()
+        self.server.wait()
+        self.server.stdout.close()
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    def toggl(self, *argv):
+        env = dict(os.environ, HOME=self.home, TOGGL_NO_DAEMON='1')
+        return subprocess.run([sys.executable, TOGGL] + list(argv), env=env,
+                cwd=self.home, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def cache_contents(self):
+        cache = os.path.join(self.home, '.toggl')
+        contents = {}
+        for name in os.listdir(cache):
+            if name.endswith('.lock'):
+                continue
+            with open(os.path.join(cache, name), 'rb') as f:
+                contents[name] = hashlib.sha1(f.read()).hexdigest()
+        return contents
+
+    def test_replay_leaves_cache_untouched(self):
+        cassette = os.path.join(self.home, 'start.cassette')
+        self.assertEqual(self.toggl('--record', cassette, 'start', '-m', 'Replayed').returncode, 0)
+        self.assertEqual(self.toggl('stop').returncode, 0)
+        self.assertEqual(self.toggl('ls').returncode, 0)
+        before = self.cache_contents()
+        self.server.terminate()
+
+        proc = self.toggl('--replay', cassette, 'start', '-m', 'Replayed')
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+        self.assertEqual(self.cache_contents(), before)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 toggl.py
 
@@ -26,35 +26,302 @@ WWW_ADDRESS = "open http://www.toggl.com"
 ### End of Configuration Section                                          ###
 #############################################################################
 
+import sys
+import time
+
+class StartupProfiler(object):
+    """Records the wall time spent in each top-level import and in each
+    startup phase for --startup-profile."""
+    def __init__(self):
+        self.start = time.time()
+        self.imports = []
+        self.phases = []
+        self._last_mark = self.start
+        self._depth = 0
+
+    def install(self):
+        import builtins
+        real_import = builtins.__import__
+
+        def profiled_import(name, *args, **kwargs):
+            if self._depth == 0 and name in sys.modules:
+                return real_import(name, *args, **kwargs)
+            self._depth += 1
+            start = time.time()
+            try:
+                return real_import(name, *args, **kwargs)
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.imports.append((name, time.time() - start))
+
+        builtins.__import__ = profiled_import
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self._last_mark))
+        self._last_mark = now
+
+    def report(self):
+        sys.stderr.write("Imports (ms):\n")
+        for name, secs in sorted(self.imports, key=lambda i: -i[1]):
+            sys.stderr.write("  %-30s %8.1f\n" % (name, secs * 1000))
+        sys.stderr.write("Phases (ms):\n")
+        for phase, secs in self.phases:
+            sys.stderr.write("  %-30s %8.1f\n" % (phase, secs * 1000))
+        sys.stderr.write("  %-30s %8.1f\n" % ("total", (time.time() - self.start) * 1000))
+
+# Commands that always run in the calling process: they open a browser or
+# read local files at length. Commands that keep printing until interrupted
+# (now --watch) are recognized by toggld once it has parsed them; see
+# needs_terminal().
+LOCAL_COMMANDS = ('www', 'import')
+# Seconds to wait for toggld to accept a command and to answer it. A
+# command that timed out may have run, so it is not run again here.
+DAEMON_CONNECT_TIMEOUT = 2
+DAEMON_REPLY_TIMEOUT = 300
+# Global options that take a value, so find_command() has to skip it.
+GLOBAL_VALUE_OPTIONS = ('--record', '--replay')
+
+def find_command(argv):
+    """Returns the sub-command named on the command line, if any."""
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in GLOBAL_VALUE_OPTIONS:
+            skip = True
+        elif not arg.startswith('-'):
+            return arg
+    return None
+
+def daemon_socket_path():
+    import os
+    return os.environ.get('TOGGLD_SOCKET') or os.path.expanduser('~/.toggl/toggld.sock')
+
+def run_in_daemon(argv):
+    """Forwards a command line to a running toggld and prints its output.
+    Returns the exit code, or None if the command has to run here."""
+    import os
+    if os.environ.get('TOGGL_NO_DAEMON'):
+        return None
+    if find_command(argv) in LOCAL_COMMANDS:
+        return None
+    # A cassette records or replays this process's own requests.
+    if [arg for arg in argv if arg.split('=')[0] in GLOBAL_VALUE_OPTIONS]:
+        return None
+
+    path = daemon_socket_path()
+    if not os.path.exists(path):
+        return None
+
+    import json
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(DAEMON_CONNECT_TIMEOUT)
+        sock.connect(path)
+        request = {'argv': argv, 'cwd': os.getcwd()}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+    except (OSError, ValueError):
+        # No daemon listening (e.g. a stale socket); run the command here.
+        sock.close()
+        return None
+
+    try:
+        sock.settimeout(DAEMON_REPLY_TIMEOUT)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        reply = json.loads(b''.join(chunks).decode('utf-8'))
+    except socket.timeout:
+        sys.stderr.write("toggld did not answer; stop it with \"toggld.py stop\" "
+                "or set TOGGL_NO_DAEMON=1.\n")
+        return 1
+    except (OSError, ValueError):
+        # The daemon went away before answering.
+        return None
+    finally:
+        sock.close()
+
+    if reply.get('local'):
+        # Interactive; toggld cannot serve it.
+        return None
+    sys.stdout.write(reply.get('stdout', ''))
+    sys.stderr.write(reply.get('stderr', ''))
+    return reply.get('code', 1)
+
+# The import hook has to be in place before anything else gets imported.
+STARTUP_PROFILER = None
+if '--startup-profile' in sys.argv:
+    STARTUP_PROFILER = StartupProfiler()
+    STARTUP_PROFILER.install()
+elif __name__ == "__main__":
+    # Hand the command to toggld before paying for any imports.
+    DAEMON_EXIT = run_in_daemon(sys.argv[1:])
+    if DAEMON_EXIT is not None:
+        sys.exit(DAEMON_EXIT)
+
 from libtoggl import *
+from togglstore import TogglEntryStore, DEFAULT_STABLE_DAYS
+from togglarchive import TogglArchive, TogglArchiveWriter, NO_PROJECT
+from toggljournal import TogglJournal
 
+import contextlib
 import datetime
 import json
 import os
-import pytz
-import sys
-import time
+import pickle
+import struct
+import tempfile
 import urllib
 import argparse
 import re
-import dateutil.parser as date_parser
+import shutil
+import zlib
+
+import configparser
 
 try:
-    import configparser
-except:
-    import ConfigParser as configparser
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class LazyModule(object):
+    """Stands in for a module that is only imported on first use."""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            __import__(self._name)
+            self._module = sys.modules[self._name]
+        return getattr(self._module, attr)
+
+# Only commands that deal with dates need these.
+pytz = LazyModule('pytz')
+date_parser = LazyModule('dateutil.parser')
+
+if STARTUP_PROFILER:
+    STARTUP_PROFILER.mark('module imports')
 
 TOGGL_URL = "https://www.toggl.com/api"
 DEFAULT_DATEFMT = '%Y-%m-%d (%A)'
 DEFAULT_ENTRY_DATEFMT = '%Y-%m-%d %H:%M%p'
 DEFAULT_CACHE_PATH = '~/.toggl'
+DEFAULT_STATUS_FORMAT = '{desc}{project} {elapsed}'
+DEFAULT_STATUS_IDLE = 'idle'
+DEFAULT_UPDATE_JOBS = 8
+# How long the locally recorded running entry is trusted before "toggl now"
+# checks it with the server again.
+DEFAULT_RUNNING_ENTRY_MAX_AGE_MINS = 10
+
+# Bounds, in seconds, for how often "now --watch" checks the running entry
+# with the server. The interval doubles while nothing changes.
+STATUS_CHECK_MIN = 60
+STATUS_CHECK_MAX = 15 * 60
+
+# Snapshot header: magic, format version, flags, size and mtime of the JSON
+# cache it was built from, payload length, payload CRC32.
+SNAPSHOT_MAGIC = b'TGLS'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<4sHHQdII')
+SNAPSHOT_COMPRESSED = 0x1
+
+# A background cache refresh is not started again within this many seconds
+# of the last one, so several commands run in a row only spawn one.
+REFRESH_CLAIM_SECS = 5 * 60
+
+# Cached resources and the TogglApi method that fetches each of them.
+CACHE_RESOURCES = {
+    'projects': 'get_projects',
+    'workspaces': 'get_workspaces',
+    'clients': 'get_clients',
+    'tasks': 'get_tasks',
+}
+# Extra arguments for the fetch method of a cached resource. Tasks are cached
+# active and inactive alike so that any task can be found locally.
+CACHE_RESOURCE_ARGS = {
+    'tasks': {'active': 'both'},
+}
+# Resources cached as one shard per workspace (named e.g. projects.<id>),
+# and the TogglApi method that fetches a single workspace's shard.
+SHARDED_RESOURCES = {
+    'projects': 'get_workspace_projects',
+    'clients': 'get_workspace_clients',
+    'users': 'get_workspace_users',
+}
+
+# The name index read by the shell completion scripts holds one
+# "kind<TAB>name" line per completable name. Kinds are a letter per cached
+# resource and 'a' for aliases. Recent time entry ids (kind 'i', followed by
+# the entry's description) are kept in an index of their own, as the entry
+# store changes far more often than the resource caches.
+NAMES_INDEX = 'names.idx'
+ENTRIES_INDEX = 'entries.idx'
+NAMES_INDEX_KINDS = {
+    'projects': 'p',
+    'workspaces': 'w',
+    'clients': 'c',
+    'tasks': 't',
+}
+NAMES_INDEX_ENTRIES = 50
+# Option values completed from the name index, as (command, options, kinds).
+COMPLETION_VALUES = [
+    ('add', ['-p', '--proj'], 'pa'),
+    ('edit', ['-p', '--proj'], 'pa'),
+    ('edit', ['-i', '--id'], 'i'),
+    ('start', ['-p', '--proj'], 'pa'),
+    ('rm', ['-i', '--id'], 'i'),
+    ('proj', ['-i', '--id'], 'p'),
+    ('proj', ['-c', '--client'], 'c'),
+    ('proj', ['-w', '--workspace'], 'w'),
+    ('client', ['-i', '--id'], 'c'),
+    ('client', ['-w', '--workspace'], 'w'),
+    ('wksp', ['-i', '--id'], 'w'),
+    ('task', ['-i', '--id'], 't'),
+    ('task', ['-p', '--proj'], 'pa'),
+    ('update', ['-w', '--workspace'], 'w'),
+]
+# Commands that never need the server (as long as the running entry is
+# known locally), so they do not send queued changes first.
+OFFLINE_COMMANDS = ('add', 'edit', 'rm', 'start', 'stop', 'now', 'sync',
+        'completion', 'cache', 'archive', 'www')
 alias_dict = {}
+toggl_tz = None
+refresh_started = False
+toggl_journal = None
+journal_enabled = False
+journal_queued = False
+# The real cache, journal and entry store while a replayed command runs
+# against a copy of them; see use_scratch_cache().
+scratch_cache = None
+# Parsed caches by name, with the stat of the cache file they came from.
+# These let a long-running process (toggld) skip re-reading unchanged
+# caches.
+resource_memo = {}
+# Set by toggld, whose commands cannot keep printing until interrupted.
+in_daemon = False
 
 class TogglCache:
-    def __init__(self, cache_path, cache_enabled, max_age_days=0):
+    def __init__(self, cache_path, cache_enabled, max_age_days=0,
+            snapshots=False, compress=False, refresh_hours=0, shards=True,
+            max_mb=0):
         self._cache_path = os.path.expanduser(cache_path)
         self._enabled = cache_enabled
         self._max_age_days = max_age_days
+        self._refresh_hours = refresh_hours
+        self._shards = shards
+        self._max_bytes = int(max_mb * 1024 * 1024)
+        # Hits and misses of this run, per cache name; see flush_stats().
+        self._usage = {}
+        self._snapshots = snapshots
+        self._compress = compress
 
         if not os.path.exists(self._cache_path):
             os.makedirs(self._cache_path)
@@ -63,50 +330,348 @@ class TogglCache:
     def enabled(self):
         return self._enabled
 
+    @property
+    def cache_path(self):
+        return self._cache_path
+
+    @property
+    def shards(self):
+        return self._shards
+
+    def cache_file(self, name):
+        return "%s/%s.cache" % (self._cache_path, name)
+
+    def snapshot_file(self, name):
+        return "%s/%s.snap" % (self._cache_path, name)
+
+    def meta_file(self, name):
+        return "%s/%s.meta" % (self._cache_path, name)
+
+    def copy_to(self, path):
+        """Copies the cache directory, less its locks, to path and returns
+        a cache with the same settings kept there."""
+        shutil.copytree(self._cache_path, path, dirs_exist_ok=True,
+                ignore=shutil.ignore_patterns('*.lock'))
+        cache = TogglCache(path, self._enabled, self._max_age_days,
+                self._snapshots, self._compress, self._refresh_hours,
+                self._shards)
+        cache._max_bytes = self._max_bytes
+        return cache
+
     def cache_age_expired(self, cachemodtime):
         return (time.time() - cachemodtime) / (60 * 60 * 24) > self._max_age_days
 
+    def cache_checked(self, name):
+        """Returns when the named cache was last fetched or revalidated with
+        the server, or None if there is no cache."""
+        meta = self.read_meta(name)
+        if meta is not None and 'checked' in meta:
+            return meta['checked']
+        try:
+            return os.path.getmtime(self.cache_file(name))
+        except OSError:
+            return None
+
+    def cache_expired(self, name):
+        """Checks the named cache against the hard limit, max_age_days."""
+        if self._max_age_days <= 0:
+            return False
+        checked = self.cache_checked(name)
+        return checked is None or self.cache_age_expired(checked)
+
+    def cache_stale(self, name):
+        """Checks the named cache against the soft limit, refresh_hours.
+        Stale caches are still used but should be refreshed."""
+        if self._refresh_hours <= 0:
+            return False
+        checked = self.cache_checked(name)
+        return checked is not None and \
+                time.time() - checked > self._refresh_hours * 60 * 60
+
+    def refresh_file(self):
+        return "%s/refresh.started" % self._cache_path
+
+    def claim_refresh(self):
+        """Returns True if no other background refresh has been started
+        recently, and records that one is starting now."""
+        try:
+            if time.time() - os.path.getmtime(self.refresh_file()) < REFRESH_CLAIM_SECS:
+                return False
+        except OSError:
+            pass
+        self.write_cache_file(self.refresh_file(), str(os.getpid()))
+        return True
+
     def read_cache_file(self, path):
         try:
-            if self._max_age_days > 0 and self.cache_age_expired(os.path.getmtime(path)):
-                print("Cache is expired.")
-                return None
             f = open(path, "r")
             data = f.read()
             f.close()
             if data == "":
                 data = None 
-        except IOError:
+        except (IOError, OSError):
             data = None
 
         return data
 
     def write_cache_file(self, path, data):
+        """Replaces the file at path with data. The new contents are written
+        to a temporary file and renamed into place, so concurrent readers see
+        either the old or the new file but never a partial one."""
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        tmp_path = None
         try:
-            f = open(path, "w")
-            f.write(data)
-            f.close()
-        except IOError:
+            fd, tmp_path = tempfile.mkstemp(dir=self._cache_path,
+                    prefix='.%s.' % os.path.basename(path), suffix='.tmp')
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except (IOError, OSError):
             print("Failed to update %s" % path)
-            pass
-
-    def read_project_cache(self):
-        return self.read_cache_file("%s/%s" % (self._cache_path, "projects.cache"))
-
-    def update_project_cache(self, data):
-        return self.write_cache_file("%s/%s" % (self._cache_path, "projects.cache"), data)
-
-    def read_workspace_cache(self):
-        return self.read_cache_file("%s/%s" % (self._cache_path, "workspaces.cache"))
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def lock_file(self, name):
+        return "%s/%s.lock" % (self._cache_path, name)
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        """Holds an exclusive advisory lock on the named cache. Only writers
+        refreshing or patching a cache take it; readers never wait."""
+        if fcntl is None:
+            yield
+            return
+        f = open(self.lock_file(name), "a")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield
+        finally:
+            f.close()
 
-    def update_workspace_cache(self, data):
-        return self.write_cache_file("%s/%s" % (self._cache_path, "workspaces.cache"), data)
+    def cache_stat(self, name):
+        try:
+            return os.stat(self.cache_file(name))
+        except OSError:
+            return None
+
+    def read_cache(self, name, allow_expired=False):
+        if not allow_expired and self.cache_expired(name):
+            sys.stderr.write("Cache is expired.\n")
+            return None
+        return self.read_cache_file(self.cache_file(name))
+
+    def update_cache(self, name, data):
+        return self.write_cache_file(self.cache_file(name), data)
+
+    def read_meta(self, name):
+        """Returns the validators and request url stored for the named
+        cache, or None."""
+        data = self.read_cache_file(self.meta_file(name))
+        if data is None:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+    def update_meta(self, name, url, validators):
+        """Records how to revalidate the named cache, and that it is
+        current as of now."""
+        meta = dict(validators or {})
+        meta['url'] = url
+        meta['checked'] = time.time()
+        self.write_cache_file(self.meta_file(name), json.dumps(meta))
+
+    def read_snapshot(self, name):
+        """Returns the object stored in the snapshot for the named cache, or
+        None if there is no valid snapshot matching the current cache file."""
+        if not self._snapshots:
+            return None
+        try:
+            src = os.stat(self.cache_file(name))
+            if self.cache_expired(name):
+                return None
+            f = open(self.snapshot_file(name), "rb")
+            data = f.read()
+            f.close()
+        except (IOError, OSError):
+            return None
+
+        if len(data) < SNAPSHOT_HEADER.size:
+            return None
+        (magic, version, flags, src_size, src_mtime, length, checksum) = \
+                SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            return None
+        # The snapshot is derived from the JSON cache; rebuild it whenever
+        # the cache file has been rewritten since.
+        if src_size != src.st_size or src_mtime != src.st_mtime:
+            return None
+
+        payload = data[SNAPSHOT_HEADER.size:]
+        if len(payload) != length or zlib.crc32(payload) & 0xffffffff != checksum:
+            return None
+        if flags & SNAPSHOT_COMPRESSED:
+            payload = zlib.decompress(payload)
+        try:
+            return pickle.loads(payload)
+        except Exception:
+            return None
+
+    def update_snapshot(self, name, obj, src=None):
+        """Stores obj as the pre-parsed snapshot of the named cache file.
+        src is the stat of the cache file obj was parsed from, taken before
+        reading it, in case another process has replaced it since."""
+        if not self._snapshots:
+            return
+        if src is None:
+            src = self.cache_stat(name)
+            if src is None:
+                return
+
+        flags = 0
+        payload = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        if self._compress:
+            payload = zlib.compress(payload)
+            flags |= SNAPSHOT_COMPRESSED
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, flags,
+                src.st_size, src.st_mtime, len(payload),
+                zlib.crc32(payload) & 0xffffffff)
+        self.write_cache_file(self.snapshot_file(name), header + payload)
+
+    def running_state_file(self):
+        return "%s/running.state" % self._cache_path
+
+    def read_running_state(self):
+        """Returns the recorded running-entry state, or None if nothing has
+        been recorded yet. The state is a dict holding the running entry's
+        fields (or None when idle) and the time it was last checked."""
+        try:
+            f = open(self.running_state_file(), "r")
+            state = json.loads(f.read())
+            f.close()
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(state, dict) or 'entry' not in state:
+            return None
+        return state
+
+    def update_running_state(self, fields):
+        """Records the fields of the running entry, or None when idle."""
+        state = {'entry': fields, 'checked': time.time()}
+        self.write_cache_file(self.running_state_file(), json.dumps(state))
+
+    def clear_running_state(self):
+        self.update_running_state(None)
+
+    def stats_file(self):
+        return "%s/cache.stats" % self._cache_path
+
+    def record_use(self, name, hit):
+        """Counts a lookup answered from the named cache (a hit) or one
+        that had to go to the server (a miss)."""
+        counts = self._usage.setdefault(name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+    def read_stats(self):
+        """Returns the recorded hits, misses and last use of every cache."""
+        data = self.read_cache_file(self.stats_file())
+        try:
+            return json.loads(data) if data else {}
+        except ValueError:
+            return {}
+
+    def flush_stats(self, store=None):
+        """Adds this run's hits and misses to the stats file, then evicts
+        caches and trims the entry store if they are over the budget."""
+        if self._usage:
+            self.write_stats()
+        if self._max_bytes > 0 and self.budget_usage(store) > self._max_bytes:
+            self.evict(self._max_bytes, store)
+
+    def write_stats(self):
+        with self.lock('cache'):
+            stats = self.read_stats()
+            now = time.time()
+            for name, (hits, misses) in self._usage.items():
+                entry = stats.setdefault(name, {'hits': 0, 'misses': 0})
+                entry['hits'] += hits
+                entry['misses'] += misses
+                entry['used'] = now
+            self.write_cache_file(self.stats_file(), json.dumps(stats))
+        self._usage = {}
 
-    def read_client_cache(self):
-        return self.read_cache_file("%s/%s" % (self._cache_path, "clients.cache"))
+    @property
+    def max_bytes(self):
+        return self._max_bytes
 
-    def update_client_cache(self, data):
-        return self.write_cache_file("%s/%s" % (self._cache_path, "clients.cache"), data)
+    def cache_names(self):
+        """Returns the names of all resource caches and shards on disk."""
+        try:
+            files = os.listdir(self._cache_path)
+        except OSError:
+            return []
+        return sorted(f[:-len('.cache')] for f in files if f.endswith('.cache'))
+
+    def cache_files(self, name):
+        return [self.cache_file(name), self.snapshot_file(name), self.meta_file(name)]
+
+    def cache_size(self, name):
+        size = 0
+        for path in self.cache_files(name):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def disk_usage(self):
+        """Returns the size of everything in the cache directory."""
+        size = 0
+        try:
+            for f in os.listdir(self._cache_path):
+                size += os.path.getsize(os.path.join(self._cache_path, f))
+        except OSError:
+            pass
+        return size
+
+    def evictable_usage(self):
+        """Returns the size of the resource caches, snapshots and meta
+        files."""
+        return sum(self.cache_size(name) for name in self.cache_names())
+
+    def budget_usage(self, store=None):
+        """Returns the size of what the budget applies to: the resource
+        caches and the entry store."""
+        return self.evictable_usage() + (store.size() if store is not None else 0)
+
+    def evict(self, max_bytes, store=None):
+        """Fits the resource caches and the entry store in max_bytes. The
+        entry store keeps what room the resource caches leave, losing its
+        oldest entries first; if the caches alone are over, the least
+        recently used ones are removed. The archive and running state are
+        never evicted. Returns what was evicted."""
+        stats = self.read_stats()
+        total = self.evictable_usage()
+        evicted = []
+        if store is not None:
+            removed = store.trim(max_bytes - total)
+            if removed:
+                evicted.append("%d oldest entries from the entry store" % removed)
+            total += store.size()
+        names = sorted(self.cache_names(), key=lambda n: stats.get(n, {}).get('used', 0))
+        for name in names:
+            if total <= max_bytes:
+                break
+            with self.lock(name):
+                size = self.cache_size(name)
+                for path in self.cache_files(name):
+                    if os.path.exists(path):
+                        os.unlink(path)
+            total -= size
+            evicted.append(name)
+        return evicted
 
 def check_feature_support(proj):
     wsp = find_workspace(str(proj.workspace.id)) if proj.workspace else None
@@ -136,14 +701,14 @@ def format_time_entry(entry, show_proj=True, verbose=False):
     e_time_str = " %s" % elapsed_time(int(get_entry_duration(entry)), separator='')
  
     # Get the project name (if one exists).
-    tz = pytz.timezone(toggl_cfg.get('options', 'timezone'))
+    tz = get_timezone()
     project_name = ''
     if entry.project == None:
         project_name = " (No Project)"
     elif show_proj:
         project_name = " @%s" % entry.project.name
     else:
-        start_time = date_parser.parse(entry.start_time).astimezone(tz)
+        start_time = entry.start_datetime.astimezone(tz)
         project_name = " %s" % start_time.date()
 
     if verbose:
@@ -151,11 +716,11 @@ def format_time_entry(entry, show_proj=True, verbose=False):
         if toggl_cfg.has_option('options', 'entry_datefmt'):
             date_fmt = toggl_cfg.get('options', 'entry_datefmt')
 
-        st = date_parser.parse(entry.start_time).astimezone(tz).strftime(date_fmt)
+        st = entry.start_datetime.astimezone(tz).strftime(date_fmt)
         if entry.stop_time == None:
             et = ""
         else:
-            et = date_parser.parse(entry.stop_time).astimezone(tz).strftime(date_fmt)
+            et = entry.stop_datetime.astimezone(tz).strftime(date_fmt)
 
         return "[%s] %s%s%s%s (%s - %s)" % (entry.id, is_running, entry.desc, \
                 project_name, e_time_str, st, et)
@@ -266,18 +831,18 @@ def add_time_entry(args):
     if args.duration is not None:
         entry.duration = parse_duration(args.duration)
     else:
-        start_time = date_parser.parse(entry.start_time).astimezone(pytz.utc)
-        end_time = date_parser.parse(parse_time_str(entry.stop_time)).astimezone(pytz.utc)
-
-        entry.duration = (end_time - start_time).seconds
+        entry.duration = int(entry.stop_epoch - entry.start_epoch)
     
     # Send the data.
-    resp = toggl.add_time_entry(entry)
+    resp = send_entry_change('add', entry)
 
     if args.verbose:
         print(json_format(resp))
 
-    print("New entry added with id %s" % resp.data['id'])
+    if journal_enabled:
+        print("New entry queued with id %s" % resp.data['id'])
+    else:
+        print("New entry added with id %s" % resp.data['id'])
     
     return True
 
@@ -287,7 +852,7 @@ def edit_time_entry(args):
     if args.verbose:
         print(args)
     # Get an array of objects of recent time data.
-    entry = toggl.get_time_entry(args.id)
+    entry = find_time_entry(args.id)
 
     if entry is None:
         print("Entry id %s not found!" % args.id)
@@ -310,20 +875,213 @@ def edit_time_entry(args):
 
     # Skip calc if stop time is None - this is the currently active entry.
     if args.calc_duration != False and entry.stop_time is not None:
-        start_time = date_parser.parse(entry.start_time).astimezone(pytz.utc)
-        end_time = date_parser.parse(parse_time_str(entry.stop_time)).astimezone(pytz.utc)
-
-        entry.duration = (end_time - start_time).seconds
+        entry.duration = int(entry.stop_epoch - entry.start_epoch)
     else:
         if args.duration != None:
             entry.duration = parse_duration(args.duration)
 
-    resp = toggl.update_time_entry(entry)
+    resp = send_entry_change('update', entry)
+
+    if toggl_cache.enabled and resp.success:
+        state = toggl_cache.read_running_state()
+        if state and state['entry'] and str(state['entry'][KEY_ID]) == str(entry.id):
+            record_running_entry(TogglEntry(resp.data))
 
     return True
             
+# Column/key names accepted for each field of an imported time entry.
+IMPORT_FIELDS = {
+    'desc': ('description', 'desc', 'msg'),
+    'proj': ('project', 'proj'),
+    'start': ('start', 'start_time'),
+    'end': ('stop', 'end', 'stop_time', 'end_time'),
+    'duration': ('duration',),
+}
+
+def read_import_records(path, fmt):
+    """Yields (line number, record) pairs from a CSV or JSONL file without
+    reading the whole file into memory. CSV records are dicts; JSONL records
+    are the lines as read, parsed by parse_import_record()."""
+    f = sys.stdin if path == '-' else open(path, 'r')
+    try:
+        if fmt == 'csv':
+            import csv
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield (reader.line_num, record)
+        else:
+            for lineno, line in enumerate(f, 1):
+                if line.strip():
+                    yield (lineno, line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def parse_import_record(record):
+    """Returns the record as a dict, parsing a JSONL line."""
+    if not isinstance(record, dict):
+        try:
+            record = json.loads(record)
+        except ValueError as e:
+            raise ValueError("not valid JSON: %s" % e)
+    if not isinstance(record, dict):
+        raise ValueError("not a JSON object")
+    return record
+
+def import_record_value(record, field):
+    for key in IMPORT_FIELDS[field]:
+        value = record.get(key)
+        if value is not None and value != '':
+            return str(value)
+    return None
+
+def entry_from_record(record, projects):
+    """Builds a TogglEntry from an imported record. projects memoizes the
+    project lookups, which repeat for almost every record."""
+    entry = TogglEntry()
+    entry.desc = import_record_value(record, 'desc') or ''
+
+    proj = import_record_value(record, 'proj')
+    if proj is not None:
+        if proj not in projects:
+            projects[proj] = find_project(proj)
+        if projects[proj] is None:
+            raise ValueError("Could not find project %s" % proj)
+        entry.project = projects[proj]
+
+    start = import_record_value(record, 'start')
+    if start is None:
+        raise ValueError("Missing start time")
+    entry.start_time = parse_time_str(start)
+
+    end = import_record_value(record, 'end')
+    duration = import_record_value(record, 'duration')
+    if duration is not None:
+        entry.duration = parse_duration(duration)
+        if end is None:
+            entry.stop_time = epoch_to_datetime(entry.start_epoch + entry.duration).isoformat()
+    if end is not None:
+        entry.stop_time = parse_time_str(end)
+    if duration is None:
+        if end is None:
+            raise ValueError("Missing stop time or duration")
+        entry.duration = int(entry.stop_epoch - entry.start_epoch)
+
+    return entry
+
+def entry_hash(entry):
+    """Returns a hash of the content of an entry, used to skip duplicates."""
+    import hashlib
+    content = json.dumps([entry.desc, entry.project.id if entry.project else None,
+        entry.start_epoch, entry.stop_epoch, entry.duration])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def read_checkpoint(path):
+    try:
+        f = open(path, 'r')
+        done = set(line.strip() for line in f if line.strip())
+        f.close()
+    except IOError:
+        done = set()
+    return done
+
+def import_time_entries(args):
+    """Imports time entries from a CSV or JSONL file, several at a time."""
+    import concurrent.futures
+    import threading
+
+    fmt = args.format
+    if fmt is None:
+        fmt = 'csv' if args.file.lower().endswith('.csv') else 'jsonl'
+
+    checkpoint_path = args.checkpoint
+    if checkpoint_path is None:
+        if args.file == '-':
+            print("--checkpoint is required when importing from stdin")
+            return False
+        checkpoint_path = args.file + '.checkpoint'
+    done = read_checkpoint(checkpoint_path)
+    checkpoint = open(checkpoint_path, 'a')
+    checkpoint_lock = threading.Lock()
+
+    counts = {'imported': 0, 'skipped': 0, 'failed': 0}
+
+    def submit(lineno, entry, digest):
+        try:
+            resp = toggl.add_time_entry(entry)
+        except Exception as e:
+            return (lineno, None, e)
+        # Only record entries the server has accepted, so an interrupted
+        # import resumes with whatever was still in flight.
+        with checkpoint_lock:
+            checkpoint.write(digest + '\n')
+            checkpoint.flush()
+        return (lineno, resp, None)
+
+    def collect(futures):
+        for future in futures:
+            lineno, resp, error = future.result()
+            if error is not None:
+                counts['failed'] += 1
+                print("Line %d: failed to add entry: %s" % (lineno, error))
+            else:
+                counts['imported'] += 1
+                if args.verbose:
+                    print("Line %d: added entry %s" % (lineno, resp.data['id']))
+
+    projects = {}
+    seen = set()
+    started = time.time()
+    jobs = toggl.concurrency(args.jobs)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    pending = set()
+    try:
+        for lineno, record in read_import_records(args.file, fmt):
+            # A bad line is reported and skipped; it must not abort an
+            # import that has already sent entries.
+            try:
+                entry = entry_from_record(parse_import_record(record), projects)
+            except (ValueError, TypeError, AttributeError) as e:
+                counts['failed'] += 1
+                print("Line %d: %s" % (lineno, e))
+                continue
+
+            digest = entry_hash(entry)
+            if digest in done or digest in seen:
+                counts['skipped'] += 1
+                continue
+            seen.add(digest)
+
+            # Keep a bounded number of entries in flight so large files are
+            # streamed rather than queued up in memory.
+            if len(pending) >= jobs * 2:
+                finished, pending = concurrent.futures.wait(pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(finished)
+            pending.add(pool.submit(submit, lineno, entry, digest))
+
+        finished, pending = concurrent.futures.wait(pending)
+        collect(finished)
+    finally:
+        pool.shutdown(wait=True)
+        checkpoint.close()
+
+    elapsed = time.time() - started
+    rate = counts['imported'] / elapsed if elapsed > 0 else 0
+    print("Imported %d entries (%d skipped, %d failed) in %.1fs, %.1f entries/sec" % \
+            (counts['imported'], counts['skipped'], counts['failed'], elapsed, rate))
+
+    return counts['failed'] == 0
+
+def get_timezone():
+    """Returns the configured timezone, resolving it only once."""
+    global toggl_tz
+    if toggl_tz is None:
+        toggl_tz = pytz.timezone(toggl_cfg.get('options', 'timezone'))
+    return toggl_tz
+
 def parse_time_str(timestr):
-    tz = pytz.timezone(toggl_cfg.get('options', 'timezone'))
+    tz = get_timezone()
     tmp = date_parser.parse(timestr)
     if tmp.tzinfo is None:
         tmp = tz.localize(tmp)
@@ -383,25 +1141,75 @@ def elapsed_time(seconds, suffixes=['y','w','d','h','m','s'], add_s=False, separ
     
     return separator.join(time)
 
-def get_current_time_entry():
-    """Returns the current time entry JSON object, or None."""
-    entries = get_time_entries()
-    
-    for entry in entries:
+def get_current_time_entry(refresh=False):
+    """Returns the current time entry JSON object, or None.
+
+    With caching enabled the running entry is recorded locally when it is
+    started and cleared when it is stopped, so this normally needs no
+    network access at all."""
+    if not toggl_cache.enabled:
+        return find_running_entry()
+
+    state = toggl_cache.read_running_state()
+    if state is not None and not refresh and not running_state_expired(state):
+        if state['entry'] is None:
+            return None
+        return TogglEntry(state['entry'])
+
+    # The server can only be compared with once it has the changes queued
+    # offline, such as a start or stop. Until they are sent the recorded
+    # state is the better answer; an entry started offline is recorded
+    # under a journal key the server does not know.
+    if toggl_journal is not None and toggl_journal.has_pending():
+        if send_pending_changes():
+            state = toggl_cache.read_running_state()
+        elif state is not None:
+            return TogglEntry(state['entry']) if state['entry'] else None
+
+    entry = None
+    if state is not None and state['entry'] is not None:
+        # Checking the recorded entry is a single small request.
+        entry = toggl.get_time_entry(str(state['entry'][KEY_ID]))
+        if entry is not None and int(entry.duration) >= 0:
+            entry = None
+    if entry is None:
+        entry = find_running_entry()
+
+    record_running_entry(entry)
+    return entry
+
+def find_running_entry():
+    """Scans the latest entries on the server for a running one."""
+    for entry in toggl.get_time_entries():
         if int(entry.duration) < 0:
             return entry
     
     return None
 
-def get_time_entries(start=None, end=None):
+def running_state_expired(state):
+    max_age = DEFAULT_RUNNING_ENTRY_MAX_AGE_MINS * 60
+    if toggl_cfg.has_option('options', 'running_entry_max_age_mins'):
+        max_age = toggl_cfg.getfloat('options', 'running_entry_max_age_mins') * 60
+    return max_age > 0 and time.time() - state.get('checked', 0) > max_age
+
+def record_running_entry(entry):
+    """Updates the local running-entry state after a change."""
+    if not toggl_cache.enabled:
+        return
+    if entry is not None and entry.duration is not None and int(entry.duration) < 0:
+        toggl_cache.update_running_state(entry.fields)
+    else:
+        toggl_cache.clear_running_state()
+
+def get_time_entries(start=None, end=None, refresh=False):
     """Fetches time entry data and returns it as a Python array."""
     
-    tz = pytz.timezone(toggl_cfg.get('options', 'timezone'))
+    tz = get_timezone()
 
     end_date = None
     # Construct the start and end dates. Toggl seems to want these in UTC.
     if start != None:
-        lt = tz.localize(date_parser.parse(args.start))
+        lt = tz.localize(date_parser.parse(start))
         end_date = lt.astimezone(pytz.utc)
     else:
         endday = datetime.datetime.now(pytz.utc)
@@ -413,17 +1221,28 @@ def get_time_entries(start=None, end=None):
     start_date = None
     # The end date is actually earlier in time than start date
     if end != None:
-        lt = tz.localize(date_parser.parse(args.end))
+        lt = tz.localize(date_parser.parse(end))
         start_date = lt.astimezone(pytz.utc)
     else:
-        today = datetime.datetime.now()
-        start_date = today.replace(hour=23, minute=59, second=59)
+        today = datetime.datetime.now(tz)
+        start_date = tz.normalize(today.replace(hour=23, minute=59, second=59, microsecond=0))
     
-    return toggl.get_time_entries(start_date, end_date)
+    return toggl.get_time_entries(start_date, end_date, refresh=refresh)
 
 def list_current_time_entry(args):
     """Shows what the user is currently working on (duration is negative)."""
-    entry = get_current_time_entry()
+    if args.watch:
+        return watch_current_time_entry(args)
+
+    entry = get_current_time_entry(refresh=args.refresh)
+    if args.status:
+        try:
+            print(format_status(entry, get_status_totals()))
+        except ValueError as e:
+            print(e)
+            return False
+        return True
+
     if entry != None:
         print(format_time_entry(entry, verbose=args.verbose_list))
     else:
@@ -431,6 +1250,143 @@ def list_current_time_entry(args):
 
     return True
 
+def format_clock(seconds):
+    seconds = max(int(seconds), 0)
+    return "%d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+def get_status_format():
+    if toggl_cfg.has_option('options', 'status_format'):
+        return toggl_cfg.get('options', 'status_format')
+    return DEFAULT_STATUS_FORMAT
+
+def get_status_totals():
+    """Returns the (today, this week) durations of the finished entries in
+    the local entry store, or None if the status format does not use them.
+    This never contacts the server, so the totals are only as fresh as the
+    last listing."""
+    if not re.search(r'\{(today|week)[}!:]', get_status_format()):
+        return None
+    if toggl.entry_store is None:
+        return (0, 0)
+
+    tz = get_timezone()
+    now = datetime.datetime.now(tz)
+    day = datetime.datetime(now.year, now.month, now.day)
+    today_start = timestamp_to_epoch(localize(tz, day))
+    week_start = timestamp_to_epoch(localize(tz, day - datetime.timedelta(days=day.weekday())))
+
+    today = week = 0
+    for fields in toggl.entry_store.query(week_start, time.time()):
+        duration = int(fields.get(KEY_DURATION) or 0)
+        if duration < 0:
+            continue
+        week += duration
+        if timestamp_to_epoch(fields[KEY_START]) >= today_start:
+            today += duration
+    return (today, week)
+
+def format_status(entry, totals=None, now=None):
+    """Renders the one-line status of the running entry. Only uses data
+    that is already in memory."""
+    if now is None:
+        now = time.time()
+
+    if entry is None:
+        if toggl_cfg.has_option('options', 'status_idle'):
+            idle = toggl_cfg.get('options', 'status_idle')
+        else:
+            idle = DEFAULT_STATUS_IDLE
+        if totals is None:
+            return idle
+        elapsed = 0
+        fields = {'desc': idle, 'project': '', 'id': '', 'elapsed': ''}
+    else:
+        elapsed = now - entry.start_epoch
+        fields = {
+            'desc': entry.desc or '',
+            'project': " @%s" % entry.project.name if entry.project else '',
+            'id': entry.id,
+            'elapsed': format_clock(elapsed),
+        }
+
+    if totals is not None:
+        fields['today'] = format_clock(totals[0] + elapsed)
+        fields['week'] = format_clock(totals[1] + elapsed)
+    fmt = get_status_format()
+    try:
+        line = fmt.format(**fields)
+    except KeyError as e:
+        raise ValueError("Invalid status_format %r: unknown field %s" % (fmt, e))
+    except (IndexError, ValueError) as e:
+        raise ValueError("Invalid status_format %r: %s" % (fmt, e))
+    # Fields left empty (e.g. the elapsed time when idle) must not leave
+    # gaps behind in the status line.
+    return re.sub(' +', ' ', line).strip()
+
+def same_entry(a, b):
+    if a is None or b is None:
+        return a is b
+    return a.id == b.id and a.start_time == b.start_time and a.desc == b.desc
+
+def watch_current_time_entry(args):
+    """Prints the status line every interval seconds. Elapsed times are
+    computed locally; the server is only asked every STATUS_CHECK_MIN to
+    STATUS_CHECK_MAX seconds, backing off while nothing changes."""
+    if in_daemon:
+        print("Watch mode cannot run in toggld.")
+        return False
+    entry = get_current_time_entry(refresh=args.refresh)
+    totals = get_status_totals()
+    try:
+        format_status(entry, totals)
+    except ValueError as e:
+        print(e)
+        return False
+
+    state_file = toggl_cache.running_state_file() if toggl_cache.enabled else None
+    state_mtime = get_mtime(state_file)
+    check_interval = STATUS_CHECK_MIN
+    next_check = time.time() + check_interval
+
+    try:
+        while True:
+            now = time.time()
+            if now >= next_check:
+                try:
+                    checked = get_current_time_entry(refresh=True)
+                except Exception:
+                    # Offline; keep showing the local state and retry later.
+                    checked = entry
+                if same_entry(checked, entry):
+                    check_interval = min(check_interval * 2, STATUS_CHECK_MAX)
+                else:
+                    check_interval = STATUS_CHECK_MIN
+                    totals = get_status_totals()
+                entry = checked
+                next_check = now + check_interval
+                state_mtime = get_mtime(state_file)
+            elif get_mtime(state_file) != state_mtime:
+                # Another toggl process started or stopped an entry.
+                state_mtime = get_mtime(state_file)
+                entry = get_current_time_entry()
+                totals = get_status_totals()
+
+            sys.stdout.write(format_status(entry, totals, now) + '\n')
+            sys.stdout.flush()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+    return True
+
+def get_mtime(path):
+    if path is None:
+        return None
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
 def list_projects(args):
     """List all projects."""
     show_archived = False
@@ -440,17 +1396,6 @@ def list_projects(args):
         if toggl_cfg.has_option('options', 'show_archived_projects'):
             show_archived = toggl_cfg.getboolean('options', 'show_archived_projects')
 
-    raw = None
-    if toggl_cache.enabled:
-        raw = TogglRawData()
-        if not args.update_cache:
-            raw.response_data = toggl_cache.read_project_cache()
-
-    proj_list = toggl.get_projects(raw_data=raw)
-
-    if args.update_cache:
-        toggl_cache.update_project_cache(raw.response_data)
-
     wsp = None
     if args.workspace:
         wsp = find_workspace(args.workspace)
@@ -458,6 +1403,9 @@ def list_projects(args):
             print("Could not find specified workspace!")
             return False
 
+    proj_list = load_resource(workspace_resource('projects', wsp),
+            update_cache=args.update_cache)
+
     for proj in proj_list:
         if not proj.is_active and not show_archived:
             continue
@@ -468,106 +1416,300 @@ def list_projects(args):
 
     return True
 
-def find_project(proj):
-    """Find a project given the unique prefix of the name"""
-    raw = None
-    if toggl_cache.enabled:
+def workspace_resource(name, wsp=None):
+    """Returns the cache name holding the named resource for a single
+    workspace: its shard if the resource is sharded."""
+    if wsp is None or name not in SHARDED_RESOURCES or not toggl_cache.shards:
+        return name
+    return "%s.%s" % (name, wsp.id)
+
+def resource_fetcher(name):
+    """Returns the TogglApi call that fetches the named resource or shard."""
+    base, _, wsp_id = name.partition('.')
+    if wsp_id:
+        fetch = getattr(toggl, SHARDED_RESOURCES[base])
+        return lambda raw_data=None: fetch(wsp_id, raw_data=raw_data)
+    fetch = getattr(toggl, CACHE_RESOURCES[base])
+    kwargs = CACHE_RESOURCE_ARGS.get(base, {})
+    return lambda raw_data=None: fetch(raw_data=raw_data, **kwargs)
+
+def fields_workspace_id(fields):
+    wsp = fields.get(KEY_WORKSPACE)
+    if isinstance(wsp, dict):
+        return wsp.get(KEY_ID)
+    return fields.get('wid')
+
+def load_resource(name, update_cache=False):
+    """Returns a TogglIndex over the named resource (see CACHE_RESOURCES)
+    or shard, served from the cache snapshot or JSON cache when possible."""
+    fetch = resource_fetcher(name)
+    if not toggl_cache.enabled:
+        return TogglIndex(fetch())
+
+    if name in SHARDED_RESOURCES and toggl_cache.shards:
+        return load_shards(name, update_cache)
+
+    if not update_cache:
+        index = read_cached_resource(name)
+        if index is not None:
+            toggl_cache.record_use(name, True)
+            refresh_if_stale(name)
+            return index
+
+    # Concurrent invocations needing the same refresh queue up here; all
+    # but the first then find the cache already refreshed.
+    started = time.time()
+    with toggl_cache.lock(name):
+        checked = toggl_cache.cache_checked(name)
+        if checked is not None and checked >= started:
+            index = read_cached_resource(name)
+            if index is not None:
+                toggl_cache.record_use(name, True)
+                return index
+        toggl_cache.record_use(name, False)
+        return refresh_resource(name, update_cache)
+
+def load_shards(name, update_cache=False):
+    """Returns a TogglIndex over every workspace's shard of the named
+    resource. Each shard is cached, expired and refreshed on its own."""
+    workspaces = load_resource('workspaces')
+    if not update_cache:
+        split_cache(name, workspaces)
+    items = []
+    for wsp in workspaces:
+        items.extend(load_resource(workspace_resource(name, wsp), update_cache))
+    return TogglIndex(items)
+
+def split_cache(name, workspaces):
+    """Splits a cache written before the resource was sharded into its
+    workspaces' shards, so they do not all have to be fetched again. The
+    shards keep the old cache's age, and the old cache is removed."""
+    if name not in CACHE_RESOURCES or toggl_cache.cache_stat(name) is None:
+        return
+    with toggl_cache.lock(name):
+        data = None
+        if not toggl_cache.cache_expired(name):
+            try:
+                data = json.loads(toggl_cache.read_cache(name, allow_expired=True) or '{}')
+            except ValueError:
+                pass
+        checked = toggl_cache.cache_checked(name)
+        for wsp in workspaces:
+            shard = workspace_resource(name, wsp)
+            if data is None or toggl_cache.cache_stat(shard) is not None:
+                continue
+            items = [f for f in data.get('data') or [] if fields_workspace_id(f) == wsp.id]
+            toggl_cache.update_cache(shard, json.dumps({'data': items}))
+            toggl_cache.write_cache_file(toggl_cache.meta_file(shard),
+                    json.dumps({'checked': checked}))
+        for path in toggl_cache.cache_files(name):
+            if os.path.exists(path):
+                os.unlink(path)
+        resource_memo.pop(name, None)
+
+def read_cached_resource(name):
+    """Returns a TogglIndex over the named cache if it is present and not
+    expired, preferring an already parsed copy, then its snapshot, over
+    parsing the JSON."""
+    src = toggl_cache.cache_stat(name)
+    if src is None:
+        return None
+    key = (src.st_mtime, src.st_size)
+    memo = resource_memo.get(name)
+    if memo is not None and memo[0] == key and not toggl_cache.cache_expired(name):
+        return memo[1]
+
+    index = toggl_cache.read_snapshot(name)
+    if index is None:
         raw = TogglRawData()
-        raw.response_data = toggl_cache.read_project_cache()
+        raw.response_data = toggl_cache.read_cache(name)
+        if raw.response_data is None:
+            return None
+        index = TogglIndex(resource_fetcher(name)(raw_data=raw))
+        toggl_cache.update_snapshot(name, index, src)
+    resource_memo[name] = (key, index)
+    return index
+
+def refresh_resource(name, update_cache=False):
+    """Fetches the named resource, storing it in the cache if update_cache
+    is set or there is an existing cache to refresh."""
+    fetch = resource_fetcher(name)
+    raw = TogglRawData()
+
+    # A cache that can be revalidated is first checked with the server,
+    # which avoids the download and the parse on a 304.
+    meta = toggl_cache.read_meta(name)
+    if meta is not None and meta.get('url'):
+        raw.request_url = meta['url']
+        raw.validators = meta
+        if toggl.revalidate(raw):
+            toggl_cache.update_meta(name, meta['url'], meta)
+            index = read_cached_resource(name)
+            if index is not None:
+                return index
+            raw = TogglRawData()
+        update_cache = True
+    # Shards are kept once fetched, so a workspace is not fetched again by
+    # every command until the next "toggl update".
+    if '.' in name:
+        update_cache = True
+
+    index = TogglIndex(fetch(raw_data=raw))
+
+    if update_cache:
+        toggl_cache.update_cache(name, raw.response_data)
+        toggl_cache.update_meta(name, raw.request_url, raw.validators)
+        toggl_cache.update_snapshot(name, index)
+
+    return index
+
+def patch_resource(name, changed=(), deleted=(), active=None):
+    """Applies a mutation to the named cache (and its snapshot) in place so
+    that later lookups see it without a refresh. changed holds the fields of
+    added or updated objects as returned by the server, deleted the ids of
+    removed ones, and active maps ids to their new is_active flag."""
+    if not toggl_cache.enabled:
+        return
+
+    if name not in SHARDED_RESOURCES or not toggl_cache.shards:
+        patch_cache(name, changed, deleted, active)
+        return
+
+    for wsp in load_resource('workspaces'):
+        here = [f for f in changed if fields_workspace_id(f) == wsp.id]
+        # Objects moved to another workspace leave this one's shard.
+        moved = [f[KEY_ID] for f in changed if fields_workspace_id(f) != wsp.id]
+        patch_cache(workspace_resource(name, wsp), here,
+                list(deleted) + moved, active)
+
+def patch_cache(name, changed=(), deleted=(), active=None):
+    """Patches a single cache file; see patch_resource()."""
+    changed = dict((fields[KEY_ID], fields) for fields in changed)
+    deleted = set(deleted)
+    active = active or {}
+    with toggl_cache.lock(name):
+        text = toggl_cache.read_cache(name, allow_expired=True)
+        if text is None:
+            return
+        try:
+            doc = json.loads(text)
+        except ValueError:
+            return
+
+        patched = []
+        for fields in doc.get('data') or []:
+            obj_id = fields.get(KEY_ID)
+            if obj_id in deleted:
+                continue
+            if obj_id in changed:
+                fields = changed.pop(obj_id)
+            if obj_id in active:
+                fields[KEY_ISACTIVE] = active[obj_id]
+            patched.append(fields)
+        patched.extend(changed.values())
+        doc['data'] = patched
+
+        # Rebuild the snapshot from the patched text exactly as a fresh
+        # cache read would, so both stay in step.
+        raw = TogglRawData()
+        raw.response_data = json.dumps(doc)
+        index = TogglIndex(resource_fetcher(name)(raw_data=raw))
+        toggl_cache.update_cache(name, raw.response_data)
+        toggl_cache.update_snapshot(name, index)
+
+def parse_id_list(text):
+    """Returns the ids in a comma or space separated list."""
+    return [int(i) for i in re.split(r'[\s,]+', text.strip()) if i]
+
+def refresh_if_stale(name):
+    """Starts a detached "toggl update" if the named cache is stale, so that
+    the current command can use it without waiting on the network."""
+    global refresh_started
+    if refresh_started or not toggl_cache.cache_stale(name):
+        return
+    refresh_started = True
+    if not toggl_cache.claim_refresh():
+        return
+    spawn_background('update')
+
+def spawn_background(command):
+    """Runs a toggl command detached from this one, discarding its output."""
+    # It would go to the real server, which a replayed command never does.
+    if toggl.cassette is not None and toggl.cassette.replaying:
+        return
+    import subprocess
+    devnull = subprocess.DEVNULL
+    try:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), command],
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True, start_new_session=True)
+    except OSError:
+        pass
 
-    proj_list = toggl.get_projects(raw_data=raw)
+def find_project(proj):
+    """Find a project given the unique prefix of the name"""
     if proj.startswith('@') and proj in alias_dict:
         proj = alias_dict[proj]
-    for project in proj_list:
-        if str(project.id) == proj or project.name.startswith(proj):
-            return project
-    return None
+    return load_resource('projects').find(proj)
 
 def list_workspaces(args):
-    raw = None
-    if toggl_cache.enabled:
-        raw = TogglRawData()
-        if not args.update_cache:
-            raw.response_data = toggl_cache.read_workspace_cache()
-
-    wsp_list = toggl.get_workspaces(raw_data=raw)
-
-    if args.update_cache:
-        toggl_cache.update_workspace_cache(raw.response_data)
+    wsp_list = load_resource('workspaces', update_cache=args.update_cache)
 
     for wsp in wsp_list:
         print(format_workspace_entry(wsp, args.verbose_list))
     return True
 
 def find_workspace(wkspc):
-    raw = None
-    if toggl_cache.enabled:
-        raw = TogglRawData()
-        raw.response_data = toggl_cache.read_workspace_cache()
-
-    wsp_list = toggl.get_workspaces(raw_data=raw)
-    for wsp in wsp_list:
-        if str(wsp.id) == wkspc or wsp.name.startswith(wkspc):
-            return wsp
-    return None
+    return load_resource('workspaces').find(wkspc)
 
 def list_clients(args):
-    raw = None
-    if toggl_cache.enabled:
-        raw = TogglRawData()
-        if not args.update_cache:
-            raw.response_data = toggl_cache.read_client_cache()
-
-    cl_list = toggl.get_clients(raw_data=raw)
-
-    if args.update_cache:
-        toggl_cache.update_client_cache(raw.response_data)
+    cl_list = load_resource('clients', update_cache=args.update_cache)
 
     for cl in cl_list:
         print(format_client_entry(cl, args.verbose_list))
 
 def find_client(client):
-    raw = None
-    if toggl_cache.enabled:
-        raw = TogglRawData()
-        raw.response_data = toggl_cache.read_client_cache()
-
-    cli_list = toggl.get_clients(raw_data=raw)
-    for cli in cli_list:
-        if str(cli.id) == client or cli.name.startswith(client):
-            return cli
-    return None
+    return load_resource('clients').find(client)
 
 def list_tasks(args):
-    active = False if args.list_inactive else True
-    task_list = toggl.get_tasks(active=active)
-    for task in task_list:
-        print(format_task_entry(task, args.verbose_list))
+    for task in load_resource('tasks'):
+        if task.is_active or args.list_inactive:
+            print(format_task_entry(task, args.verbose_list))
 
 def find_task(task):
-    task_list = toggl.get_tasks(active=False)
-    for task in task_list:
-        if str(task.id) == task or task.name.startswith(task):
-            return task
-    return None
+    """Find a task given its id or the unique prefix of its name."""
+    return load_resource('tasks').find(task)
+
+def load_workspace_users(wsp, update_cache=False):
+    # Users are only available per workspace, so they are always sharded.
+    return load_resource("users.%s" % wsp.id, update_cache=update_cache)
 
 def list_time_entries_date(entries):
     date_fmt = DEFAULT_DATEFMT
     if toggl_cfg.has_option('options', 'datefmt'):
         date_fmt = toggl_cfg.get('options', 'datefmt')
 
-    # Sort the time entries into buckets based on "Month Day" of the entry.
     days = {}
-    for entry in entries:
-        tz = pytz.timezone(toggl_cfg.get('options', 'timezone'))
-        start_time = date_parser.parse(entry.start_time).astimezone(tz).strftime(date_fmt)
-        if start_time not in days:
-            days[start_time] = []
-        days[start_time].append(entry)
+    order = []
+    if entries:
+        # Sort the time entries into buckets based on the local day (or week
+        # or month) of the entry. Labels are formatted once per bucket.
+        starts = [entry.start_epoch for entry in entries]
+        buckets = TogglBuckets(get_timezone(), min(starts), max(starts), unit=args.group)
+        labels = {}
+        for entry, start in zip(entries, starts):
+            index = buckets.bucket(start)
+            if index not in labels:
+                labels[index] = format_bucket_label(buckets.label(index), date_fmt)
+            date_str = labels[index]
+            if date_str not in days:
+                days[date_str] = []
+                order.append((index, date_str))
+            days[date_str].append(entry)
 
     dur_sum = 0
     # For each day, print the entries, then sum the times.
-    for date_str in sorted(days.keys()):
+    for index, date_str in sorted(order):
         print(date_str)
 
         duration = 0
@@ -582,6 +1724,13 @@ def list_time_entries_date(entries):
         print("Total time: %s" % elapsed_time(dur_sum))
     return True
 
+def format_bucket_label(start, date_fmt):
+    if args.group == 'week':
+        return "Week of %s" % start.strftime(date_fmt)
+    elif args.group == 'month':
+        return start.strftime('%B %Y')
+    return start.strftime(date_fmt)
+
 def list_time_entries_project(entries):
     projs = {}
     for entry in entries:
@@ -620,7 +1769,7 @@ def list_time_entries(args):
     """
 
     # Get an array of objects of recent time data.
-    entries = get_time_entries(start=args.start, end=args.end)
+    entries = get_time_entries(start=args.start, end=args.end, refresh=args.update_cache)
 
     if args.grep:
         entries = filter_entries(entries, args.grep)
@@ -629,6 +1778,7 @@ def list_time_entries(args):
         list_time_entries_project(entries)
     else:
         list_time_entries_date(entries)
+    return True
 
 def parse_duration(str):
     """Parses a string of the form [[Hours:]Minutes:]Seconds and returns
@@ -652,18 +1802,23 @@ def get_entry_duration(entry):
         e_time = int(entry.duration)
     else:
         is_running = '* '
-        e_time = (datetime.datetime.now(pytz.utc) - date_parser.parse(entry.start_time).astimezone(pytz.utc)).seconds
+        e_time = int(time.time() - entry.start_epoch)
     return e_time
 
 def delete_time_entry(args):
-    entry_id = args.id
+    entry_id = parse_entry_id(args.id)
 
     print("Deleting entry %s" % entry_id)
 
-    if not toggl.delete_time_entry(entry_id):
+    if not send_entry_change('delete', entry_id=entry_id).success:
         print("Entry %s does not exist!" % entry_id)
         return False
 
+    if toggl_cache.enabled:
+        state = toggl_cache.read_running_state()
+        if state and state['entry'] and str(state['entry'][KEY_ID]) == str(entry_id):
+            toggl_cache.clear_running_state()
+
     return True
 
 def start_time_entry(args):
@@ -689,12 +1844,16 @@ def start_time_entry(args):
     entry.stop_time = None
     entry.duration = -1
 
-    resp = toggl.add_time_entry(entry)
+    resp = send_entry_change('add', entry)
+    record_running_entry(TogglEntry(resp.data))
 
     if args.verbose:
         print(json_format(resp.data))
 
-    print("New entry started with id %s" % resp.data['id'])
+    if journal_enabled:
+        print("New entry started with id %s (queued)" % resp.data['id'])
+    else:
+        print("New entry started with id %s" % resp.data['id'])
     
     return True
 
@@ -702,29 +1861,235 @@ def stop_time_entry(args):
     """Stops the current time entry (duration is negative)."""
 
     entry = get_current_time_entry()
-    if entry != None:
-        # Get the start time from the entry, converted to UTC.
-        start_time = date_parser.parse(entry.start_time).astimezone(pytz.utc)
+    if entry != None and toggl_cache.enabled:
+        entry = confirm_running_entry(entry)
 
-        if args.time:
-            tz = pytz.timezone(toggl_cfg.get('options', 'timezone'))
-            stop_time = tz.localize(date_parser.parse(args.time)).astimezone(pytz.utc)
-        else:
-            # Get stop time(now) in UTC.
-            stop_time = datetime.datetime.now(pytz.utc)
+    if entry == None:
+        print("You're not working on anything right now.")
+        return False
+    if not stop_entry(entry, args):
+        print("Could not stop the current time entry!")
+        return False
+    return True
 
-        # Create the payload.
-        entry.stop_time = stop_time.isoformat()
-        entry.duration = (stop_time - start_time).seconds
+def confirm_running_entry(entry):
+    """Checks the locally recorded running entry with the server before it
+    is changed, as it may have been stopped or deleted elsewhere. Returns
+    the server's copy of what is running, or None. With offline_journal
+    enabled and the server out of reach, the recorded entry is trusted."""
+    try:
+        return get_current_time_entry(refresh=True)
+    except Exception as e:
+        if not journal_enabled:
+            raise
+        print("Could not check the running entry with the server: %s" % e)
+        return entry
+
+def stop_entry(entry, args):
+    """Sets the stop time and duration of a running entry. Returns False if
+    the entry does not exist on the server."""
+    if args.time:
+        tz = get_timezone()
+        stop_time = tz.localize(date_parser.parse(args.time)).astimezone(pytz.utc)
+    else:
+        # Get stop time(now) in UTC.
+        stop_time = datetime.datetime.now(pytz.utc)
 
-        toggl.update_time_entry(entry)
+    # Create the payload.
+    entry.stop_time = stop_time.isoformat()
+    entry.duration = int(timestamp_to_epoch(stop_time) - entry.start_epoch)
 
-    else:
-        print("You're not working on anything right now.")
+    if not send_entry_change('update', entry).success:
         return False
 
+    record_running_entry(None)
+    return True
+
+def parse_entry_id(text):
+    """Returns a time entry id given on the command line: a server id, or
+    the journal key of an entry that has not been sent yet."""
+    text = str(text).strip()
+    return int(text) if text.isdigit() else text
+
+def send_entry_change(op, entry=None, entry_id=None):
+    """Adds, updates or deletes a time entry, or with offline_journal
+    enabled queues the change and returns at once. Returns a TogglResponse;
+    the id of a queued new entry is its journal key."""
+    if not journal_enabled:
+        if op == 'add':
+            return toggl.add_time_entry(entry)
+        elif op == 'update':
+            return toggl.update_time_entry(entry)
+        return toggl.delete_time_entry(entry_id)
+
+    global journal_queued
+    with toggl_cache.lock('journal'):
+        if op == 'add':
+            fields = dict(entry.fields)
+            fields.pop(KEY_ID, None)
+            record = toggl_journal.append(op, fields=fields)
+            fields = dict(fields)
+            fields[KEY_ID] = record['key']
+        elif op == 'update':
+            fields = entry.fields
+            toggl_journal.append(op, entry.id, fields)
+        else:
+            fields = {KEY_ID: entry_id}
+            toggl_journal.append(op, entry_id)
+    journal_queued = True
+    return TogglResponse(True, {'data': fields})
+
+def find_time_entry(entry_id):
+    """Returns the time entry with the given id or journal key, or None.
+    With offline_journal enabled, queued changes, the running entry and the
+    entry store are looked at before asking the server."""
+    entry_id = parse_entry_id(entry_id)
+    if journal_enabled:
+        pending, ids, attempted = toggl_journal.read()
+        entry_id = ids.get(entry_id, entry_id)
+        found = False
+        for change in pending:
+            ref = change['key'] if change['op'] == 'add' else change.get('id')
+            if ids.get(ref, ref) == entry_id:
+                found = True
+                fields = change.get('fields')
+        if found:
+            if fields is None:
+                return None
+            fields = dict(fields)
+            fields[KEY_ID] = entry_id
+            return TogglEntry(fields)
+
+        state = toggl_cache.read_running_state()
+        if state and state['entry'] and state['entry'][KEY_ID] == entry_id:
+            return TogglEntry(state['entry'])
+        if toggl.entry_store is not None and isinstance(entry_id, int):
+            fields = toggl.entry_store.get(entry_id)
+            if fields is not None:
+                return TogglEntry(fields)
+
+    if not isinstance(entry_id, int):
+        return None
+    return toggl.get_time_entry(str(entry_id))
+
+def entry_project_id(entry):
+    return entry.project.id if entry.project else None
+
+def find_sent_entry(entry):
+    """Looks on the server for an entry matching one whose add may have
+    been applied without its response arriving. The server keeps whole
+    seconds, so start times only need to agree to within a second."""
+    start = entry.start_epoch
+    for found in toggl.get_time_entries(epoch_to_datetime(start + 2),
+            epoch_to_datetime(start - 2), refresh=True):
+        if abs(found.start_epoch - start) < 1 and found.desc == entry.desc and \
+                entry_project_id(found) == entry_project_id(entry):
+            return found
+    return None
+
+def send_journal_change(change, ids, attempted):
+    """Sends one queued change, returning the server id of the entry, or
+    None if the change was dropped because its entry no longer exists."""
+    if change['op'] == 'add':
+        entry = TogglEntry(dict(change['fields']))
+        found = None
+        if attempted:
+            found = find_sent_entry(entry)
+        if found is None:
+            with toggl_cache.lock('journal'):
+                toggl_journal.attempt(change['key'])
+            found = TogglEntry(toggl.add_time_entry(entry,
+                    idempotency_key=change['key']).data)
+
+        # An entry started offline is still recorded under its key.
+        state = toggl_cache.read_running_state()
+        if state and state['entry'] and state['entry'][KEY_ID] == change['key']:
+            record_running_entry(found)
+        return found.id
+
+    entry_id = ids.get(change.get('id'), change.get('id'))
+    if entry_id is None or not isinstance(entry_id, int):
+        # The entry's own add was rejected.
+        return None
+    if change['op'] == 'update':
+        fields = dict(change['fields'])
+        fields[KEY_ID] = entry_id
+        resp = toggl.update_time_entry(TogglEntry(fields))
+    else:
+        resp = toggl.delete_time_entry(entry_id)
+    if not resp.success:
+        print("Entry %s no longer exists, dropping the queued %s" % (entry_id, change['op']))
+        return None
+    return entry_id
+
+def sync_journal():
+    """Sends the queued changes to the server in order. Returns how many
+    were sent and how many the server rejected (these are dropped). Network
+    and server errors are raised, leaving the rest of the changes queued."""
+    sent = dropped = 0
+    with toggl_cache.lock('sync'):
+        with toggl_cache.lock('journal'):
+            pending, ids, attempted = toggl_journal.read()
+        try:
+            for change in pending:
+                try:
+                    entry_id = send_journal_change(change, ids, change['key'] in attempted)
+                    if entry_id is None:
+                        dropped += 1
+                    else:
+                        sent += 1
+                except Exception as e:
+                    status = getattr(getattr(e, 'response', None), 'status_code', None)
+                    if status is None or status >= 500 or status == 429:
+                        raise
+                    print("Dropping the queued %s rejected by the server: %s" % (change['op'], e))
+                    entry_id = None
+                    dropped += 1
+                ids[change['key']] = entry_id
+                with toggl_cache.lock('journal'):
+                    toggl_journal.ack(change['key'], entry_id)
+        finally:
+            with toggl_cache.lock('journal'):
+                toggl_journal.compact()
+    return (sent, dropped)
+
+def send_pending_changes():
+    """Sends any queued changes before the server is read from. Returns
+    whether there were changes and they were all sent."""
+    if toggl_journal is None or not toggl_journal.has_pending():
+        return False
+    try:
+        sync_journal()
+    except Exception as e:
+        print("Could not send the queued changes: %s" % e)
+        return False
     return True
 
+def cmd_sync(args):
+    if toggl_journal is None:
+        print("Caching is not enabled. Set options.cache_enabled in ~/.togglrc to enable it.")
+        return False
+
+    if args.list:
+        with toggl_cache.lock('journal'):
+            pending, ids, attempted = toggl_journal.read()
+        tz = get_timezone()
+        for change in pending:
+            queued = epoch_to_datetime(change['queued']).astimezone(tz)
+            desc = (change.get('fields') or {}).get(KEY_DESC, '')
+            print("%s %-6s %s %s" % (queued.strftime('%Y-%m-%d %H:%M:%S'), change['op'],
+                    change['key'] if change['op'] == 'add' else change['id'], desc))
+        print("%d changes queued" % len(pending))
+        return True
+
+    try:
+        sent, dropped = sync_journal()
+    except Exception as e:
+        print("Could not send the queued changes: %s" % e)
+        return False
+    print("Sent %d queued changes, %d dropped" % (sent, dropped))
+    return dropped == 0
+
 def cmd_project(args):
     if args.add:
         if not args.name or not args.workspace:
@@ -750,7 +2115,8 @@ def cmd_project(args):
                 return False
             p.client = cli
 
-        toggl.add_project(p)
+        resp = toggl.add_project(p)
+        patch_resource('projects', changed=[resp.data])
     elif args.update:
         if not args.id:
             print("-i is required when updating a project")
@@ -781,11 +2147,14 @@ def cmd_project(args):
                 return False
             p.client = cli
 
-        toggl.update_project(p)
+        resp = toggl.update_project(p)
+        patch_resource('projects', changed=[resp.data])
     elif args.archive:
         toggl.archive_projects(args.archive)
+        patch_resource('projects', active=dict((i, False) for i in parse_id_list(args.archive)))
     elif args.reopen:
         toggl.reopen_projects(args.reopen)
+        patch_resource('projects', active=dict((i, True) for i in parse_id_list(args.reopen)))
     elif args.id:
         proj = find_project(args.id)
         if proj is None:
@@ -803,7 +2172,11 @@ def cmd_workspace(args):
         if not args.id:
             print("Workspace ID is required to list users!")
             return False
-        user_list = toggl.get_workspace_users(args.id)
+        wsp = find_workspace(args.id)
+        if wsp is None:
+            print("Could not find specified workspace!")
+            return False
+        user_list = load_workspace_users(wsp, update_cache=args.update_cache)
         for user in user_list:
             print(format_user_entry(user))
         print("Total Users: %d" % len(user_list))
@@ -836,7 +2209,8 @@ def cmd_client(args):
                 return False
             c.workspace = wksp
 
-        toggl.add_client(c)
+        resp = toggl.add_client(c)
+        patch_resource('clients', changed=[resp.data])
 
         return True
     elif args.update:
@@ -861,9 +2235,11 @@ def cmd_client(args):
                 return False
             c.workspace = wksp
 
-        if not toggl.update_client(c):
+        resp = toggl.update_client(c)
+        if not resp.success:
             print("Failed to update specified client!")
             return False
+        patch_resource('clients', changed=[resp.data])
 
         return True
     elif args.delete:
@@ -871,9 +2247,11 @@ def cmd_client(args):
             print("Must specify the client id to delete!")
             return False
 
-        if not toggl.delete_client(args.id):
+        resp = toggl.delete_client(args.id)
+        if not resp.success:
             print("Failed to update specified client!")
             return False
+        patch_resource('clients', deleted=[int(args.id)])
 
         return True
     elif args.id:
@@ -913,7 +2291,8 @@ def cmd_task(args):
 
         t.project = proj
 
-        toggl.add_task(t)
+        resp = toggl.add_task(t)
+        patch_resource('tasks', changed=[resp.data])
 
         return True
     elif args.update:
@@ -938,7 +2317,11 @@ def cmd_task(args):
                 return False
             t.project = proj
 
-        toggl.update_task(t)
+        resp = toggl.update_task(t)
+        if not resp.success:
+            print("Failed to update specified task!")
+            return False
+        patch_resource('tasks', changed=[resp.data])
 
         return True
     elif args.delete:
@@ -946,7 +2329,8 @@ def cmd_task(args):
             print("You must specify the id of a task to delete!")
             return False
 
-        toggl.delete_task(args.id)
+        if toggl.delete_task(args.id).success:
+            patch_resource('tasks', deleted=[int(args.id)])
 
         return True
     elif args.id:
@@ -960,25 +2344,442 @@ def cmd_task(args):
     else:
         list_tasks(args)
 
-def cmd_update(args):
-    if not toggl_cfg.has_option('options', 'cache_enabled') or \
-            not toggl_cfg.getboolean('options', 'cache_enabled'):
+def archive_file(args):
+    if args.file is not None:
+        return os.path.expanduser(args.file)
+    if toggl_cfg.has_option('options', 'archive_path') and scratch_cache is None:
+        return os.path.expanduser(toggl_cfg.get('options', 'archive_path'))
+    return "%s/entries.archive" % toggl_cache.cache_path
+
+def archive_bound(timestr):
+    if timestr is None:
+        return None
+    return timestamp_to_epoch(parse_time_str(timestr))
+
+def build_archive(args):
+    """Writes the finished time entries in the given range to the archive."""
+    if args.start is None:
+        print("A start date (-s) is required to build the archive.")
+        return False
+
+    path = archive_file(args)
+    entries = get_time_entries(start=args.start, end=args.end)
+    writer = TogglArchiveWriter()
+    for entry in sorted(entries, key=lambda e: e.start_epoch):
+        if entry.duration < 0 or entry.stop_time is None:
+            continue
+        proj = entry.project
+        writer.add(entry.start_epoch, entry.stop_epoch, entry.duration, entry.desc,
+                proj.id if proj is not None else None,
+                proj.name if proj is not None else None)
+    writer.write(path)
+
+    print("Archived %d entries to %s (%d KB)" % \
+            (len(writer), path, os.path.getsize(path) // 1024))
+    return True
+
+def report_archive(args, archive):
+    """Prints the total time per project, description or period by scanning
+    the archive's columns; no per-entry objects are created."""
+    first, end = archive.span(archive_bound(args.start), archive_bound(args.end))
+    if first == end:
+        print("No archived entries in that range.")
+        return True
+
+    durations = archive.duration[first:end]
+    totals = {}
+    if args.group in ('project', 'desc'):
+        keys = archive.project if args.group == 'project' else archive.desc
+        for key, duration in zip(keys[first:end], durations):
+            totals[key] = totals.get(key, 0) + duration
+        order = sorted(totals, key=lambda k: totals[k], reverse=True)
+    else:
+        starts = archive.start[first:end]
+        buckets = TogglBuckets(get_timezone(), starts[0], starts[-1], unit=args.group)
+        for start, duration in zip(starts, durations):
+            key = buckets.bucket(start)
+            totals[key] = totals.get(key, 0) + duration
+        order = sorted(totals)
+
+    date_fmt = DEFAULT_DATEFMT
+    if toggl_cfg.has_option('options', 'datefmt'):
+        date_fmt = toggl_cfg.get('options', 'datefmt')
+
+    for key in order:
+        if args.group == 'project':
+            label = archive.project_name(key) if key != NO_PROJECT else None
+            label = label or '(No Project)'
+        elif args.group == 'desc':
+            label = archive.string(key)
+        else:
+            label = format_bucket_label(buckets.label(key), date_fmt)
+        print("%s: %s" % (label, elapsed_time(int(totals[key]))))
+    print("Total time: %s" % elapsed_time(int(sum(totals.values()))))
+    return True
+
+def cmd_archive(args):
+    if args.action == 'build':
+        return build_archive(args)
+
+    path = archive_file(args)
+    try:
+        archive = TogglArchive(path)
+    except (IOError, OSError, ValueError) as e:
+        print("Cannot open the archive: %s" % e)
+        print("Run \"toggl archive build -s DATE\" to create it.")
+        return False
+
+    with archive:
+        if args.action == 'report':
+            return report_archive(args, archive)
+
+        print("%s: %d entries, %d KB" % (path, len(archive), os.path.getsize(path) // 1024))
+        if len(archive) > 0:
+            tz = get_timezone()
+            print("From %s to %s" % (epoch_to_datetime(archive.start[0]).astimezone(tz),
+                    epoch_to_datetime(archive.start[-1]).astimezone(tz)))
+    return True
+
+def format_size(size):
+    if size >= 1024 * 1024:
+        return "%.1f MB" % (size / (1024.0 * 1024))
+    return "%d KB" % ((size + 1023) // 1024)
+
+def show_cache_stats(args):
+    stats = toggl_cache.read_stats()
+    names = toggl_cache.cache_names()
+    tz = get_timezone()
+    now = time.time()
+
+    print("%-24s %9s %10s %6s %6s %5s  %s" % \
+            ('Cache', 'Size', 'Age', 'Hits', 'Misses', 'Hit%', 'Last refresh'))
+    for name in names:
+        entry = stats.get(name, {})
+        hits = entry.get('hits', 0)
+        misses = entry.get('misses', 0)
+        ratio = "%d%%" % (100 * hits // (hits + misses)) if hits + misses else '-'
+        checked = toggl_cache.cache_checked(name)
+        age = '-'
+        if checked:
+            age = elapsed_time(int(now - checked), separator='') or '0s'
+        refreshed = '-'
+        if checked:
+            refreshed = epoch_to_datetime(checked).astimezone(tz).strftime('%Y-%m-%d %H:%M')
+        print("%-24s %9s %10s %6d %6d %5s  %s" % (name,
+                format_size(toggl_cache.cache_size(name)), age, hits, misses, ratio, refreshed))
+
+    budget = 'no limit'
+    if toggl_cache.max_bytes > 0:
+        budget = format_size(toggl_cache.max_bytes)
+    store = toggl.entry_store
+    if store is not None:
+        cov = store.coverage()
+        since = epoch_to_datetime(cov[0]).astimezone(tz).strftime('%Y-%m-%d') if cov else '-'
+        print("%-24s %9s  entries since %s" % ('(entry store)', format_size(store.size()), since))
+    print("Caches and entry store: %s (budget: %s)" % \
+            (format_size(toggl_cache.budget_usage(store)), budget))
+    print("Total disk use: %s" % format_size(toggl_cache.disk_usage()))
+    return True
+
+def cmd_cache(args):
+    if not toggl_cache.enabled:
         print("Caching is not enabled. Set options.cache_enabled in ~/.togglrc to enable it.")
         return False
 
-    raw = TogglRawData()
-    toggl.get_projects(raw_data=raw)
-    toggl_cache.update_project_cache(raw.response_data)
+    if args.action == 'stats':
+        return show_cache_stats(args)
 
-    raw = TogglRawData()
-    toggl.get_workspaces(raw_data=raw)
-    toggl_cache.update_workspace_cache(raw.response_data)
+    if args.all:
+        evicted = toggl_cache.evict(0)
+    elif toggl_cache.max_bytes > 0:
+        evicted = toggl_cache.evict(toggl_cache.max_bytes, toggl.entry_store)
+    else:
+        print("No cache budget set. Set options.cache_max_mb, or use -a to evict every cache.")
+        return False
+    for name in evicted:
+        print("Evicted %s" % name)
+    print("Caches and entry store: %s" % format_size(toggl_cache.budget_usage(toggl.entry_store)))
+    return True
 
-    raw = TogglRawData()
-    toggl.get_clients(raw_data=raw)
-    toggl_cache.update_client_cache(raw.response_data)
+def workspace_shards(wsp):
+    """Returns the cache names holding the given workspace's resources.
+    Users are only listed for workspaces the user administers."""
+    names = []
+    for name in SHARDED_RESOURCES:
+        if name == 'users':
+            if wsp.is_admin:
+                names.append("users.%s" % wsp.id)
+        elif toggl_cache.shards:
+            names.append(workspace_resource(name, wsp))
+    return names
+
+def update_resource(name):
+    """Refreshes one cache; returns its name, item count and duration."""
+    started = time.time()
+    index = load_resource(name, update_cache=True)
+    return (name, len(index), time.time() - started)
+
+def update_resources(names, jobs):
+    """Refreshes the named caches concurrently. Returns the results of
+    update_resource() and whether every refresh succeeded."""
+    import concurrent.futures
+    results = []
+    ok = True
+    workers = max(1, min(toggl.concurrency(jobs), len(names)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = dict((pool.submit(update_resource, name), name) for name in names)
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print("Failed to update %s: %s" % (futures[future], e))
+                ok = False
+    return results, ok
 
-    print("Caches updated!")
+def cmd_update(args):
+    if not toggl_cfg.has_option('options', 'cache_enabled') or \
+            not toggl_cfg.getboolean('options', 'cache_enabled'):
+        print("Caching is not enabled. Set options.cache_enabled in ~/.togglrc to enable it.")
+        return False
+
+    started = time.time()
+    if args.workspace:
+        wsp = find_workspace(args.workspace)
+        if wsp is None:
+            print("Could not find specified workspace!")
+            return False
+        results, ok = update_resources(workspace_shards(wsp), args.jobs)
+    else:
+        # Shards are listed by workspace, so the workspaces (and everything
+        # not sharded) are refreshed first, then every shard at once.
+        names = [name for name in CACHE_RESOURCES
+                if name not in SHARDED_RESOURCES or not toggl_cache.shards]
+        results, ok = update_resources(names, args.jobs)
+        shards = []
+        for wsp in load_resource('workspaces'):
+            shards.extend(workspace_shards(wsp))
+        more, more_ok = update_resources(shards, args.jobs)
+        results.extend(more)
+        ok = ok and more_ok
+
+    print("%-24s %7s %9s %8s" % ('Cache', 'Items', 'Size', 'Time'))
+    for name, count, elapsed in sorted(results):
+        print("%-24s %7d %9s %7.2fs" % (name, count,
+                format_size(toggl_cache.cache_size(name)), elapsed))
+    print("Updated %d caches in %.2fs (%.2fs of requests)" % (len(results),
+            time.time() - started, sum(r[2] for r in results)))
+
+    if ok:
+        print("Caches updated!")
+    return ok
+
+def names_index_file():
+    return os.path.join(toggl_cache.cache_path, NAMES_INDEX)
+
+def entries_index_file():
+    return os.path.join(toggl_cache.cache_path, ENTRIES_INDEX)
+
+def names_index_stale():
+    """Returns whether the name index is missing or older than ~/.togglrc
+    or any resource cache."""
+    index_mtime = get_mtime(names_index_file())
+    if index_mtime is None:
+        return True
+    sources = [os.path.expanduser('~/.togglrc')]
+    sources.extend(toggl_cache.cache_file(name) for name in toggl_cache.cache_names())
+    for path in sources:
+        mtime = get_mtime(path)
+        if mtime is not None and mtime > index_mtime:
+            return True
+    return False
+
+def index_line(kind, name, note=''):
+    clean = lambda s: re.sub(r'[\t\r\n]+', ' ', s)
+    if note:
+        return "%s\t%s\t%s\n" % (kind, clean(name), clean(note))
+    return "%s\t%s\n" % (kind, clean(name))
+
+def write_names_index():
+    """Writes the names of every cached project, workspace, client and task
+    and the aliases to the name index."""
+    lines = []
+    for name in toggl_cache.cache_names():
+        resource = name.split('.')[0]
+        kind = NAMES_INDEX_KINDS.get(resource)
+        if kind is None:
+            continue
+        # Leftover unsharded caches would list deleted or moved objects.
+        if resource in SHARDED_RESOURCES and toggl_cache.shards and '.' not in name:
+            continue
+        text = toggl_cache.read_cache(name, allow_expired=True)
+        if not text:
+            continue
+        try:
+            data = json.loads(text).get('data') or []
+        except ValueError:
+            continue
+        for fields in data:
+            if fields.get('name'):
+                lines.append(index_line(kind, fields['name']))
+
+    for alias in sorted(alias_dict):
+        lines.append(index_line('a', alias, alias_dict[alias]))
+
+    toggl_cache.write_cache_file(names_index_file(), ''.join(lines))
+
+def entries_index_stale():
+    """Returns whether the entry store has changed since the entry index
+    was written."""
+    index_mtime = get_mtime(entries_index_file())
+    store_mtime = get_mtime(os.path.join(toggl_cache.cache_path, 'entries.db'))
+    return index_mtime is None or (store_mtime is not None and store_mtime > index_mtime)
+
+def write_entries_index():
+    """Writes the latest entry ids and descriptions to the entry index.
+    Most commands leave them as they were; then the index is only marked
+    current."""
+    if toggl.entry_store is None:
+        return
+    lines = [index_line('i', str(fields[KEY_ID]), fields.get('description') or '')
+            for fields in toggl.entry_store.recent(NAMES_INDEX_ENTRIES)]
+    text = ''.join(lines)
+    path = entries_index_file()
+    if os.path.exists(path) and (toggl_cache.read_cache_file(path) or '') == text:
+        os.utime(path, None)
+        return
+    toggl_cache.write_cache_file(path, text)
+
+BASH_COMPLETION = r'''# toggl completion for bash; generated by "toggl completion bash".
+_toggl_names()
+{
+    awk -F '\t' -v k="$1" -v p="$2" \
+        'index(k, $1) && index($2, p) == 1 {print $2}' '%(index)s' '%(entries)s' 2>/dev/null
+}
+
+# Removes the shell quoting from a partly typed word ("Project\ 0" or
+# 'Project 0), as the index holds names as they are.
+_toggl_dequote()
+{
+    local word="$1" out= quote= c i
+    for ((i = 0; i < ${#word}; i++)); do
+        c="${word:i:1}"
+        if [[ "$c" == "$quote" ]]; then
+            quote=
+        elif [[ -z "$quote" && ( "$c" == "'" || "$c" == '"' ) ]]; then
+            quote="$c"
+        elif [[ "$c" == '\' && "$quote" != "'" ]]; then
+            ((i++))
+            out+="${word:i:1}"
+        else
+            out+="$c"
+        fi
+    done
+    printf '%%s' "$out"
+}
+
+_toggl_complete()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}" prev="${COMP_WORDS[COMP_CWORD-1]}"
+    local cmd= kinds= opts= i
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        case "${COMP_WORDS[i]}" in
+            -*) ;;
+            *) cmd="${COMP_WORDS[i]}"; break ;;
+        esac
+    done
+    COMPREPLY=()
+    if [[ -z "$cmd" ]]; then
+        COMPREPLY=($(compgen -W "%(commands)s" -- "$cur"))
+        return 0
+    fi
+    case "$cmd $prev" in
+%(values)s
+    esac
+    if [[ -n "$kinds" ]]; then
+        local IFS=$'\n' name
+        for name in $(_toggl_names "$kinds" "$(_toggl_dequote "$cur")"); do
+            COMPREPLY+=("$(printf '%%q' "$name")")
+        done
+        return 0
+    fi
+    if [[ "$cur" == -* ]]; then
+        case "$cmd" in
+%(options)s
+        esac
+        COMPREPLY=($(compgen -W "$opts" -- "$cur"))
+    fi
+    return 0
+}
+complete -o default -F _toggl_complete toggl toggl.py
+'''
+
+ZSH_COMPLETION = r'''# toggl completion for zsh; generated by "toggl completion zsh".
+autoload -U +X bashcompinit && bashcompinit
+'''
+
+FISH_COMPLETION = r'''# toggl completion for fish; generated by "toggl completion fish".
+function __toggl_names
+    awk -F '\t' -v k=$argv[1] \
+        'index(k, $1) {print $2 ($3 == "" ? "" : "\t" $3)}' '%(index)s' '%(entries)s' 2>/dev/null
+end
+complete -c toggl -f
+'''
+
+def fish_quote(text):
+    return "'%s'" % text.replace('\\', '\\\\').replace("'", "\\'")
+
+def command_options(setup):
+    """Returns the option strings and help of a sub-command's arguments."""
+    parser = argparse.ArgumentParser()
+    setup(parser)
+    return [(action.option_strings, action.help) for action in parser._actions
+            if action.option_strings and '-h' not in action.option_strings]
+
+def completion_script(shell):
+    """Generates the completion script for the given shell. The scripts
+    look names up in the name index themselves, so completing never runs
+    toggl.py."""
+    index = names_index_file().replace("'", "'\\''")
+    entries = entries_index_file().replace("'", "'\\''")
+
+    if shell == 'fish':
+        lines = [FISH_COMPLETION % {'index': index, 'entries': entries}]
+        for name, help_text, setup in COMMANDS:
+            lines.append("complete -c toggl -n __fish_use_subcommand -a %s -d %s\n" %
+                    (name, fish_quote(help_text)))
+        values = dict(((cmd, tuple(opts)), kinds) for cmd, opts, kinds in COMPLETION_VALUES)
+        for name, help_text, setup in COMMANDS:
+            for opts, help_text in command_options(setup):
+                flags = ''.join(' -s %s' % o[1:] if len(o) == 2 else ' -l %s' % o[2:]
+                        for o in opts)
+                kinds = values.get((name, tuple(opts)))
+                if kinds:
+                    flags += " -xa '(__toggl_names %s)'" % kinds
+                lines.append("complete -c toggl -n '__fish_seen_subcommand_from %s'%s -d %s\n" %
+                        (name, flags, fish_quote(help_text or '')))
+        return ''.join(lines)
+
+    values = []
+    for cmd, opts, kinds in COMPLETION_VALUES:
+        values.append('        %s) kinds=%s ;;' %
+                ('|'.join('"%s %s"' % (cmd, o) for o in opts), kinds))
+    options = []
+    for name, help_text, setup in COMMANDS:
+        opts = [o for option_strings, h in command_options(setup) for o in option_strings]
+        if opts:
+            options.append('            %s) opts="%s" ;;' % (name, ' '.join(opts)))
+    script = BASH_COMPLETION % {'index': index, 'entries': entries,
+            'commands': ' '.join(name for name, help_text, setup in COMMANDS),
+            'values': '\n'.join(values), 'options': '\n'.join(options)}
+    if shell == 'zsh':
+        script = ZSH_COMPLETION + script.split('\n', 1)[1]
+    return script
+
+def cmd_completion(args):
+    if not toggl_cache.enabled:
+        print("Caching is not enabled. Set options.cache_enabled in ~/.togglrc to enable it.")
+        return False
+    sys.stdout.write(completion_script(args.shell))
     return True
 
 def visit_web(args):
@@ -1016,10 +2817,7 @@ def build_alias_table():
 
 def init_config():
     global toggl_cfg
-    try:
-        toggl_cfg = configparser.ConfigParser(interpolation=None)
-    except:
-        toggl_cfg = configparser.ConfigParser()
+    toggl_cfg = configparser.ConfigParser(interpolation=None)
 
     toggl_cfg.optionxform = lambda option: option
     if toggl_cfg.read(os.path.expanduser('~/.togglrc')) == []:
@@ -1043,27 +2841,103 @@ def init_cache():
     max_cache_age = 0
     if toggl_cfg.has_option('options', 'max_cache_age_days'):
         max_cache_age = toggl_cfg.get('options', 'max_cache_age_days')
+    snapshots = False
+    if toggl_cfg.has_option('options', 'cache_snapshots'):
+        snapshots = toggl_cfg.getboolean('options', 'cache_snapshots')
+    compress = False
+    if toggl_cfg.has_option('options', 'cache_compress'):
+        compress = toggl_cfg.getboolean('options', 'cache_compress')
+    refresh_hours = 0
+    if toggl_cfg.has_option('options', 'cache_refresh_hours'):
+        refresh_hours = toggl_cfg.getfloat('options', 'cache_refresh_hours')
+    shards = True
+    if toggl_cfg.has_option('options', 'cache_shards'):
+        shards = toggl_cfg.getboolean('options', 'cache_shards')
+    max_mb = 0
+    if toggl_cfg.has_option('options', 'cache_max_mb'):
+        max_mb = toggl_cfg.getfloat('options', 'cache_max_mb')
     toggl_cache = TogglCache(cache_path=cache_path,
-            cache_enabled=cache_enabled, max_age_days=float(max_cache_age))
+            cache_enabled=cache_enabled, max_age_days=float(max_cache_age),
+            snapshots=snapshots, compress=compress, refresh_hours=refresh_hours,
+            shards=shards, max_mb=max_mb)
 
     return True
 
-def main():
-    """Program entry point."""
-    
-    if not init_config() or not init_cache():
-        return 1
-
-    global IGNORE_START_TIMES
-    auth = (toggl_cfg.get('auth', 'username').strip(), toggl_cfg.get('auth', 'password').strip())
-    IGNORE_START_TIMES = toggl_cfg.getboolean('options', 'ignore_start_times')
-
-    parser = argparse.ArgumentParser(prog='toggl')
-    parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
-
-    subparsers = parser.add_subparsers(help='sub-command help')
+def init_journal():
+    """Sets up the change journal. It is kept in the cache directory, and
+    changes are only queued in it when offline_journal is enabled."""
+    global toggl_journal, journal_enabled
+    toggl_journal = None
+    journal_enabled = False
+    if not toggl_cache.enabled:
+        return True
+    toggl_journal = TogglJournal(os.path.join(toggl_cache.cache_path, 'journal.jsonl'))
+    if toggl_cfg.has_option('options', 'offline_journal'):
+        journal_enabled = toggl_cfg.getboolean('options', 'offline_journal')
+    return True
 
-    parser_ls = subparsers.add_parser('ls', help='List time entries')
+def init_entry_store():
+    """Opens the local time entry store if caching is enabled."""
+    if not toggl_cache.enabled:
+        return None
+    if toggl_cfg.has_option('options', 'entry_store_enabled') and \
+            not toggl_cfg.getboolean('options', 'entry_store_enabled'):
+        return None
+
+    stable_days = DEFAULT_STABLE_DAYS
+    if toggl_cfg.has_option('options', 'entry_store_stable_days'):
+        stable_days = toggl_cfg.getfloat('options', 'entry_store_stable_days')
+
+    return TogglEntryStore(os.path.join(toggl_cache.cache_path, 'entries.db'),
+            stable_days=stable_days)
+
+def get_pool_options():
+    """Reads the HTTP connection pool settings from the options section."""
+    pool_args = {}
+    for opt in ('pool_connections', 'pool_maxsize'):
+        if toggl_cfg.has_option('options', opt):
+            pool_args[opt] = toggl_cfg.getint('options', opt)
+    for opt in ('pool_block', 'keep_alive'):
+        if toggl_cfg.has_option('options', opt):
+            pool_args[opt] = toggl_cfg.getboolean('options', opt)
+    return pool_args
+
+def get_rate_options():
+    """Reads the request rate limit and retry settings."""
+    rate_args = {}
+    if toggl_cfg.has_option('options', 'rate_limit'):
+        rate_args['rate_limit'] = toggl_cfg.getfloat('options', 'rate_limit')
+    if toggl_cfg.has_option('options', 'rate_burst'):
+        rate_args['rate_burst'] = toggl_cfg.getint('options', 'rate_burst')
+    if toggl_cfg.has_option('options', 'max_retries'):
+        rate_args['max_retries'] = toggl_cfg.getint('options', 'max_retries')
+    return rate_args
+
+def get_fetch_options():
+    """Reads how long time entry ranges are split up and fetched."""
+    fetch_args = {}
+    if toggl_cfg.has_option('options', 'fetch_window'):
+        window = toggl_cfg.get('options', 'fetch_window').strip().lower()
+        if window in ('', 'none'):
+            window = None
+        elif window not in FETCH_WINDOWS:
+            print("Ignoring unknown fetch_window %s" % window)
+            window = DEFAULT_FETCH_WINDOW
+        fetch_args['fetch_window'] = window
+    if toggl_cfg.has_option('options', 'fetch_parallel'):
+        fetch_args['fetch_parallel'] = toggl_cfg.getint('options', 'fetch_parallel')
+    return fetch_args
+
+def print_connection_stats():
+    stats = toggl.connection_stats()
+    reuse = 0.0
+    if stats['requests'] > 0:
+        reuse = 100.0 * stats['reused'] / stats['requests']
+    print("Requests: %d, connections opened: %d, reused: %d (%.0f%%)" % \
+            (stats['requests'], stats['connections'], stats['reused'], reuse))
+    print("Throttled: %d, retried: %d" % (stats['throttled'], stats['retried']))
+
+def setup_ls_parser(parser_ls):
     parser_ls.add_argument('-p', '--proj', help='Sort entries by project', action='store_true', default=False)
     parser_ls.add_argument('-s', '--start', help='Specify start date', default=None)
     parser_ls.add_argument('-e', '--end', help='Specify end date', default=None)
@@ -1071,9 +2945,11 @@ def main():
     parser_ls.add_argument('-v', '--verbose-list', help='Show verbose output', action='store_true', default=False)
     parser_ls.add_argument('-q', '--quiet', help='Do not show entries, only sums', action='store_true', default=False)
     parser_ls.add_argument('-S', '--sum', help='Show time summary', action='store_true', default=False)
+    parser_ls.add_argument('-G', '--group', help='Group entries by day, week or month', choices=TogglBuckets.UNITS, default='day')
+    parser_ls.add_argument('-U', '--update-cache', help='Re-download the range into the local entry store', action='store_true', default=False)
     parser_ls.set_defaults(func=list_time_entries)
 
-    parser_add = subparsers.add_parser('add', help='Add a new time entry')
+def setup_add_parser(parser_add):
     parser_add.add_argument('-m', '--msg', help='Log entry message', required=True)
     parser_add.add_argument('-p', '--proj', help='Project for the log entry', default=None)
     parser_add.add_argument('-s', '--start', help='Specify start date', default=None)
@@ -1081,7 +2957,14 @@ def main():
     parser_add.add_argument('-d', '--duration', help='Entry duration', required=False)
     parser_add.set_defaults(func=add_time_entry)
 
-    parser_edit = subparsers.add_parser('edit', help='Edit an existing time entry')
+def setup_import_parser(parser_import):
+    parser_import.add_argument('file', help='CSV or JSONL file to import, or - for stdin')
+    parser_import.add_argument('-f', '--format', help='Input format (default: from the file extension)', choices=['csv', 'jsonl'], default=None)
+    parser_import.add_argument('-j', '--jobs', help='Number of entries to submit concurrently', type=int, default=4)
+    parser_import.add_argument('-c', '--checkpoint', help='Checkpoint file (default: FILE.checkpoint)', default=None)
+    parser_import.set_defaults(func=import_time_entries)
+
+def setup_edit_parser(parser_edit):
     parser_edit.add_argument('-i', '--id', help='The time entry id to edit', required=True)
     parser_edit.add_argument('-m', '--msg', help='Log entry message')
     parser_edit.add_argument('-p', '--proj', help='Project for the log entry')
@@ -1091,11 +2974,15 @@ def main():
     parser_edit.add_argument('-c', '--calc-duration', help='Calculate duration from start/end dates', action='store_true', default=False)
     parser_edit.set_defaults(func=edit_time_entry)
 
-    parser_now = subparsers.add_parser('now', help='Show the current time entry')
+def setup_now_parser(parser_now):
     parser_now.add_argument('-v', '--verbose-list', help='Show verbose output', action='store_true', default=False)
+    parser_now.add_argument('-r', '--refresh', help='Check the running entry with the server', action='store_true', default=False)
+    parser_now.add_argument('-s', '--status', help='Print a compact status line', action='store_true', default=False)
+    parser_now.add_argument('-w', '--watch', help='Keep printing the status line', action='store_true', default=False)
+    parser_now.add_argument('-i', '--interval', help='Seconds between status lines in watch mode', type=float, default=1.0)
     parser_now.set_defaults(func=list_current_time_entry)
 
-    parser_proj = subparsers.add_parser('proj', help='Manage projects')
+def setup_proj_parser(parser_proj):
     parser_proj.add_argument('-l', '--list', help="List projects", action='store_true', default=False)
     parser_proj.add_argument('-A', '--show-archived', help="Override the show-archived setting", action='store_true', default=None)
     parser_proj.add_argument('-a', '--add', help="Add a new project entry", action='store_true', default=False)
@@ -1113,24 +3000,24 @@ def main():
     parser_proj.add_argument('-v', '--verbose-list', help='Show verbose output', action='store_true', default=False)
     parser_proj.set_defaults(func=cmd_project)
 
-    parser_start = subparsers.add_parser('start', help='Start a new time entry')
+def setup_start_parser(parser_start):
     parser_start.add_argument('-m', '--msg', help='Log entry message', required=True)
     parser_start.add_argument('-p', '--proj', help='Project for the log entry')
     parser_start.add_argument('-t', '--time', help='Specify the start date and/or time')
     parser_start.set_defaults(func=start_time_entry)
 
-    parser_stop = subparsers.add_parser('stop', help='Start a new time entry')
+def setup_stop_parser(parser_stop):
     parser_stop.add_argument('-t', '--time', help='Specify the stop time')
     parser_stop.set_defaults(func=stop_time_entry)
 
-    parser_www = subparsers.add_parser('www', help='Open the webpage')
+def setup_www_parser(parser_www):
     parser_www.set_defaults(func=visit_web)
 
-    parser_rm = subparsers.add_parser('rm', help='Remove a time entry')
+def setup_rm_parser(parser_rm):
     parser_rm.add_argument('-i', '--id', help='The id to remove', required=True)
     parser_rm.set_defaults(func=delete_time_entry)
 
-    parser_wspace = subparsers.add_parser('wksp', help='List workspaces')
+def setup_wspace_parser(parser_wspace):
     parser_wspace.add_argument('-i', '--id', help='The workspace id')
     parser_wspace.add_argument('-l', '--list', help='List workspaces', action='store_true', default=False)
     parser_wspace.add_argument('-u', '--user-list', help='List workspace users', action='store_true', default=False)
@@ -1138,7 +3025,7 @@ def main():
     parser_wspace.add_argument('-v', '--verbose-list', help='Show verbose output', action='store_true', default=False)
     parser_wspace.set_defaults(func=cmd_workspace)
 
-    parser_clients = subparsers.add_parser('client', help='Manage clients')
+def setup_clients_parser(parser_clients):
     parser_clients.add_argument('-l', '--list', help='List clients', action='store_true', default=False)
     parser_clients.add_argument('-a', '--add', help='Add a new client entry', action='store_true', default=False)
     parser_clients.add_argument('-u', '--update', help='Update an existing client entry', action='store_true', default=False)
@@ -1152,7 +3039,7 @@ def main():
     parser_clients.add_argument('-v', '--verbose-list', help='Show verbose output', action='store_true', default=False)
     parser_clients.set_defaults(func=cmd_client)
 
-    parser_tasks = subparsers.add_parser('task', help='Manage tasks')
+def setup_tasks_parser(parser_tasks):
     parser_tasks.add_argument('-l', '--list', help='List tasks', action='store_true', default=False)
     parser_tasks.add_argument('-I', '--list-inactive', help='Include inactive tasks in list', action='store_true', default=False)
     parser_tasks.add_argument('-a', '--add', help='Add a new task entry', action='store_true', default=False)
@@ -1167,19 +3054,219 @@ def main():
     parser_tasks.add_argument('-v', '--verbose-list', help='Show verbose output', action='store_true', default=False)
     parser_tasks.set_defaults(func=cmd_task)
 
-    parser_update = subparsers.add_parser('update', help='Update caches')
+def setup_archive_parser(parser_archive):
+    parser_archive.add_argument('action', help='build the archive, report totals from it, or show its contents', choices=['build', 'report', 'info'])
+    parser_archive.add_argument('-s', '--start', help='Specify start date', default=None)
+    parser_archive.add_argument('-e', '--end', help='Specify end date', default=None)
+    parser_archive.add_argument('-g', '--group', help='Report totals by project, description, day, week or month', choices=['project', 'desc', 'day', 'week', 'month'], default='project')
+    parser_archive.add_argument('-f', '--file', help='The archive file', default=None)
+    parser_archive.set_defaults(func=cmd_archive)
+
+def setup_cache_parser(parser_cache):
+    parser_cache.add_argument('action', help='show cache usage, or evict caches down to the budget', choices=['stats', 'evict'])
+    parser_cache.add_argument('-a', '--all', help='Evict every resource cache', action='store_true', default=False)
+    parser_cache.set_defaults(func=cmd_cache)
+
+def setup_completion_parser(parser_completion):
+    parser_completion.add_argument('shell', help='The shell to generate the completion script for', choices=['bash', 'zsh', 'fish'])
+    parser_completion.set_defaults(func=cmd_completion)
+
+def setup_sync_parser(parser_sync):
+    parser_sync.add_argument('-l', '--list', help='List the queued changes instead of sending them', action='store_true', default=False)
+    parser_sync.set_defaults(func=cmd_sync)
+
+def setup_update_parser(parser_update):
+    parser_update.add_argument('-w', '--workspace', help="Only update the caches of this workspace", default=None)
+    parser_update.add_argument('-j', '--jobs', help='Number of caches to refresh at once (at most rate_burst; faster only with a higher rate_limit)', type=int, default=DEFAULT_UPDATE_JOBS)
     parser_update.set_defaults(func=cmd_update)
 
-    global args
-    args = parser.parse_args(sys.argv[1:])
+# Sub-commands as (name, help, setup function). Only the parser for the
+# command being run is populated; see build_parser().
+COMMANDS = [
+    ('ls', 'List time entries', setup_ls_parser),
+    ('add', 'Add a new time entry', setup_add_parser),
+    ('edit', 'Edit an existing time entry', setup_edit_parser),
+    ('import', 'Import time entries from a CSV or JSONL file', setup_import_parser),
+    ('now', 'Show the current time entry', setup_now_parser),
+    ('proj', 'Manage projects', setup_proj_parser),
+    ('start', 'Start a new time entry', setup_start_parser),
+    ('stop', 'Start a new time entry', setup_stop_parser),
+    ('www', 'Open the webpage', setup_www_parser),
+    ('rm', 'Remove a time entry', setup_rm_parser),
+    ('wksp', 'List workspaces', setup_wspace_parser),
+    ('client', 'Manage clients', setup_clients_parser),
+    ('task', 'Manage tasks', setup_tasks_parser),
+    ('update', 'Update caches', setup_update_parser),
+    ('sync', 'Send time entry changes queued offline', setup_sync_parser),
+    ('archive', 'Build or report from the time entry archive', setup_archive_parser),
+    ('cache', 'Show cache usage or evict caches', setup_cache_parser),
+    ('completion', 'Print a shell completion script', setup_completion_parser),
+]
+
+def build_parser(argv):
+    parser = argparse.ArgumentParser(prog='toggl')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
+    parser.add_argument('--conn-stats', action='store_true', help='Show HTTP connection reuse statistics')
+    parser.add_argument('--startup-profile', action='store_true', help='Report the time spent in each import and startup phase')
+    parser.add_argument('--record', help='Record every API request and response to this cassette file', metavar='FILE')
+    parser.add_argument('--replay', help='Answer API requests from this cassette file instead of the server', metavar='FILE')
+    parser.add_argument('--replay-delays', action='store_true', help='Wait as long for each replayed response as it took when recorded')
+
+    subparsers = parser.add_subparsers(help='sub-command help')
+
+    # Registering every sub-command keeps "toggl -h" complete, but adding
+    # their arguments is only worth it for the one that will actually run.
+    command = find_command(argv)
+    for name, help_text, setup in COMMANDS:
+        sub = subparsers.add_parser(name, help=help_text)
+        if name == command:
+            setup(sub)
+
+    return parser
+
+def init_api():
+    """Creates the API client from the configuration."""
+    global IGNORE_START_TIMES
+    auth = (toggl_cfg.get('auth', 'username').strip(), toggl_cfg.get('auth', 'password').strip())
+    IGNORE_START_TIMES = toggl_cfg.getboolean('options', 'ignore_start_times')
+
     global toggl
-    toggl = TogglApi(url=TOGGL_URL, auth=auth, verbose=args.verbose)
+    api_args = get_pool_options()
+    api_args.update(get_fetch_options())
+    api_args.update(get_rate_options())
+    url = TOGGL_URL
+    if toggl_cfg.has_option('options', 'api_url'):
+        url = toggl_cfg.get('options', 'api_url').strip().rstrip('/')
+    toggl = TogglApi(url=url, auth=auth, entry_store=init_entry_store(), **api_args)
+
+def init():
+    """Reads ~/.togglrc and sets up the cache and API client, discarding
+    anything derived from an earlier configuration."""
+    global toggl_tz
+    toggl_tz = None
+    alias_dict.clear()
+    resource_memo.clear()
+    if not init_config() or not init_cache() or not init_journal():
+        return False
+    init_api()
+    return True
 
-    if args.func(args):
+def use_scratch_cache():
+    """Points the cache, journal and entry store at a temporary copy of the
+    cache directory, so that a replayed command leaves the real ones (and
+    the recorded running entry) as they were."""
+    global toggl_cache, scratch_cache
+    path = tempfile.mkdtemp(prefix='toggl-replay.')
+    scratch_cache = (toggl_cache, toggl_journal, toggl.entry_store)
+    toggl_cache = toggl_cache.copy_to(path)
+    if toggl_cfg.has_option('options', 'archive_path'):
+        archive = os.path.expanduser(toggl_cfg.get('options', 'archive_path'))
+        if os.path.exists(archive):
+            shutil.copy(archive, os.path.join(path, 'entries.archive'))
+    init_journal()
+    toggl.entry_store = init_entry_store()
+    resource_memo.clear()
+
+def restore_cache():
+    """Discards the copy made by use_scratch_cache()."""
+    global toggl_cache, toggl_journal, scratch_cache
+    if toggl.entry_store is not None:
+        toggl.entry_store.close()
+    shutil.rmtree(toggl_cache.cache_path, ignore_errors=True)
+    toggl_cache, toggl_journal, toggl.entry_store = scratch_cache
+    scratch_cache = None
+    resource_memo.clear()
+
+def needs_terminal(argv):
+    """Returns whether the command line keeps running until interrupted,
+    such as "now --watch" (or -sw, or --wat), as argparse reads it."""
+    import io
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            parsed = build_parser(argv).parse_args(argv)
+    except SystemExit:
+        return False
+    return bool(getattr(parsed, 'watch', False))
+
+def run_command(argv):
+    """Parses and runs a single command line. Returns the exit code."""
+    parser = build_parser(argv)
+    if STARTUP_PROFILER:
+        STARTUP_PROFILER.mark('build parser')
+
+    global args, journal_queued, refresh_started
+    args = parser.parse_args(argv)
+    toggl.verbose = args.verbose
+    # Per command, as toggld runs many in one process.
+    journal_queued = False
+    refresh_started = False
+
+    if args.record and args.replay:
+        print("--record and --replay cannot be used together")
+        return 1
+    try:
+        if args.record:
+            toggl.cassette = TogglCassette(args.record, 'record')
+        elif args.replay:
+            toggl.cassette = TogglCassette(args.replay, 'replay', delays=args.replay_delays)
+    except (IOError, ValueError) as e:
+        print("Could not open the cassette: %s" % e)
+        return 1
+    if args.replay and toggl_cache.enabled:
+        use_scratch_cache()
+    try:
+        result = run_parsed_command(argv)
+    except TogglReplayError as e:
+        print(e)
+        result = False
+    finally:
+        if toggl.cassette is not None:
+            toggl.cassette.close()
+            toggl.cassette = None
+        if scratch_cache is not None:
+            restore_cache()
+
+    if args.conn_stats:
+        print_connection_stats()
+    if STARTUP_PROFILER:
+        STARTUP_PROFILER.mark('run %s' % find_command(argv))
+        STARTUP_PROFILER.report()
+
+    if result:
         return 0
     else:
         return 1
 
+def run_parsed_command(argv):
+    """Runs the parsed command along with the journal and cache upkeep
+    around it. Returns the command's result."""
+    # Changes queued offline go out before anything else reads from the
+    # server, so that it sees them.
+    if find_command(argv) not in OFFLINE_COMMANDS:
+        send_pending_changes()
+
+    result = args.func(args)
+    if journal_queued:
+        spawn_background('sync')
+    if toggl_cache.enabled:
+        toggl_cache.flush_stats(toggl.entry_store)
+        if names_index_stale():
+            write_names_index()
+        if entries_index_stale():
+            write_entries_index()
+    return result
+
+def main():
+    """Program entry point."""
+    
+    if not init():
+        return 1
+    if STARTUP_PROFILER:
+        STARTUP_PROFILER.mark('read config')
+
+    return run_command(sys.argv[1:])
+
 if __name__ == "__main__":
     sys.exit(main())
 
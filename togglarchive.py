@@ -0,0 +1,189 @@
+"""
+togglarchive.py
+
+Read-only columnar archive of historical time entries. Each field is kept in
+a fixed-width array and descriptions and project names are interned in a
+string table, so reports can mmap the file and scan the columns they need
+without parsing JSON or creating an object per entry.
+"""
+
+import array
+import bisect
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+ARCHIVE_MAGIC = b'TGLA'
+ARCHIVE_VERSION = 1
+ARCHIVE_BIG_ENDIAN = 0x1
+
+# Header: magic, format version, flags, entry count, project count, string
+# count, string data length. The sections follow in this order, each
+# padded to 8 bytes: start, stop, duration and project id columns (int64),
+# description column (uint32 string ids), project ids (int64) and names
+# (uint32 string ids), string offsets (uint32, count + 1) and string data.
+ARCHIVE_HEADER = struct.Struct('<4sHHIIII')
+
+NO_PROJECT = 0
+
+def _padded(size):
+    return (size + 7) & ~7
+
+class TogglArchiveWriter(object):
+    """Collects entries in typed arrays and writes them out as an archive.
+
+    Entries must be added in order of their start time."""
+    def __init__(self):
+        self._start = array.array('q')
+        self._stop = array.array('q')
+        self._duration = array.array('q')
+        self._project = array.array('q')
+        self._desc = array.array('I')
+        self._projects = {}
+        self._strings = []
+        self._string_ids = {}
+
+    def __len__(self):
+        return len(self._start)
+
+    def _intern(self, text):
+        string_id = self._string_ids.get(text)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._strings.append(text)
+            self._string_ids[text] = string_id
+        return string_id
+
+    def add(self, start, stop, duration, desc, project_id=None, project_name=None):
+        if len(self._start) > 0 and start < self._start[-1]:
+            raise ValueError("Archive entries must be added in start order")
+        self._start.append(int(start))
+        self._stop.append(int(stop))
+        self._duration.append(int(duration))
+        self._desc.append(self._intern(desc or ''))
+        if project_id is None:
+            self._project.append(NO_PROJECT)
+        else:
+            self._project.append(int(project_id))
+            self._projects[int(project_id)] = self._intern(project_name or '')
+
+    def write(self, path):
+        """Writes the archive to path, replacing any existing file at once."""
+        project_ids = array.array('q', sorted(self._projects))
+        project_names = array.array('I', [self._projects[p] for p in project_ids])
+
+        data = [s.encode('utf-8') for s in self._strings]
+        offsets = array.array('I', [0])
+        for d in data:
+            offsets.append(offsets[-1] + len(d))
+        blob = b''.join(data)
+
+        flags = ARCHIVE_BIG_ENDIAN if sys.byteorder == 'big' else 0
+        sections = [self._start, self._stop, self._duration, self._project,
+                self._desc, project_ids, project_names, offsets]
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                prefix='.%s.' % os.path.basename(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, flags,
+                        len(self._start), len(project_ids), len(self._strings), len(blob)))
+                f.write(b'\0' * (_padded(ARCHIVE_HEADER.size) - ARCHIVE_HEADER.size))
+                for section in sections:
+                    raw = section.tobytes()
+                    f.write(raw)
+                    f.write(b'\0' * (_padded(len(raw)) - len(raw)))
+                f.write(blob)
+            os.replace(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+class TogglArchive(object):
+    """A memory-mapped archive. The columns (start, stop, duration, project
+    and desc) are memoryviews over the file, indexed by entry position and
+    sorted by start time."""
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._load()
+        except:
+            self.close()
+            raise
+
+    def _load(self):
+        if len(self._mm) < ARCHIVE_HEADER.size:
+            raise ValueError("%s is not a time entry archive" % self._path)
+        (magic, version, flags, count, nprojects, nstrings, blob_len) = \
+                ARCHIVE_HEADER.unpack_from(self._mm)
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            raise ValueError("%s is not a time entry archive" % self._path)
+        if bool(flags & ARCHIVE_BIG_ENDIAN) != (sys.byteorder == 'big'):
+            raise ValueError("%s was built on a machine of different byte order" % self._path)
+
+        view = memoryview(self._mm)
+        self._views = [view]
+        self._offset = _padded(ARCHIVE_HEADER.size)
+
+        def section(fmt, n):
+            size = struct.calcsize(fmt) * n
+            # Checked before casting, which fails on a short view.
+            if self._offset + size > len(self._mm):
+                raise ValueError("%s is truncated" % self._path)
+            column = view[self._offset:self._offset + size].cast(fmt)
+            self._views.append(column)
+            self._offset += _padded(size)
+            return column
+
+        self.start = section('q', count)
+        self.stop = section('q', count)
+        self.duration = section('q', count)
+        self.project = section('q', count)
+        self.desc = section('I', count)
+        self._project_ids = section('q', nprojects)
+        self._project_names = section('I', nprojects)
+        self._string_offsets = section('I', nstrings + 1)
+        self._blob = self._offset
+        if self._blob + blob_len > len(self._mm):
+            raise ValueError("%s is truncated" % self._path)
+        if self._string_offsets[-1] != blob_len:
+            raise ValueError("%s is corrupt" % self._path)
+
+    def __len__(self):
+        return len(self.start)
+
+    def close(self):
+        # The mmap cannot be closed while memoryviews still refer to it.
+        for view in reversed(getattr(self, '_views', [])):
+            view.release()
+        self._views = []
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def span(self, low=None, high=None):
+        """Returns the (first, end) positions of the entries starting
+        between the epochs low and high."""
+        first = 0 if low is None else bisect.bisect_left(self.start, low)
+        end = len(self) if high is None else bisect.bisect_right(self.start, high)
+        return (first, max(first, end))
+
+    def string(self, string_id):
+        begin = self._blob + self._string_offsets[string_id]
+        end = self._blob + self._string_offsets[string_id + 1]
+        return self._mm[begin:end].decode('utf-8')
+
+    def project_name(self, project_id):
+        """Returns the name of the project, or None for entries without one."""
+        i = bisect.bisect_left(self._project_ids, project_id)
+        if i == len(self._project_ids) or self._project_ids[i] != project_id:
+            return None
+        return self.string(self._project_names[i])
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+togglbench.py
+
+End-to-end benchmark of toggl.py against togglserver.py. It starts the
+stand-in server, gives toggl.py a throwaway home directory pointing at it,
+and runs each workload as its own process, reporting the wall time, the
+number of API requests made and the peak RSS of every run. Nothing goes
+over the network.
+
+The first round of runs starts with empty caches ("cold"); later rounds
+show the steady state ("warm").
+
+Usage: togglbench.py [-r RUNS] [-w WORKLOAD,...] [--entries N] [--projects N]
+                     [--latency MS] [--error-rate P] [--json]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from urllib.request import urlopen
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOGGL = os.path.join(HERE, 'toggl.py')
+SERVER = os.path.join(HERE, 'togglserver.py')
+
+TOGGLRC = """[auth]
+username = bench@example.com
+password = bench
+
+[options]
+api_url = %(api_url)s
+timezone = UTC
+ignore_start_times = False
+datefmt = %%Y-%%m-%%d (%%A)
+entry_datefmt = %%Y-%%m-%%d %%H:%%M%%p
+use_mandays = False
+show_archived_projects = False
+cache_enabled = True
+max_cache_age_days = 1
+rate_limit = 0
+"""
+
+def days_ago(days):
+    return (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+
+def write_import_file(path, rows):
+    """Writes a CSV of rows entries for the import workload."""
+    start = datetime.datetime(2000, 1, 1, 9, 0)
+    with open(path, 'w') as f:
+        f.write("description,project,start,duration\n")
+        for i in range(rows):
+            f.write("Imported %d,Project 00001,%s,1800\n" % \
+                    (i, (start + datetime.timedelta(hours=i)).strftime('%Y-%m-%d %H:%M')))
+
+class Bench(object):
+    """A benchmark session: the server, the home directory toggl.py runs
+    in and the results collected so far."""
+    def __init__(self, args):
+        self.args = args
+        self.home = tempfile.mkdtemp(prefix='togglbench.')
+        self.server = None
+        self.server_url = None
+        self.results = {}
+        self.import_file = os.path.join(self.home, 'import.csv')
+        write_import_file(self.import_file, args.import_size)
+
+    # Workloads as (name, command line). The server's time entries are
+    # reset after every round, so each round sees the same account (start
+    # and stop cancel out, but import adds its entries again).
+    def workloads(self):
+        return [
+            ('ls', ['ls']),
+            ('ls-month', ['ls', '-s', days_ago(30)]),
+            ('ls-year', ['ls', '-q', '-S', '-s', days_ago(365)]),
+            ('now', ['now']),
+            ('proj', ['proj', '-l']),
+            ('start', ['start', '-m', 'Benchmark', '-p', 'Project 00001']),
+            ('stop', ['stop']),
+            ('update', ['update']),
+            ('import', ['import', self.import_file, '-c', self.import_file + '.checkpoint']),
+            ('archive', ['archive', 'build', '-s', days_ago(365)]),
+            ('report', ['archive', 'report']),
+        ]
+
+    def start_server(self):
+        args = self.args
+        argv = [sys.executable, SERVER, '-p', '0',
+                '--projects', str(args.projects), '--entries', str(args.entries),
+                '--days', str(args.days), '--latency', str(args.latency),
+                '--jitter', str(args.jitter), '--error-rate', str(args.error_rate),
+                '--seed', '1']
+        self.server = subprocess.Popen(argv, stdout=subprocess.PIPE)
+        line = self.server.stdout.readline().decode('utf-8').strip()
+        if not line.startswith('Listening on '):
+            raise RuntimeError("togglserver.py did not start")
+        api_url = line[len('Listening on '):]
+        self.server_url = api_url[:-len('/api')]
+        with open(os.path.join(self.home, '.togglrc'), 'w') as f:
+            f.write(TOGGLRC % {'api_url': api_url})
+
+    def requests(self):
+        stats = urlopen(self.server_url + '/_stats').read().decode('utf-8')
+        return json.loads(stats)['requests']
+
+    def reset(self):
+        """Undoes the changes the workloads made to the time entries."""
+        urlopen(self.server_url + '/_reset', data=b'').read()
+
+    def run(self, name, argv):
+        """Runs toggl.py once; returns (wall time, requests, peak RSS in
+        bytes, exit code)."""
+        checkpoint = self.import_file + '.checkpoint'
+        if name == 'import' and os.path.exists(checkpoint):
+            os.unlink(checkpoint)
+
+        env = dict(os.environ)
+        env['HOME'] = self.home
+        env['TOGGL_NO_DAEMON'] = '1'
+        before = self.requests()
+        with open(os.path.join(self.home, 'bench.log'), 'a') as log:
+            log.write("$ toggl %s\n" % ' '.join(argv))
+            log.flush()
+            started = time.time()
+            proc = subprocess.Popen([sys.executable, TOGGL] + argv, env=env,
+                    stdout=log, stderr=log, cwd=self.home)
+            pid, status, usage = os.wait4(proc.pid, 0)
+            wall = time.time() - started
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        # ru_maxrss is in kilobytes, except on macOS.
+        rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+        return (wall, self.requests() - before, rss, proc.returncode)
+
+    def run_all(self, names):
+        workloads = [w for w in self.workloads() if w[0] in names]
+        for round_no in range(self.args.runs):
+            for name, argv in workloads:
+                self.results.setdefault(name, []).append(self.run(name, argv))
+            self.reset()
+
+    def report(self):
+        rows = []
+        for name, argv in self.workloads():
+            runs = self.results.get(name)
+            if not runs:
+                continue
+            warm = sorted(r[0] for r in runs[1:])
+            rows.append({
+                'workload': name,
+                'runs': len(runs),
+                'cold_secs': runs[0][0],
+                'warm_secs': warm[len(warm) // 2] if warm else None,
+                'cold_requests': runs[0][1],
+                'warm_requests': runs[-1][1] if len(runs) > 1 else None,
+                'peak_rss': max(r[2] for r in runs),
+                'failed': sum(1 for r in runs if r[3] != 0),
+            })
+        return rows
+
+    def close(self):
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+        if self.args.keep:
+            print("Kept %s (see bench.log)" % self.home)
+        else:
+            shutil.rmtree(self.home, ignore_errors=True)
+
+def print_report(rows):
+    print("%-10s %4s %8s %8s %10s %9s  %s" % \
+            ('Workload', 'Runs', 'Cold', 'Warm', 'Requests', 'Peak RSS', 'Failed'))
+    for row in rows:
+        warm = '-' if row['warm_secs'] is None else "%.3fs" % row['warm_secs']
+        requests = "%d" % row['cold_requests']
+        if row['warm_requests'] is not None:
+            requests += "/%d" % row['warm_requests']
+        print("%-10s %4d %7.3fs %8s %10s %6.1f MB  %s" % (row['workload'], row['runs'],
+                row['cold_secs'], warm, requests, row['peak_rss'] / (1024.0 * 1024),
+                row['failed'] or ''))
+
+def main():
+    parser = argparse.ArgumentParser(prog='togglbench.py',
+            description='Benchmark toggl.py end to end against togglserver.py.')
+    parser.add_argument('-r', '--runs', help='Rounds of runs of each workload', type=int, default=3)
+    parser.add_argument('-w', '--workloads', help='Comma separated workloads to run (default: all)', default=None)
+    parser.add_argument('--entries', help='Time entries on the server', type=int, default=100000)
+    parser.add_argument('--projects', help='Projects on the server', type=int, default=1000)
+    parser.add_argument('--days', help='Days the time entries are spread over', type=float, default=365)
+    parser.add_argument('--latency', help='Server latency per request in milliseconds', type=float, default=0)
+    parser.add_argument('--jitter', help='Extra random server latency in milliseconds', type=float, default=0)
+    parser.add_argument('--error-rate', help='Fraction of requests the server fails', type=float, default=0)
+    parser.add_argument('--import-size', help='Entries added by the import workload', type=int, default=200)
+    parser.add_argument('--json', help='Print the results as JSON', action='store_true', default=False)
+    parser.add_argument('--keep', help='Keep the home directory and its log', action='store_true', default=False)
+    args = parser.parse_args()
+
+    bench = Bench(args)
+    known = [name for name, argv in bench.workloads()]
+    selected = known
+    if args.workloads:
+        selected = [w.strip() for w in args.workloads.split(',') if w.strip()]
+        unknown = [w for w in selected if w not in known]
+        if unknown:
+            bench.close()
+            parser.error("unknown workloads: %s (choose from %s)" % \
+                    (', '.join(unknown), ', '.join(known)))
+
+    try:
+        bench.start_server()
+        bench.run_all(selected)
+    finally:
+        bench.close()
+
+    rows = bench.report()
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_report(rows)
+    return 1 if any(row['failed'] for row in rows) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+toggld.py
+
+Optional background server for toggl.py. It keeps the configuration, the
+parsed caches, the entry store and pooled HTTP connections alive between
+commands. toggl.py forwards its command line over a Unix socket whenever
+the daemon is running, and runs the command itself otherwise.
+
+Usage: toggld.py [run|start|stop|status]
+"""
+
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import time
+import traceback
+
+import toggl
+
+# Seconds to wait for a client to send its request, and for a control
+# request to be answered.
+REQUEST_TIMEOUT = 10
+CONTROL_TIMEOUT = 5
+
+class TogglDaemon(object):
+    """Runs toggl.py commands in this process, one at a time, and reloads
+    the configuration whenever ~/.togglrc changes."""
+    def __init__(self):
+        self._config_mtime = None
+        self._started = time.time()
+        self._served = 0
+        self.running = True
+
+    def _config_path(self):
+        return os.path.expanduser('~/.togglrc')
+
+    def reload_if_changed(self):
+        try:
+            mtime = os.path.getmtime(self._config_path())
+        except OSError:
+            mtime = None
+        if mtime == self._config_mtime and getattr(toggl, 'toggl', None) is not None:
+            return True
+
+        api = getattr(toggl, 'toggl', None)
+        if api is not None:
+            api.close()
+            if api.entry_store is not None:
+                api.entry_store.close()
+        if not toggl.init():
+            return False
+        self._config_mtime = mtime
+        return True
+
+    def status(self):
+        return "toggld pid %d, up %ds, %d commands served" % \
+                (os.getpid(), time.time() - self._started, self._served)
+
+    def handle(self, request):
+        """Runs the request and returns the reply sent back to the client."""
+        control = request.get('control')
+        if control == 'stop':
+            self.running = False
+            return {'code': 0, 'stdout': "toggld stopping\n"}
+        elif control == 'status':
+            return {'code': 0, 'stdout': self.status() + "\n"}
+
+        out = io.StringIO()
+        err = io.StringIO()
+        code = 1
+        real_stdout, real_stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = out, err
+        try:
+            os.chdir(request.get('cwd') or os.path.expanduser('~'))
+            if self.reload_if_changed():
+                argv = request.get('argv') or []
+                if toggl.needs_terminal(argv):
+                    # The client runs it itself.
+                    return {'local': True}
+                code = toggl.run_command(argv)
+        except SystemExit as e:
+            # argparse exits on -h and on usage errors.
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            sys.stdout, sys.stderr = real_stdout, real_stderr
+
+        if code != 0:
+            # A failed command may have modified cached objects in place.
+            toggl.resource_memo.clear()
+        self._served += 1
+        return {'code': code, 'stdout': out.getvalue(), 'stderr': err.getvalue()}
+
+class TogglRequestHandler(socketserver.StreamRequestHandler):
+    # A client that never finishes its request must not hold up the others.
+    timeout = REQUEST_TIMEOUT
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return
+        reply = self.server.daemon.handle(request)
+        self.wfile.write(json.dumps(reply).encode('utf-8'))
+
+class TogglServer(socketserver.UnixStreamServer):
+    # Commands share toggl.py's globals, so requests are served one at a
+    # time on the main thread.
+    def __init__(self, path, daemon):
+        self.daemon = daemon
+        socketserver.UnixStreamServer.__init__(self, path, TogglRequestHandler)
+
+def send_control(path, control):
+    """Sends a control request to a running daemon; returns its reply or
+    None if none is running."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONTROL_TIMEOUT)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({'control': control}).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        data = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return json.loads(data.decode('utf-8'))
+    except socket.timeout:
+        # Running, but busy with (or stuck on) another command.
+        return {'code': 1, 'stdout': "toggld is not responding.\n"}
+    except (OSError, ValueError):
+        return None
+    finally:
+        sock.close()
+
+def serve(path):
+    if send_control(path, 'status') is not None:
+        print("toggld is already running.")
+        return 1
+    if os.path.exists(path):
+        os.unlink(path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    toggl.in_daemon = True
+    daemon = TogglDaemon()
+    if not daemon.reload_if_changed():
+        return 1
+
+    server = TogglServer(path, daemon)
+    os.chmod(path, 0o600)
+    try:
+        while daemon.running:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+    return 0
+
+def main():
+    path = toggl.daemon_socket_path()
+    action = sys.argv[1] if len(sys.argv) > 1 else 'run'
+
+    if action == 'run':
+        return serve(path)
+    elif action == 'start':
+        if send_control(path, 'status') is not None:
+            print("toggld is already running.")
+            return 1
+        import subprocess
+        devnull = subprocess.DEVNULL
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), 'run'],
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True, start_new_session=True)
+        for i in range(50):
+            if send_control(path, 'status') is not None:
+                print("toggld started.")
+                return 0
+            time.sleep(0.1)
+        print("toggld did not start; run \"toggld.py run\" to see why.")
+        return 1
+    elif action in ('stop', 'status'):
+        reply = send_control(path, action)
+        if reply is None:
+            print("toggld is not running.")
+            return 1
+        sys.stdout.write(reply['stdout'])
+        return reply.get('code', 0)
+
+    print(__doc__.strip().splitlines()[-1])
+    return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
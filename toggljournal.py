@@ -0,0 +1,131 @@
+"""
+toggljournal.py
+
+Write-ahead journal of time entry changes. With offline_journal enabled,
+toggl.py appends each added, updated or deleted entry here and returns at
+once; the changes are sent to the server later by "toggl sync" or by the
+next command that goes online.
+"""
+
+import json
+import os
+import tempfile
+import time
+import uuid
+
+JOURNAL_OPS = ('add', 'update', 'delete')
+
+class TogglJournal(object):
+    """An append-only JSONL file of changes and their acknowledgements.
+
+    A change is {"key", "op", "id", "fields", "queued"}. Its key is unique
+    and, for an added entry, stands in for the entry's id until the server
+    has assigned one. Once a change has been sent an {"ack": key, "id": id}
+    record follows it. An {"attempt": key} record is written before an add
+    is sent, so an add that may already have reached the server is looked
+    for there before it is sent again.
+
+    The journal does no locking itself: callers must keep compact() from
+    running alongside appends, and only flush from one process at a time.
+    """
+    def __init__(self, path):
+        self._path = os.path.expanduser(path)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _append(self, record):
+        # The change must be on disk before the command reports success.
+        with open(self._path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, op, entry_id=None, fields=None):
+        """Queues a change and returns its record."""
+        if op not in JOURNAL_OPS:
+            raise ValueError("Unknown journal operation %s" % op)
+        record = {'key': uuid.uuid4().hex, 'op': op, 'queued': time.time()}
+        if entry_id is not None:
+            record['id'] = entry_id
+        if fields is not None:
+            record['fields'] = fields
+        self._append(record)
+        return record
+
+    def ack(self, key, entry_id=None):
+        """Marks a change as sent. entry_id is the server id of an added
+        entry, or None if the change was dropped."""
+        self._append({'ack': key, 'id': entry_id})
+
+    def attempt(self, key):
+        self._append({'attempt': key})
+
+    def has_pending(self):
+        """Returns whether anything may be waiting to be sent. The journal
+        is emptied by compact() once everything has been, so this only
+        needs a stat."""
+        try:
+            return os.path.getsize(self._path) > 0
+        except OSError:
+            return False
+
+    def read(self):
+        """Returns the changes not yet sent, in order, a dict of the acked
+        changes' ids by key and the set of keys of attempted adds."""
+        changes = []
+        ids = {}
+        attempted = set()
+        try:
+            f = open(self._path, 'r')
+        except IOError:
+            return (changes, ids, attempted)
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A write cut short by a crash; it was never reported
+                    # as queued.
+                    continue
+                if 'ack' in record:
+                    ids[record['ack']] = record.get('id')
+                elif 'attempt' in record:
+                    attempted.add(record['attempt'])
+                elif record.get('op') in JOURNAL_OPS:
+                    changes.append(record)
+        pending = [c for c in changes if c['key'] not in ids]
+        return (pending, ids, attempted)
+
+    def compact(self):
+        """Rewrites the journal with only the changes still to be sent and
+        what they need: the ids of the adds they refer to and the attempts
+        already made."""
+        pending, ids, attempted = self.read()
+        if not pending:
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+            return
+
+        keys = set(c['key'] for c in pending)
+        lines = []
+        for change in pending:
+            ref = change.get('id')
+            if ref in ids:
+                lines.append({'ack': ref, 'id': ids[ref]})
+        lines.extend({'attempt': key} for key in sorted(attempted & keys))
+        lines.extend(pending)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._path) or '.',
+                prefix='.%s.' % os.path.basename(self._path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for record in lines:
+                    f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._path)
+        except:
+            os.unlink(tmp_path)
+            raise
@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+"""
+togglserver.py
+
+Local stand-in for the Toggl v6 API, for benchmarking and trying out
+toggl.py without network access. It serves the endpoints toggl.py uses from
+a synthetic dataset of any size. Workspaces, clients, projects, tasks and
+users are built at startup; time entries are generated on demand from their
+position in the timeline, so a million of them cost no memory until they
+are changed.
+
+Point toggl.py at it with api_url=http://127.0.0.1:PORT/api in ~/.togglrc.
+GET /_stats returns the number of requests served, in total and by route;
+POST /_reset undoes every change made to the time entries.
+
+Usage: togglserver.py [-p PORT] [--projects N] [--entries N] [--latency MS]
+                      [--error-rate P] (see -h for the rest)
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+API_PREFIX = '/api/v6'
+
+# Ids of each kind of object start at their own base, so that ids never
+# collide and are easy to tell apart in logs.
+WORKSPACE_ID_BASE = 1
+CLIENT_ID_BASE = 10000
+PROJECT_ID_BASE = 100000
+TASK_ID_BASE = 1000000
+USER_ID_BASE = 2000000
+ENTRY_ID_BASE = 100000000
+# Objects added through the API, other than time entries.
+ADDED_ID_BASE = 900000000
+
+# Without a date range, v6 returns the entries of the last nine days.
+RECENT_ENTRY_DAYS = 9
+
+ENTRY_WORDS = ['Planning', 'Review', 'Meeting', 'Coding', 'Testing', 'Support',
+        'Design', 'Docs', 'Research', 'Email']
+
+UTC = datetime.timezone.utc
+
+def format_time(epoch):
+    return datetime.datetime.fromtimestamp(epoch, UTC).isoformat()
+
+def parse_time(text):
+    value = datetime.datetime.fromisoformat(text.replace('Z', '+00:00').replace(' ', 'T', 1))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=UTC)
+    return value.timestamp()
+
+def parse_ids(value):
+    """Returns the ids of an archive or open request, sent as a list or as
+    a comma separated string."""
+    if isinstance(value, list):
+        return [int(i) for i in value]
+    return [int(i) for i in re.split(r'[\s,]+', str(value).strip()) if i]
+
+class TogglDataset(object):
+    """The synthetic account served by the server.
+
+    Time entry k (0 <= k < entries) starts at a fixed step through the
+    days before end and is derived from k alone. Changed, deleted and added
+    entries are kept in small overlays on top of the generated ones."""
+    def __init__(self, workspaces=2, clients=20, projects=200, tasks=100,
+            users=5, entries=10000, days=365, end=None):
+        self._lock = threading.RLock()
+        self.workspaces = [{'id': WORKSPACE_ID_BASE + i, 'name': "Workspace %d" % (i + 1),
+                'profile_name': 'Pro', 'current_user_is_admin': i == 0}
+                for i in range(workspaces)]
+        self.clients = [{'id': CLIENT_ID_BASE + i, 'name': "Client %05d" % (i + 1),
+                'workspace': self._workspace_ref(i), 'hourly_rate': 50, 'currency': 'EUR'}
+                for i in range(clients)]
+        self.projects = []
+        for i in range(projects):
+            project = {'id': PROJECT_ID_BASE + i, 'name': "Project %05d" % (i + 1),
+                    'workspace': self._workspace_ref(i), 'is_active': True,
+                    'billable': i % 3 == 0, 'estimated_workhours': None,
+                    'automatically_calculate_estimated_workhours': False}
+            if clients:
+                project['client'] = dict(self.clients[i % clients])
+            self.projects.append(project)
+        self.tasks = [{'id': TASK_ID_BASE + i, 'name': "Task %05d" % (i + 1),
+                'workspace': self._workspace_ref(i), 'is_active': i % 10 != 0,
+                'estimated_seconds': 3600 * (i % 8),
+                'project': self._project_ref(i)}
+                for i in range(tasks)]
+        self.users = [{'id': USER_ID_BASE + i, 'name': "User %d" % (i + 1),
+                'fullname': "User %d" % (i + 1), 'email': "user%d@example.com" % (i + 1)}
+                for i in range(users)]
+
+        self.num_entries = entries
+        self.end = int(end if end is not None else time.time()) // 3600 * 3600
+        self.span = int(days * 24 * 3600)
+        self.first = self.end - self.span
+        self._changed = {}
+        self._deleted = set()
+        self._added = {}
+        self._next_id = ENTRY_ID_BASE + entries
+        self._next_object_id = ADDED_ID_BASE
+
+    def _workspace_ref(self, i):
+        return dict(self.workspaces[i % len(self.workspaces)]) if self.workspaces else None
+
+    def _project_ref(self, i):
+        if not self.projects:
+            return None
+        project = self.projects[i % len(self.projects)]
+        return {'id': project['id'], 'name': project['name']}
+
+    # Generated time entries
+
+    def _entry_start(self, k):
+        return self.first + k * self.span // self.num_entries
+
+    def _first_index(self, low):
+        """Returns the index of the first generated entry starting at or
+        after low."""
+        if low <= self.first:
+            return 0
+        k = min(int((low - self.first) * self.num_entries // self.span), self.num_entries)
+        while k > 0 and self._entry_start(k - 1) >= low:
+            k -= 1
+        while k < self.num_entries and self._entry_start(k) < low:
+            k += 1
+        return k
+
+    def _generate(self, k):
+        start = self._entry_start(k)
+        step = max(self.span // max(self.num_entries, 1), 60)
+        duration = 60 + (k * 7919) % max(min(step, 4 * 3600) - 60, 1)
+        fields = {'id': ENTRY_ID_BASE + k, 'start': format_time(start),
+                'stop': format_time(start + duration), 'duration': duration,
+                'description': "%s %d" % (ENTRY_WORDS[k % len(ENTRY_WORDS)], k % 97),
+                'billable': False, 'created_with': 'togglserver'}
+        project = self._project_ref(k * 31)
+        if project is not None:
+            fields['project'] = project
+        return fields
+
+    def _entry_index(self, entry_id):
+        k = entry_id - ENTRY_ID_BASE
+        if 0 <= k < self.num_entries:
+            return k
+        return None
+
+    def entries(self, low, high):
+        """Returns the entries starting between the epochs low and high."""
+        with self._lock:
+            found = []
+            k = self._first_index(low)
+            while k < self.num_entries and self._entry_start(k) <= high:
+                entry_id = ENTRY_ID_BASE + k
+                if entry_id not in self._deleted and entry_id not in self._changed:
+                    found.append(self._generate(k))
+                k += 1
+            # Changed entries may have been moved in or out of the range.
+            for fields in list(self._added.values()) + list(self._changed.values()):
+                if low <= parse_time(fields['start']) <= high:
+                    found.append(fields)
+            found.sort(key=lambda f: (parse_time(f['start']), f['id']))
+            return found
+
+    def entry(self, entry_id):
+        with self._lock:
+            if entry_id in self._deleted:
+                return None
+            if entry_id in self._changed:
+                return self._changed[entry_id]
+            if entry_id in self._added:
+                return self._added[entry_id]
+            k = self._entry_index(entry_id)
+            return None if k is None else self._generate(k)
+
+    def add_entry(self, fields):
+        with self._lock:
+            fields = dict(fields)
+            fields['id'] = self._next_id
+            self._next_id += 1
+            self._added[fields['id']] = fields
+            return fields
+
+    def update_entry(self, entry_id, changes):
+        with self._lock:
+            fields = self.entry(entry_id)
+            if fields is None:
+                return None
+            fields = dict(fields)
+            fields.update(changes)
+            fields['id'] = entry_id
+            if entry_id in self._added:
+                self._added[entry_id] = fields
+            else:
+                self._changed[entry_id] = fields
+            return fields
+
+    def delete_entry(self, entry_id):
+        with self._lock:
+            if self.entry(entry_id) is None:
+                return False
+            self._added.pop(entry_id, None)
+            self._changed.pop(entry_id, None)
+            self._deleted.add(entry_id)
+            return True
+
+    def reset_entries(self):
+        """Drops every added, changed and deleted entry. Ids are not
+        reused."""
+        with self._lock:
+            self._changed = {}
+            self._deleted = set()
+            self._added = {}
+
+    # Other resources
+
+    def collection(self, name):
+        return getattr(self, name)
+
+    def add(self, name, fields):
+        with self._lock:
+            fields = dict(fields)
+            fields['id'] = self._next_object_id
+            self._next_object_id += 1
+            self.collection(name).append(fields)
+            return fields
+
+    def update(self, name, item_id, changes):
+        with self._lock:
+            for item in self.collection(name):
+                if item['id'] == item_id:
+                    item.update(changes)
+                    item['id'] = item_id
+                    return item
+            return None
+
+    def delete(self, name, item_id):
+        with self._lock:
+            items = self.collection(name)
+            for i, item in enumerate(items):
+                if item['id'] == item_id:
+                    del items[i]
+                    return True
+            return False
+
+    def set_active(self, item_ids, active):
+        with self._lock:
+            ids = set(item_ids)
+            for project in self.projects:
+                if project['id'] in ids:
+                    project['is_active'] = active
+
+class TogglRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so toggl.py's connection pool is exercised as it would be
+    # against the real API.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    def _send(self, status, obj=None, headers=None):
+        body = b''
+        if obj is not None:
+            body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_data(self, data):
+        """Sends {"data": data}, or a 304 if the client already has it."""
+        body = json.dumps({'data': data}).encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length).decode('utf-8')) or {}
+        except ValueError:
+            return {}
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self._body()
+        path = url.path
+        if path == '/_stats':
+            return self._send(200, self.server.stats())
+        if path == '/_reset' and method == 'POST':
+            self.server.dataset.reset_entries()
+            return self._send(200, {})
+        if not path.startswith(API_PREFIX):
+            return self._send(404)
+        path = path[len(API_PREFIX):]
+
+        for route_method, pattern, name, label in ROUTES:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            self.server.count('%s (unknown)' % method)
+            return self._send(404)
+
+        self.server.count('%s %s' % (method, label))
+        self.server.delay()
+        if self.server.should_fail():
+            return self._send(self.server.error_status, headers={'Retry-After': '0'})
+        getattr(self, 'handle_' + name)(query, body, *[int(g) for g in match.groups()])
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    # Endpoints
+
+    def handle_workspaces(self, query, body):
+        self._send_data(self.server.dataset.workspaces)
+
+    def handle_workspace_projects(self, query, body, wsp_id):
+        self._send_data([p for p in self.server.dataset.projects
+                if p['workspace']['id'] == wsp_id])
+
+    def handle_workspace_clients(self, query, body, wsp_id):
+        self._send_data([c for c in self.server.dataset.clients
+                if c['workspace']['id'] == wsp_id])
+
+    def handle_workspace_users(self, query, body, wsp_id):
+        self._send_data(self.server.dataset.users)
+
+    def handle_projects(self, query, body):
+        self._send_data(self.server.dataset.projects)
+
+    def handle_clients(self, query, body):
+        self._send_data(self.server.dataset.clients)
+
+    def handle_tasks(self, query, body):
+        active = query.get('active', ['true'])[0]
+        tasks = self.server.dataset.tasks
+        if active != 'both':
+            tasks = [t for t in tasks if t['is_active'] == (active == 'true')]
+        self._send_data(tasks)
+
+    def _add(self, name, key, body):
+        self._send(200, {'data': self.server.dataset.add(name, body.get(key) or {})})
+
+    def _update(self, name, key, body, item_id):
+        item = self.server.dataset.update(name, item_id, body.get(key) or {})
+        if item is None:
+            return self._send(404)
+        self._send(200, {'data': item})
+
+    def _delete(self, name, item_id):
+        if not self.server.dataset.delete(name, item_id):
+            return self._send(404)
+        self._send(200, {'data': None})
+
+    def handle_add_project(self, query, body):
+        self._add('projects', 'project', body)
+
+    def handle_update_project(self, query, body, project_id):
+        self._update('projects', 'project', body, project_id)
+
+    def handle_archive_projects(self, query, body):
+        self.server.dataset.set_active(parse_ids(body.get('id', [])), False)
+        self._send(200, {'data': None})
+
+    def handle_open_projects(self, query, body):
+        self.server.dataset.set_active(parse_ids(body.get('id', [])), True)
+        self._send(200, {'data': None})
+
+    def handle_add_client(self, query, body):
+        self._add('clients', 'client', body)
+
+    def handle_update_client(self, query, body, client_id):
+        self._update('clients', 'client', body, client_id)
+
+    def handle_delete_client(self, query, body, client_id):
+        self._delete('clients', client_id)
+
+    def handle_add_task(self, query, body):
+        self._add('tasks', 'task', body)
+
+    def handle_update_task(self, query, body, task_id):
+        self._update('tasks', 'task', body, task_id)
+
+    def handle_delete_task(self, query, body, task_id):
+        self._delete('tasks', task_id)
+
+    def handle_time_entries(self, query, body):
+        # As in v6, start_date is the earlier bound and end_date the later.
+        dataset = self.server.dataset
+        if 'start_date' in query and 'end_date' in query:
+            try:
+                low = parse_time(query['start_date'][0])
+                high = parse_time(query['end_date'][0])
+            except ValueError:
+                return self._send(400)
+        else:
+            high = time.time()
+            low = high - RECENT_ENTRY_DAYS * 24 * 3600
+        self._send(200, {'data': dataset.entries(low, high)})
+
+    def handle_add_time_entry(self, query, body):
+        self._send(200, {'data': self.server.dataset.add_entry(body.get('time_entry') or {})})
+
+    def handle_time_entry(self, query, body, entry_id):
+        fields = self.server.dataset.entry(entry_id)
+        if fields is None:
+            return self._send(404)
+        self._send(200, {'data': fields})
+
+    def handle_update_time_entry(self, query, body, entry_id):
+        fields = self.server.dataset.update_entry(entry_id, body.get('time_entry') or {})
+        if fields is None:
+            return self._send(404)
+        self._send(200, {'data': fields})
+
+    def handle_delete_time_entry(self, query, body, entry_id):
+        if not self.server.dataset.delete_entry(entry_id):
+            return self._send(404)
+        self._send(200, {'data': None})
+
+# (method, path pattern, handler name, label for the stats); paths are
+# relative to API_PREFIX.
+ROUTES = [(method, re.compile('^%s$' % pattern), name,
+        pattern.replace(r'(\d+)', '{id}').replace('\\', '')) for method, pattern, name in [
+    ('GET', r'/workspaces\.json', 'workspaces'),
+    ('GET', r'/workspaces/(\d+)/projects\.json', 'workspace_projects'),
+    ('GET', r'/workspaces/(\d+)/clients\.json', 'workspace_clients'),
+    ('GET', r'/workspaces/(\d+)/users\.json', 'workspace_users'),
+    ('GET', r'/projects\.json', 'projects'),
+    ('POST', r'/projects\.json', 'add_project'),
+    ('PUT', r'/projects/archive\.json', 'archive_projects'),
+    ('PUT', r'/projects/open\.json', 'open_projects'),
+    ('PUT', r'/projects/(\d+)\.json', 'update_project'),
+    ('GET', r'/clients\.json', 'clients'),
+    ('POST', r'/clients\.json', 'add_client'),
+    ('PUT', r'/clients/(\d+)\.json', 'update_client'),
+    ('DELETE', r'/clients/(\d+)\.json', 'delete_client'),
+    ('GET', r'/tasks\.json', 'tasks'),
+    ('POST', r'/tasks\.json', 'add_task'),
+    ('PUT', r'/tasks/(\d+)\.json', 'update_task'),
+    ('DELETE', r'/tasks/(\d+)\.json', 'delete_task'),
+    ('GET', r'/time_entries\.json', 'time_entries'),
+    ('POST', r'/time_entries\.json', 'add_time_entry'),
+    ('GET', r'/time_entries/(\d+)\.json', 'time_entry'),
+    ('PUT', r'/time_entries/(\d+)\.json', 'update_time_entry'),
+    ('DELETE', r'/time_entries/(\d+)\.json', 'delete_time_entry'),
+]]
+
+class TogglServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, dataset, latency=0.0, jitter=0.0,
+            error_rate=0.0, error_status=503, seed=None, verbose=False):
+        HTTPServer.__init__(self, address, TogglRequestHandler)
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.verbose = verbose
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._requests = 0
+
+    def count(self, route):
+        with self._lock:
+            self._requests += 1
+            self._counts[route] = self._counts.get(route, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self._requests, 'routes': dict(self._counts)}
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self._lock:
+                extra = self._random.uniform(0, self.jitter)
+            time.sleep(self.latency + extra)
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+def main():
+    parser = argparse.ArgumentParser(prog='togglserver.py',
+            description='Local stand-in for the Toggl v6 API.')
+    parser.add_argument('-p', '--port', help='Port to listen on (0 picks a free one)', type=int, default=8080)
+    parser.add_argument('--host', help='Address to listen on', default='127.0.0.1')
+    parser.add_argument('--workspaces', help='Number of workspaces', type=int, default=2)
+    parser.add_argument('--clients', help='Number of clients', type=int, default=20)
+    parser.add_argument('--projects', help='Number of projects', type=int, default=200)
+    parser.add_argument('--tasks', help='Number of tasks', type=int, default=100)
+    parser.add_argument('--users', help='Number of users per workspace', type=int, default=5)
+    parser.add_argument('--entries', help='Number of time entries', type=int, default=10000)
+    parser.add_argument('--days', help='Number of days the time entries are spread over', type=float, default=365)
+    parser.add_argument('--latency', help='Milliseconds to wait before answering each request', type=float, default=0)
+    parser.add_argument('--jitter', help='Up to this many more milliseconds, at random', type=float, default=0)
+    parser.add_argument('--error-rate', help='Fraction of requests answered with an error', type=float, default=0)
+    parser.add_argument('--error-status', help='HTTP status of those errors', type=int, default=503)
+    parser.add_argument('--seed', help='Random seed for the jitter and errors', type=int, default=None)
+    parser.add_argument('-v', '--verbose', help='Log every request', action='store_true', default=False)
+    args = parser.parse_args()
+
+    if args.workspaces < 1:
+        parser.error('--workspaces must be at least 1')
+
+    dataset = TogglDataset(workspaces=args.workspaces, clients=args.clients,
+            projects=args.projects, tasks=args.tasks, users=args.users,
+            entries=args.entries, days=args.days)
+    server = TogglServer((args.host, args.port), dataset,
+            latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+            error_rate=args.error_rate, error_status=args.error_status,
+            seed=args.seed, verbose=args.verbose)
+
+    # The first line tells scripts (such as togglbench.py) where to connect.
+    print("Listening on http://%s:%d%s" % (args.host, server.server_address[1],
+            API_PREFIX[:-len('/v6')]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+togglstore.py
+
+Local SQLite store for time entries. TogglApi keeps the store in sync with
+the server so that range queries over old, stable entries can be answered
+without downloading them again.
+"""
+
+import json
+import os
+import threading
+import time
+
+STORE_SCHEMA_VERSION = 1
+DEFAULT_STABLE_DAYS = 7
+
+class TogglEntryStore:
+    """Keeps time entries keyed by id and indexed by start time.
+
+    The store tracks the single contiguous range of start times that has
+    been fetched from the server. Entries that started more than
+    stable_days ago are assumed not to change any more and are served
+    locally; anything newer is fetched again on every query.
+    """
+    def __init__(self, path, stable_days=DEFAULT_STABLE_DAYS):
+        self._path = os.path.expanduser(path)
+        self._stable_secs = stable_days * 60 * 60 * 24
+        self._conn = None
+        # TogglApi may be shared by worker threads (e.g. toggl import), so
+        # the connection is used from several threads under this lock.
+        self._lock = threading.RLock()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def _db(self):
+        # Opened on first use so that commands which never touch time
+        # entries do not pay for importing sqlite3.
+        with self._lock:
+            if self._conn is None:
+                import sqlite3
+                self._conn = sqlite3.connect(self._path, check_same_thread=False)
+                self._init_schema()
+        return self._conn
+
+    def _init_schema(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version != STORE_SCHEMA_VERSION:
+            self._db.execute("DROP TABLE IF EXISTS entries")
+            self._db.execute("DROP TABLE IF EXISTS meta")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                "id INTEGER PRIMARY KEY, start REAL NOT NULL, fields TEXT NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_start ON entries (start)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta ("
+                "key TEXT PRIMARY KEY, value REAL NOT NULL)")
+        self._db.execute("PRAGMA user_version = %d" % STORE_SCHEMA_VERSION)
+        self._db.commit()
+
+    def _get_meta(self, key):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def coverage(self):
+        """Returns the (low, high) epoch range already synced, or None."""
+        with self._lock:
+            low = self._get_meta('synced_low')
+            high = self._get_meta('synced_high')
+        if low is None or high is None:
+            return None
+        return (low, high)
+
+    def missing_ranges(self, low, high, refresh=False, now=None):
+        """Returns the epoch ranges that must be fetched to answer a query
+        for entries starting between low and high.
+
+        The returned ranges always keep the synced range contiguous."""
+        if now is None:
+            now = time.time()
+
+        cov = self.coverage()
+        if cov is None or refresh:
+            ranges = [(low, high)]
+            if cov is not None:
+                # Bridge any gap so the synced range stays contiguous.
+                if high < cov[0]:
+                    ranges.append((high, cov[0]))
+                elif low > cov[1]:
+                    ranges.append((cov[1], low))
+            return ranges
+
+        ranges = []
+        if low < cov[0]:
+            ranges.append((low, cov[0]))
+
+        # Anything that started after the stable horizon may still change.
+        stable_high = min(cov[1], now - self._stable_secs)
+        if high > stable_high:
+            ranges.append((max(stable_high, cov[0]), high))
+
+        return ranges
+
+    def replace_range(self, low, high, entries):
+        """Replaces all entries starting between low and high with the given
+        list of (start_epoch, fields) pairs."""
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE start >= ? AND start <= ?", (low, high))
+            self._db.executemany("INSERT OR REPLACE INTO entries (id, start, fields) VALUES (?, ?, ?)",
+                    [(fields['id'], start, json.dumps(fields)) for start, fields in entries])
+
+    def extend_coverage(self, low, high):
+        with self._lock:
+            cov = self.coverage()
+            if cov is not None:
+                low = min(low, cov[0])
+                high = max(high, cov[1])
+            self._set_meta('synced_low', low)
+            self._set_meta('synced_high', high)
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def query(self, low, high):
+        """Returns the fields of every entry starting between low and high,
+        ordered by start time."""
+        with self._lock:
+            rows = self._db.execute("SELECT fields FROM entries "
+                    "WHERE start >= ? AND start <= ? ORDER BY start, id", (low, high)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get(self, entry_id):
+        """Returns the fields of the entry with the given id, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT fields FROM entries WHERE id = ?",
+                    (int(entry_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def recent(self, limit):
+        """Returns the fields of the latest entries, newest first."""
+        with self._lock:
+            rows = self._db.execute("SELECT fields FROM entries "
+                    "ORDER BY start DESC, id DESC LIMIT ?", (limit,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def upsert(self, start, fields):
+        """Adds or updates a single entry."""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO entries (id, start, fields) VALUES (?, ?, ?)",
+                    (fields['id'], start, json.dumps(fields)))
+            self._db.commit()
+
+    def delete(self, entry_id):
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE id = ?", (int(entry_id),))
+            self._db.commit()
+
+    def size(self):
+        try:
+            return os.path.getsize(self._path)
+        except OSError:
+            return 0
+
+    def trim(self, max_bytes):
+        """Removes the oldest entries until the database fits in max_bytes,
+        moving the start of the synced range up past them so that they are
+        fetched again if asked for. Returns how many entries were removed."""
+        removed = 0
+        with self._lock:
+            while self.size() > max_bytes:
+                count = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                if count == 0:
+                    break
+                # Rows take about the same space each; remove a share of
+                # them matching the excess.
+                size = self.size()
+                remove = max(1, int(count * float(size - max(max_bytes, 0)) / size + 0.5))
+                if remove >= count:
+                    self._db.execute("DELETE FROM entries")
+                    self._db.execute("DELETE FROM meta")
+                    removed += count
+                else:
+                    cutoff = self._db.execute("SELECT start FROM entries ORDER BY start "
+                            "LIMIT 1 OFFSET ?", (remove - 1,)).fetchone()[0]
+                    removed += self._db.execute("DELETE FROM entries WHERE start <= ?",
+                            (cutoff,)).rowcount
+                    low = self._db.execute("SELECT MIN(start) FROM entries").fetchone()[0]
+                    cov = self.coverage()
+                    if cov is not None and low > cov[1]:
+                        self._db.execute("DELETE FROM meta")
+                    elif cov is not None:
+                        self._set_meta('synced_low', max(low, cov[0]))
+                self._db.commit()
+                # Deleted rows only free pages; the file shrinks on VACUUM,
+                # which has to wait for other commands using the store.
+                import sqlite3
+                try:
+                    self._db.execute("VACUUM")
+                except sqlite3.OperationalError:
+                    break
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM entries")
+            self._db.execute("DELETE FROM meta")
+            self._db.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None